@@ -0,0 +1,135 @@
+"""
+Assignment Expiry Scheduler
+Fires rider offer timeouts at their exact deadline instead of polling.
+
+Deadlines live in a min-heap keyed by expiry time. A single asyncio task
+sleeps until the earliest one, releases everything that is due with one
+set-based UPDATE (db.clear_expired_assignments) and goes back to sleep.
+Accepting or rejecting an offer cancels its timer; cancelled and superseded
+entries are dropped lazily when they reach the top of the heap.
+
+On startup the heap is rebuilt from the orders table, and it is reconciled
+against the table every RECONCILE_INTERVAL seconds so offers made by another
+server process still expire on time.
+"""
+import asyncio
+import heapq
+import time
+from datetime import datetime, UTC
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Union
+
+import db
+
+RECONCILE_INTERVAL = 60.0
+
+ExpiryCallback = Callable[[List[str]], Awaitable[None]]
+
+def _deadline_timestamp(expires_at: Union[str, datetime, float]) -> float:
+    if isinstance(expires_at, (int, float)):
+        return float(expires_at)
+    if isinstance(expires_at, str):
+        expires_at = datetime.fromisoformat(expires_at)
+    if expires_at.tzinfo is None:
+        # Stored deadlines are UTC; older rows may lack the offset
+        expires_at = expires_at.replace(tzinfo=UTC)
+    return expires_at.timestamp()
+
+class AssignmentExpiryScheduler:
+    """Heap of (deadline, order_id) drained by one asyncio task"""
+
+    def __init__(self, on_expired: Optional[ExpiryCallback] = None):
+        self.on_expired = on_expired
+        self._heap: List[Tuple[float, str]] = []
+        self._deadlines: Dict[str, float] = {}
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_reconcile = 0.0
+
+    def schedule(self, order_id: str, expires_at: Union[str, datetime, float]) -> None:
+        """Register (or move) the deadline for an order's current offer"""
+        deadline = _deadline_timestamp(expires_at)
+        self._deadlines[order_id] = deadline
+        heapq.heappush(self._heap, (deadline, order_id))
+        # Only the loop needs to re-arm when the new deadline is the earliest
+        if self._wakeup is not None and self._heap[0] == (deadline, order_id):
+            self._wakeup.set()
+
+    def cancel(self, order_id: str) -> None:
+        """Forget an order's deadline (offer accepted or rejected)"""
+        self._deadlines.pop(order_id, None)
+
+    def pending(self) -> int:
+        return len(self._deadlines)
+
+    def _pop_due(self, now: float) -> List[str]:
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, order_id = heapq.heappop(self._heap)
+            # Skip cancelled entries and ones superseded by a later schedule()
+            if self._deadlines.get(order_id) == deadline:
+                del self._deadlines[order_id]
+                due.append(order_id)
+        return due
+
+    async def rebuild(self) -> int:
+        """Load every outstanding offer deadline from the database"""
+        deadlines = await db.aio.get_assignment_deadlines()
+        for order_id, expires_at in deadlines:
+            if self._deadlines.get(order_id) != _deadline_timestamp(expires_at):
+                self.schedule(order_id, expires_at)
+        self._last_reconcile = time.time()
+        return len(deadlines)
+
+    async def _expire(self, order_ids: List[str]) -> None:
+        expired = await db.aio.clear_expired_assignments(order_ids)
+        if expired:
+            print(f"⏰ Cleared {len(expired)} expired assignments: {expired}")
+            if self.on_expired:
+                await self.on_expired(expired)
+
+    async def run(self) -> None:
+        self._wakeup = asyncio.Event()
+        while True:
+            try:
+                now = time.time()
+                due = self._pop_due(now)
+                if due:
+                    await self._expire(due)
+                    continue
+
+                if now - self._last_reconcile >= RECONCILE_INTERVAL:
+                    await self.rebuild()
+                    continue
+
+                timeout = self._last_reconcile + RECONCILE_INTERVAL - now
+                if self._heap:
+                    timeout = min(timeout, self._heap[0][0] - now)
+
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=max(timeout, 0))
+                except asyncio.TimeoutError:
+                    pass
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error in assignment expiry scheduler: {e}")
+                await asyncio.sleep(1)
+
+    async def start(self) -> None:
+        """Rebuild from the database and start the timer task"""
+        count = await self.rebuild()
+        self._task = asyncio.create_task(self.run())
+        print(f"✅ Assignment expiry scheduler started ({count} pending offers)")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._wakeup = None
+
+scheduler = AssignmentExpiryScheduler()
@@ -0,0 +1,195 @@
+"""
+Batch Dispatch
+Matches all pending orders to available riders at once instead of greedily.
+
+Greedy dispatch gives each order the nearest free rider in arrival order,
+which during rush hour strands later orders with far-away riders. The batch
+dispatcher builds one cost matrix for every (order, rider) pair and picks
+the assignment with the lowest total cost (rectangular linear assignment).
+
+Cost, in kilometre-equivalents:
+    distance_km + RATING_WEIGHT * (5 - rating) + LOAD_WEIGHT * active_orders
+
+Pairs further apart than MAX_DISPATCH_KM, and riders an order was already
+offered to, are infeasible and never matched. scipy's linear_sum_assignment
+is used when installed; otherwise an equivalent NumPy shortest augmenting
+path solver runs (1,000 x 1,000 in well under a second).
+"""
+from typing import Any, Dict, List, Sequence, Tuple
+
+import numpy as np
+
+import geo
+
+try:
+    from scipy.optimize import linear_sum_assignment as _scipy_lsa
+except ImportError:  # scipy is optional
+    _scipy_lsa = None
+
+RATING_WEIGHT = 0.5  # km a rider one star lower must be closer by to win
+LOAD_WEIGHT = 2.0    # km per order the rider is already carrying
+MAX_DISPATCH_KM = 15.0
+INFEASIBLE = 1e9
+
+def _solve_numpy(cost: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Shortest augmenting path (Jonker-Volgenant style) for n rows <= m columns.
+
+    One Dijkstra-like search per row over reduced costs; each step is a
+    vectorized pass over the columns, so the Python loop runs once per
+    column visited rather than once per matrix cell.
+    """
+    n, m = cost.shape
+    u = np.zeros(n)
+    v = np.zeros(m)
+    col4row = np.full(n, -1, dtype=np.intp)
+    row4col = np.full(m, -1, dtype=np.intp)
+    rows = np.arange(n)
+
+    # Warm start with duals that keep every reduced cost >= 0, pre-matching
+    # pairs that are already tight, so only contested rows need a search
+    if n == m:
+        # Square: v = column minima, each column claims its cheapest row
+        v[:] = cost.min(axis=0)
+        cheapest = cost.argmin(axis=0)
+        _, first = np.unique(cheapest, return_index=True)
+        row4col[first] = cheapest[first]
+        col4row[cheapest[first]] = first
+        unmatched = col4row < 0
+        u[unmatched] = (cost[unmatched] - v).min(axis=1)
+    else:
+        # Rectangular: unmatched columns must keep v = 0, so reduce rows instead
+        u[:] = cost.min(axis=1)
+        cheapest = cost.argmin(axis=1)
+        _, first = np.unique(cheapest, return_index=True)
+        col4row[first] = cheapest[first]
+        row4col[cheapest[first]] = first
+
+    for cur_row in np.flatnonzero(col4row < 0):
+        shortest = np.full(m, np.inf)
+        path = np.full(m, -1, dtype=np.intp)
+        visited_rows = np.zeros(n, dtype=bool)
+        visited_cols = np.zeros(m, dtype=bool)
+        # -v for open columns, +inf once visited, so visited columns never improve
+        open_v = -v
+        # Tentative distances of open columns; visited ones are parked at +inf
+        frontier = np.full(m, np.inf)
+        free_cols = np.flatnonzero(row4col < 0)
+        min_val = 0.0
+        i = cur_row
+        sink = -1
+
+        while sink < 0:
+            visited_rows[i] = True
+            reduced = cost[i] + open_v
+            reduced += min_val - u[i]
+            better = reduced < frontier
+            np.copyto(path, i, where=better)
+            np.copyto(frontier, reduced, where=better)
+
+            j = int(frontier.argmin())
+            min_val = frontier[j]
+            if min_val == np.inf:
+                raise ValueError("cost matrix is infeasible")
+            # Prefer a free column among equally short ones: ends the search
+            # sooner, which matters on matrices full of ties
+            if row4col[j] >= 0:
+                free_frontier = frontier[free_cols]
+                k = int(free_frontier.argmin())
+                if free_frontier[k] == min_val:
+                    j = int(free_cols[k])
+            shortest[j] = min_val
+            visited_cols[j] = True
+            open_v[j] = np.inf
+            frontier[j] = np.inf
+            if row4col[j] < 0:
+                sink = j
+            else:
+                i = row4col[j]
+
+        # Update duals
+        u[cur_row] += min_val
+        others = visited_rows & (rows != cur_row)
+        u[others] += min_val - shortest[col4row[others]]
+        v[visited_cols] -= min_val - shortest[visited_cols]
+
+        # Augment along the path
+        j = sink
+        while True:
+            i = path[j]
+            row4col[j] = i
+            col4row[i], j = j, col4row[i]
+            if i == cur_row:
+                break
+
+    return rows, col4row
+
+def solve_assignment(cost: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Minimum-cost rectangular assignment: (row indices, column indices), like scipy's"""
+    cost = np.asarray(cost, dtype=float)
+    if cost.size == 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+    if _scipy_lsa is not None:
+        return _scipy_lsa(cost)
+    if np.isnan(cost).any() or np.isneginf(cost).any():
+        raise ValueError("cost matrix contains invalid numeric entries")
+
+    # +inf marks forbidden pairs, as in scipy. Stand in a finite cost dearer
+    # than any all-finite assignment, then reject answers that still use one.
+    forbidden = np.isposinf(cost)
+    if forbidden.any():
+        finite = cost[~forbidden]
+        k = min(cost.shape)
+        big = (2 * k + 1) * (float(np.abs(finite).max()) + 1.0) if finite.size else 1.0
+        rows, cols = _solve_rectangular(np.where(forbidden, big, cost))
+        if forbidden[rows, cols].any():
+            raise ValueError("cost matrix is infeasible")
+        return rows, cols
+    return _solve_rectangular(cost)
+
+def _solve_rectangular(cost: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    if cost.shape[0] > cost.shape[1]:
+        cols, rows = _solve_numpy(cost.T)
+        order = np.argsort(rows)
+        return rows[order], cols[order]
+    return _solve_numpy(cost)
+
+def build_cost_matrix(
+    orders: Sequence[Dict[str, Any]],
+    riders: Sequence[Dict[str, Any]]
+) -> Tuple[np.ndarray, np.ndarray]:
+    """(cost, distance_km) matrices for orders x riders.
+
+    orders: {'id', 'lat', 'lng', 'exclude': set of rider IDs}
+    riders: {'id', 'lat', 'lng', 'rating', 'load'}
+    """
+    order_ll = np.array([(o['lat'], o['lng']) for o in orders], dtype=float).reshape(-1, 2)
+    rider_ll = np.array([(r['lat'], r['lng']) for r in riders], dtype=float).reshape(-1, 2)
+    ratings = np.array([r.get('rating') or 0.0 for r in riders], dtype=float)
+    loads = np.array([r.get('load') or 0 for r in riders], dtype=float)
+
+    distance = geo.distance_matrix_km(order_ll[:, 0], order_ll[:, 1], rider_ll[:, 0], rider_ll[:, 1])
+    cost = distance + RATING_WEIGHT * (5.0 - np.clip(ratings, 0.0, 5.0)) + LOAD_WEIGHT * loads
+    cost[distance > MAX_DISPATCH_KM] = INFEASIBLE
+
+    rider_columns = {r['id']: j for j, r in enumerate(riders)}
+    for i, order in enumerate(orders):
+        for rider_id in order.get('exclude') or ():
+            j = rider_columns.get(rider_id)
+            if j is not None:
+                cost[i, j] = INFEASIBLE
+    return cost, distance
+
+def plan_batch(
+    orders: Sequence[Dict[str, Any]],
+    riders: Sequence[Dict[str, Any]]
+) -> List[Tuple[str, int, float]]:
+    """Globally cheapest (order_id, rider_id, distance_km) offers; infeasible pairs are dropped"""
+    if not orders or not riders:
+        return []
+    cost, distance = build_cost_matrix(orders, riders)
+    row_ind, col_ind = solve_assignment(cost)
+    return [
+        (orders[i]['id'], riders[j]['id'], float(distance[i, j]))
+        for i, j in zip(row_ind, col_ind)
+        if cost[i, j] < INFEASIBLE
+    ]
@@ -106,15 +106,15 @@ if len(existing_orders) < 3:
     ]
     
     orders_created = 0
-    for i, order_data in enumerate(sample_orders, 1):
-        try:
-            order_id = db.create_order(order_data)
-            print(f"✅ Order {i} created: ID={order_id}, Status={order_data['status']}, Rider={order_data.get('rider_id', 'None')}")
-            orders_created += 1
-        except Exception as e:
-            print(f"⚠️  Error creating order {i}: {e}")
-            import traceback
-            traceback.print_exc()
+    try:
+        # One transaction for the whole batch
+        orders_created = db.create_orders(sample_orders, return_orders=False)
+        for i, order_data in enumerate(sample_orders, 1):
+            print(f"✅ Order {i} created: Status={order_data['status']}, Rider={order_data.get('rider_id', 'None')}")
+    except Exception as e:
+        print(f"⚠️  Error creating sample orders: {e}")
+        import traceback
+        traceback.print_exc()
     
     print(f"\n✅ Created {orders_created} sample orders")
     print(f"📦 Statuses: pending, assigned, in_transit, pickup, delivered")
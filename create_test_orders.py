@@ -4,11 +4,9 @@ Create Sample Orders with Ghana Addresses
 This script creates sample orders with real Ghana addresses for testing geocoding.
 """
 
-import sqlite3
-import json
 from datetime import datetime
 
-DB_PATH = "gasfill.db"
+import db
 
 GHANA_ADDRESSES = [
     "Circle, Accra",
@@ -25,21 +23,19 @@ GHANA_ADDRESSES = [
 
 def create_test_orders():
     """Create sample orders with Ghana addresses but no location."""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+    db.init_db()
     
-    created_count = 0
+    new_orders = []
     
     for i, address in enumerate(GHANA_ADDRESSES, 1):
         order_id = f"TEST-{datetime.now().strftime('%Y%m%d')}-{i:03d}"
         
         # Check if order already exists
-        cursor.execute("SELECT id FROM orders WHERE id = ?", (order_id,))
-        if cursor.fetchone():
+        if db.get_order_by_id(order_id):
             print(f"⊘ Order {order_id} already exists, skipping")
             continue
         
-        order_data = {
+        new_orders.append({
             'id': order_id,
             'customer_name': f'Test Customer {i}',
             'customer_email': f'test{i}@gasfill.com',
@@ -51,35 +47,17 @@ def create_test_orders():
             'status': 'pending',
             'payment_status': 'pending',
             'created_at': datetime.now().isoformat(),
-            'updated_at': datetime.now().isoformat()
-        }
-        
-        # Sample items
-        items = [
-            {'name': '13kg Gas Cylinder Refill', 'quantity': 1, 'price': 120.00}
-        ]
-        items_json = json.dumps(items)
-        
-        cursor.execute("""
-            INSERT INTO orders (
-                id, items, customer_name, customer_email, customer_phone,
-                customer_address, customer_location, total, delivery_type,
-                status, payment_status, created_at, updated_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            order_data['id'], items_json, order_data['customer_name'],
-            order_data['customer_email'], order_data['customer_phone'],
-            order_data['customer_address'], order_data['customer_location'],
-            order_data['total'], order_data['delivery_type'],
-            order_data['status'], order_data['payment_status'],
-            order_data['created_at'], order_data['updated_at']
-        ))
+            'updated_at': datetime.now().isoformat(),
+            # Sample items
+            'items': [
+                {'name': '13kg Gas Cylinder Refill', 'quantity': 1, 'price': 120.00}
+            ]
+        })
         
         print(f"✓ Created order {order_id}: {address}")
-        created_count += 1
     
-    conn.commit()
-    conn.close()
+    # Single transaction for the whole batch
+    created_count = db.create_orders(new_orders, return_orders=False)
     
     print()
     print(f"✓ Created {created_count} test orders")
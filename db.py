@@ -1,16 +1,217 @@
 import sqlite3
 import json
+import math
+import asyncio
+import atexit
+import functools
+import itertools
+import operator
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from contextlib import contextmanager
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Callable, Optional, Iterator, Iterable, Sequence, Tuple, Union
 from datetime import datetime, timedelta, UTC
 
+import ids
+
 DB_PATH = Path(__file__).parent / 'gasfill.db'
 
-def init_db():
-    """Initialize SQLite database with orders table"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    
+# Pragmas applied once to every pooled connection
+CONNECTION_PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA busy_timeout=5000',
+    'PRAGMA cache_size=-16000',  # 16 MB page cache per connection
+    'PRAGMA temp_store=MEMORY',
+    'PRAGMA mmap_size=134217728',  # 128 MB memory-mapped I/O
+)
+STATEMENT_CACHE_SIZE = 256
+# Worker threads for async callers; each holds its own pooled connection
+DB_EXECUTOR_WORKERS = 8
+
+# Composite indexes matching the orders access paths: customer history,
+# rider order lists (all statuses, and by status), the assignment expiry sweep
+# and recency listings
+ORDER_INDEXES = (
+    'CREATE INDEX IF NOT EXISTS idx_orders_customer_created ON orders(customer_email, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_orders_rider_status ON orders(rider_id, status, created_at)',
+    'CREATE INDEX IF NOT EXISTS idx_orders_rider_created ON orders(rider_id, created_at, id)',
+    'CREATE INDEX IF NOT EXISTS idx_orders_status_expiry ON orders(status, assignment_expires_at)',
+    'CREATE INDEX IF NOT EXISTS idx_orders_created ON orders(created_at, id)',
+)
+
+# ============================================================================
+# CONNECTION POOL
+# ============================================================================
+
+class ConnectionPool:
+    """Long-lived SQLite connections, one per thread.
+
+    Each thread keeps its own connection (SQLite connections must not be
+    shared between concurrent threads), so the page cache and prepared
+    statement cache stay warm across calls instead of being rebuilt on every
+    query. Connections are reopened automatically if DB_PATH changes.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections: List[sqlite3.Connection] = []
+        self._trace = None
+
+    def _open(self, path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            path,
+            timeout=5.0,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            check_same_thread=False  # only the owning thread uses it; close_all() may run elsewhere
+        )
+        conn.row_factory = sqlite3.Row
+        for pragma in CONNECTION_PRAGMAS:
+            conn.execute(pragma)
+        with self._lock:
+            self._connections.append(conn)
+        return conn
+
+    def _discard(self, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+
+    def connection(self) -> sqlite3.Connection:
+        """Get the calling thread's connection, opening it on first use"""
+        path = str(DB_PATH)
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.path != path:
+            self._discard(conn)
+            conn = None
+        if conn is None:
+            conn = self._open(path)
+            self._local.conn = conn
+            self._local.path = path
+            self._local.depth = 0
+            self._local.trace = None
+        elif self._local.depth == 0 and conn.in_transaction:
+            # A previous caller on this thread failed mid-write; don't inherit its transaction
+            conn.rollback()
+        if self._local.trace is not self._trace:
+            conn.set_trace_callback(self._trace)
+            self._local.trace = self._trace
+        return conn
+
+    def set_trace(self, callback) -> None:
+        """Install a statement trace callback on every pooled connection (None removes it).
+
+        Each thread picks the change up the next time it asks for its connection.
+        """
+        self._trace = callback
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        """Commit on success, roll back on error. Nested blocks join the outer transaction."""
+        conn = self.connection()
+        self._local.depth += 1
+        try:
+            yield conn
+        except BaseException:
+            self._local.depth -= 1
+            if self._local.depth == 0:
+                conn.rollback()
+            raise
+        self._local.depth -= 1
+        if self._local.depth == 0:
+            conn.commit()
+
+    def close_all(self) -> None:
+        """Close every pooled connection (call on shutdown)"""
+        with self._lock:
+            connections, self._connections = self._connections, []
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+        self._local = threading.local()
+
+_pool = ConnectionPool()
+
+def get_connection() -> sqlite3.Connection:
+    """Get this thread's pooled connection to DB_PATH (do not close it)"""
+    return _pool.connection()
+
+def transaction():
+    """Context manager yielding the pooled connection inside a transaction"""
+    return _pool.transaction()
+
+def close_all_connections() -> None:
+    """Close all pooled connections"""
+    _pool.close_all()
+
+def set_query_trace(callback) -> None:
+    """Receive every SQL statement the pooled connections run (see query_advisor.py)"""
+    _pool.set_trace(callback)
+
+# ============================================================================
+# ASYNC ACCESS
+# ============================================================================
+
+_executor: Optional[ThreadPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+def _get_executor() -> ThreadPoolExecutor:
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=DB_EXECUTOR_WORKERS,
+                    thread_name_prefix='gasfill-db'
+                )
+    return _executor
+
+async def run_blocking(fn, *args, **kwargs):
+    """Run a blocking callable on the database executor and await its result.
+
+    Use this from async handlers for anything that touches SQLite so the
+    event loop thread never waits on disk I/O or locks.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), functools.partial(fn, *args, **kwargs))
+
+class _AsyncDB:
+    """Awaitable view of this module: ``await db.aio.get_order_by_id(order_id)``"""
+
+    def __getattr__(self, name: str):
+        fn = getattr(sys.modules[__name__], name)
+        if not callable(fn):
+            raise AttributeError(name)
+
+        async def call(*args, **kwargs):
+            return await run_blocking(fn, *args, **kwargs)
+
+        call.__name__ = name
+        return call
+
+aio = _AsyncDB()
+
+def shutdown_executor() -> None:
+    """Stop the database executor and close its connections"""
+    global _executor
+    with _executor_lock:
+        executor, _executor = _executor, None
+    if executor is not None:
+        executor.shutdown(wait=True)
+    close_all_connections()
+
+def _migrate_base_schema(cur: sqlite3.Cursor) -> None:
     # Users table
     cur.execute('''
         CREATE TABLE IF NOT EXISTS users (
@@ -26,7 +227,7 @@ def init_db():
             updated_at TEXT NOT NULL
         )
     ''')
-    
+
     # Riders table
     cur.execute('''
         CREATE TABLE IF NOT EXISTS riders (
@@ -60,7 +261,7 @@ def init_db():
             updated_at TEXT NOT NULL
         )
     ''')
-    
+
     # Orders table
     cur.execute('''
         CREATE TABLE IF NOT EXISTS orders (
@@ -87,10 +288,14 @@ def init_db():
             assigned_riders TEXT,
             customer_location TEXT,
             distance_km REAL,
-            estimated_time_minutes INTEGER
+            estimated_time_minutes INTEGER,
+            rating INTEGER,
+            rating_comment TEXT,
+            rated_at TEXT,
+            delivery_fee REAL DEFAULT 10.0
         )
     ''')
-    
+
     # Chat rooms table
     cur.execute('''
         CREATE TABLE IF NOT EXISTS chat_rooms (
@@ -103,7 +308,7 @@ def init_db():
             last_message_time TEXT
         )
     ''')
-    
+
     # Chat participants table
     cur.execute('''
         CREATE TABLE IF NOT EXISTS chat_participants (
@@ -118,7 +323,7 @@ def init_db():
             UNIQUE(chat_room_id, user_id, user_type)
         )
     ''')
-    
+
     # Chat messages table
     cur.execute('''
         CREATE TABLE IF NOT EXISTS chat_messages (
@@ -138,7 +343,7 @@ def init_db():
             FOREIGN KEY (chat_room_id) REFERENCES chat_rooms(id)
         )
     ''')
-    
+
     # Ratings table
     cur.execute('''
         CREATE TABLE IF NOT EXISTS ratings (
@@ -165,7 +370,7 @@ def init_db():
             FOREIGN KEY (order_id) REFERENCES orders(id)
         )
     ''')
-    
+
     # Create indexes for better query performance
     cur.execute('CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_riders_email ON riders(email)')
@@ -178,131 +383,556 @@ def init_db():
     cur.execute('CREATE INDEX IF NOT EXISTS idx_ratings_reviewee ON ratings(reviewee_id, reviewee_type)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_ratings_reviewer ON ratings(reviewer_id, reviewer_type)')
     cur.execute('CREATE INDEX IF NOT EXISTS idx_ratings_dispute ON ratings(disputed, dispute_status)')
-    
-    # Migration: Add new columns to orders table if they don't exist
-    try:
-        cur.execute("SELECT status_history FROM orders LIMIT 1")
-    except:
-        cur.execute("ALTER TABLE orders ADD COLUMN status_history TEXT")
-    
-    try:
-        cur.execute("SELECT tracking_updates FROM orders LIMIT 1")
-    except:
-        cur.execute("ALTER TABLE orders ADD COLUMN tracking_updates TEXT")
-    
-    try:
-        cur.execute("SELECT estimated_delivery FROM orders LIMIT 1")
-    except:
-        cur.execute("ALTER TABLE orders ADD COLUMN estimated_delivery TEXT")
-    
-    try:
-        cur.execute("SELECT rating FROM orders LIMIT 1")
-    except:
-        cur.execute("ALTER TABLE orders ADD COLUMN rating INTEGER")
-    
-    try:
-        cur.execute("SELECT rating_comment FROM orders LIMIT 1")
-    except:
-        cur.execute("ALTER TABLE orders ADD COLUMN rating_comment TEXT")
-    
-    try:
-        cur.execute("SELECT rated_at FROM orders LIMIT 1")
-    except:
-        cur.execute("ALTER TABLE orders ADD COLUMN rated_at TEXT")
-    
-    # Migration: Add document URL columns to riders table if they don't exist
-    try:
-        cur.execute("SELECT license_photo_url FROM riders LIMIT 1")
-    except:
-        cur.execute("ALTER TABLE riders ADD COLUMN license_photo_url TEXT")
-    
-    try:
-        cur.execute("SELECT vehicle_photo_url FROM riders LIMIT 1")
-    except:
-        cur.execute("ALTER TABLE riders ADD COLUMN vehicle_photo_url TEXT")
-    
-    conn.commit()
-    conn.close()
 
-def _row_to_order(row: sqlite3.Row) -> Dict[str, Any]:
-    """Convert SQLite row to order dict"""
-    order_dict = {
-        'id': row['id'],
-        'items': json.loads(row['items']) if row['items'] else [],
-        'total': row['total'],
-        'customer_email': row['customer_email'],
-        'customer_name': row['customer_name'],
-        'customer_phone': row['customer_phone'],
-        'customer_address': row['customer_address'],
-        'delivery_type': row['delivery_type'],
-        'status': row['status'],
-        'payment_status': row['payment_status'],
-        'payment_reference': row['payment_reference'],
-        'created_at': row['created_at'],
-        'updated_at': row['updated_at'],
-        'rider_id': row['rider_id'],
-        'tracking_info': json.loads(row['tracking_info']) if row['tracking_info'] else None
-    }
-    
-    # Add new fields if they exist
-    try:
-        order_dict['status_history'] = json.loads(row['status_history']) if row['status_history'] else []
-    except (KeyError, IndexError):
-        order_dict['status_history'] = []
-    
-    try:
-        order_dict['tracking_updates'] = json.loads(row['tracking_updates']) if row['tracking_updates'] else []
-    except (KeyError, IndexError):
-        order_dict['tracking_updates'] = []
-    
-    try:
-        order_dict['estimated_delivery'] = row['estimated_delivery']
-    except (KeyError, IndexError):
-        order_dict['estimated_delivery'] = None
-    
-    try:
-        order_dict['rating'] = row['rating']
-    except (KeyError, IndexError):
-        order_dict['rating'] = None
-    
-    try:
-        order_dict['rating_comment'] = row['rating_comment']
-    except (KeyError, IndexError):
-        order_dict['rating_comment'] = None
-    
-    try:
-        order_dict['rated_at'] = row['rated_at']
-    except (KeyError, IndexError):
-        order_dict['rated_at'] = None
+def _add_missing_columns(cur: sqlite3.Cursor, table: str, columns: List[Tuple[str, str]]) -> None:
+    cur.execute(f'PRAGMA table_info({table})')
+    existing = {row[1] for row in cur.fetchall()}
+    for name, column_type in columns:
+        if name not in existing:
+            cur.execute(f'ALTER TABLE {table} ADD COLUMN {name} {column_type}')
+
+def _migrate_legacy_columns(cur: sqlite3.Cursor) -> None:
+    """Columns older databases picked up through init_db probes and the helper scripts"""
+    _add_missing_columns(cur, 'orders', [
+        ('status_history', 'TEXT'),
+        ('tracking_updates', 'TEXT'),
+        ('estimated_delivery', 'TEXT'),
+        ('rating', 'INTEGER'),
+        ('rating_comment', 'TEXT'),
+        ('rated_at', 'TEXT'),
+        ('assignment_expires_at', 'TEXT'),
+        ('assignment_attempts', 'INTEGER DEFAULT 0'),
+        ('assigned_riders', 'TEXT'),
+        ('customer_location', 'TEXT'),
+        ('distance_km', 'REAL'),
+        ('estimated_time_minutes', 'INTEGER'),
+        ('delivery_fee', 'REAL DEFAULT 10.0'),
+    ])
+    _add_missing_columns(cur, 'riders', [
+        ('license_photo_url', 'TEXT'),
+        ('vehicle_photo_url', 'TEXT'),
+    ])
+
+def _migrate_order_events(cur: sqlite3.Cursor) -> None:
+    # Order status events (append-only history, one row per transition)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS order_status_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id TEXT NOT NULL,
+            status TEXT NOT NULL,
+            note TEXT,
+            location TEXT,
+            created_at TEXT NOT NULL,
+            FOREIGN KEY (order_id) REFERENCES orders(id)
+        )
+    ''')
+
+    # Order location points (append-only rider GPS trail per order)
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS order_location_points (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id TEXT NOT NULL,
+            rider_id INTEGER,
+            latitude REAL,
+            longitude REAL,
+            accuracy REAL,
+            recorded_at TEXT NOT NULL,
+            FOREIGN KEY (order_id) REFERENCES orders(id)
+        )
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_order_status_events_order ON order_status_events(order_id, id)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_order_location_points_order ON order_location_points(order_id, id)')
+    _backfill_order_events(cur)
+
+def _migrate_order_indexes(cur: sqlite3.Cursor) -> None:
+    for statement in ORDER_INDEXES:
+        cur.execute(statement)
+
+def _migrate_delivery_fees(cur: sqlite3.Cursor) -> None:
+    """Price existing located orders by distance from the station (50% of total cap)"""
+    cur.execute('SELECT id, customer_location, total FROM orders WHERE customer_location IS NOT NULL')
+    updates = []
+    for order_id, customer_location, total in cur.fetchall():
+        try:
+            location = json.loads(customer_location)
+            lat = location.get('lat', location.get('latitude'))
+            lng = location.get('lng', location.get('longitude'))
+        except (json.JSONDecodeError, TypeError, AttributeError):
+            continue
+        if lat is None or lng is None:
+            continue
+        updates.append((_station_delivery_fee(lat, lng, total or 0), order_id))
+    cur.executemany('UPDATE orders SET delivery_fee=? WHERE id=?', updates)
+
+# Frozen copy of the fee rule as of migration 5; current rules live in geo.py
+_MIGRATION5_STATION_LAT = 5.6037
+_MIGRATION5_STATION_LNG = -0.1870
+
+def _station_delivery_fee(lat: float, lng: float, order_total: float) -> float:
+    lat1, lng1, lat2, lng2 = map(math.radians, (_MIGRATION5_STATION_LAT, _MIGRATION5_STATION_LNG, lat, lng))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    distance_meters = 6371000 * 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    fee = 10.0
+    if distance_meters > 500:
+        fee += math.ceil((distance_meters - 500) / 500) * 2.0
+    if order_total > 0:
+        fee = min(fee, order_total * 0.5)
+    return round(fee, 2)
+
+def _migrate_chat_unread_counts(cur: sqlite3.Cursor) -> None:
+    # Per-participant unread counters, maintained by create_chat_message / mark_messages_as_read
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS chat_unread_counts (
+            chat_room_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            user_type TEXT NOT NULL,
+            unread_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (chat_room_id, user_id, user_type)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_chat_participants_user ON chat_participants(user_id, user_type, chat_room_id)')
+    cur.execute('''
+        INSERT OR REPLACE INTO chat_unread_counts (chat_room_id, user_id, user_type, unread_count)
+        SELECT cp.chat_room_id, cp.user_id, cp.user_type, COUNT(m.id)
+        FROM chat_participants cp
+        LEFT JOIN chat_messages m
+            ON m.chat_room_id = cp.chat_room_id AND m.is_read = 0
+            AND NOT (m.sender_id = cp.user_id AND m.sender_type = cp.user_type)
+        GROUP BY cp.chat_room_id, cp.user_id, cp.user_type
+    ''')
+
+def _migrate_chat_message_keyset_index(cur: sqlite3.Cursor) -> None:
+    # Serves room history pages in (created_at, id) order; supersedes the room-only index
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_chat_messages_room_created ON chat_messages(chat_room_id, created_at, id)')
+    cur.execute('DROP INDEX IF EXISTS idx_chat_messages_room')
+
+def _migrate_rating_aggregates(cur: sqlite3.Cursor) -> None:
+    # Running totals per reviewee, maintained by create_rating / update_rating
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS rating_aggregates (
+            user_id INTEGER NOT NULL,
+            user_type TEXT NOT NULL,
+            total_ratings INTEGER NOT NULL DEFAULT 0,
+            rating_sum INTEGER NOT NULL DEFAULT 0,
+            one_star INTEGER NOT NULL DEFAULT 0,
+            two_star INTEGER NOT NULL DEFAULT 0,
+            three_star INTEGER NOT NULL DEFAULT 0,
+            four_star INTEGER NOT NULL DEFAULT 0,
+            five_star INTEGER NOT NULL DEFAULT 0,
+            updated_at TEXT,
+            PRIMARY KEY (user_id, user_type)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS rating_tag_counts (
+            user_id INTEGER NOT NULL,
+            user_type TEXT NOT NULL,
+            tag TEXT NOT NULL,
+            count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, user_type, tag)
+        ) WITHOUT ROWID
+    ''')
+    # Recent ratings for the stats endpoint come straight off this index
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_ratings_reviewee_created ON ratings(reviewee_id, reviewee_type, created_at)')
+    cur.execute('DROP INDEX IF EXISTS idx_ratings_reviewee')
     
-    # Parse customer_location from JSON string to dict
-    try:
-        customer_location = row['customer_location']
-        if customer_location:
-            order_dict['customer_location'] = json.loads(customer_location) if isinstance(customer_location, str) else customer_location
-        else:
-            order_dict['customer_location'] = None
-    except (KeyError, IndexError):
-        order_dict['customer_location'] = None
+    cur.execute('''
+        INSERT OR REPLACE INTO rating_aggregates
+            (user_id, user_type, total_ratings, rating_sum, one_star, two_star, three_star, four_star, five_star, updated_at)
+        SELECT reviewee_id, reviewee_type, COUNT(*), SUM(rating),
+               SUM(rating = 1), SUM(rating = 2), SUM(rating = 3), SUM(rating = 4), SUM(rating = 5),
+               MAX(created_at)
+        FROM ratings
+        GROUP BY reviewee_id, reviewee_type
+    ''')
+    cur.execute('''
+        INSERT OR REPLACE INTO rating_tag_counts (user_id, user_type, tag, count)
+        SELECT r.reviewee_id, r.reviewee_type, t.value, COUNT(*)
+        FROM ratings r, json_each(CASE WHEN json_valid(r.tags) THEN r.tags ELSE '[]' END) t
+        GROUP BY r.reviewee_id, r.reviewee_type, t.value
+    ''')
+
+def _migrate_order_offers(cur: sqlite3.Cursor) -> None:
+    # One row per rider an order was broadcast to; status is open, accepted,
+    # taken (another rider won), declined or expired
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS order_offers (
+            order_id TEXT NOT NULL,
+            rider_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'open',
+            offered_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL,
+            responded_at TEXT,
+            PRIMARY KEY (order_id, rider_id)
+        ) WITHOUT ROWID
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_order_offers_rider_status ON order_offers(rider_id, status)')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_order_offers_offered ON order_offers(offered_at)')
+
+def _migrate_id_worker_leases(cur: sqlite3.Cursor) -> None:
+    cur.execute('''
+        CREATE TABLE IF NOT EXISTS id_worker_leases (
+            worker_id INTEGER PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+    ''')
+
+# Ordered schema migrations; PRAGMA user_version records the last one applied.
+# Append new steps at the end and never renumber or edit applied ones.
+MIGRATIONS = (
+    (1, 'base schema', _migrate_base_schema),
+    (2, 'legacy order and rider columns', _migrate_legacy_columns),
+    (3, 'order status events and location points', _migrate_order_events),
+    (4, 'orders indexes', _migrate_order_indexes),
+    (5, 'distance-based delivery fees', _migrate_delivery_fees),
+    (6, 'chat unread counters', _migrate_chat_unread_counts),
+    (7, 'chat message keyset index', _migrate_chat_message_keyset_index),
+    (8, 'rating aggregates', _migrate_rating_aggregates),
+    (9, 'broadcast order offers', _migrate_order_offers),
+    (10, 'ID worker leases', _migrate_id_worker_leases),
+    # Re-runs the orders index step (IF NOT EXISTS) for indexes added to ORDER_INDEXES since 4
+    (11, 'rider order list index', _migrate_order_indexes),
+)
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_schema_version() -> int:
+    """Migration version recorded in the database file"""
+    return get_connection().execute('PRAGMA user_version').fetchone()[0]
+
+def init_db():
+    """Bring the database schema up to SCHEMA_VERSION, applying each pending migration once"""
+    # Fast path: a current schema costs one PRAGMA read
+    if get_schema_version() >= SCHEMA_VERSION:
+        return
     
-    # Add delivery_fee if it exists
+    for version, description, migrate in MIGRATIONS:
+        with transaction() as conn:
+            # Take the write lock before re-checking so concurrent workers apply each step once
+            if not conn.in_transaction:
+                conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= version:
+                continue
+            migrate(conn.cursor())
+            conn.execute(f'PRAGMA user_version = {version}')
+        print(f"✅ Applied schema migration {version}: {description}")
+
+def lease_id_worker(owner: str, worker_id: Optional[int] = None, seconds: float = ids.WORKER_LEASE_SECONDS) -> int:
+    """Renew owner's lease on worker_id, or lease the lowest free snowflake worker number.
+
+    Runs on its own connection so the lease commits even when the caller is
+    inside a transaction that later rolls back.
+    """
+    conn = sqlite3.connect(str(DB_PATH), timeout=5.0, isolation_level=None)
     try:
-        order_dict['delivery_fee'] = row['delivery_fee'] if row['delivery_fee'] is not None else 10.0
-    except (KeyError, IndexError):
-        order_dict['delivery_fee'] = 10.0
-    
-    return order_dict
+        conn.execute('BEGIN IMMEDIATE')
+        now = time.time()
+        if worker_id is not None:
+            renewed = conn.execute(
+                'UPDATE id_worker_leases SET expires_at=? WHERE worker_id=? AND owner=?',
+                (now + seconds, worker_id, owner)
+            ).rowcount
+            if renewed:
+                conn.execute('COMMIT')
+                return worker_id
+        taken = {row[0] for row in conn.execute(
+            'SELECT worker_id FROM id_worker_leases WHERE expires_at > ? AND owner != ?', (now, owner)
+        )}
+        free = next((w for w in range(ids.MAX_WORKER_ID + 1) if w not in taken), None)
+        if free is None:
+            raise RuntimeError(f"All {ids.MAX_WORKER_ID + 1} ID worker numbers are leased by running processes")
+        conn.execute('DELETE FROM id_worker_leases WHERE owner=?', (owner,))
+        conn.execute(
+            'INSERT OR REPLACE INTO id_worker_leases (worker_id, owner, expires_at) VALUES (?,?,?)',
+            (free, owner, now + seconds)
+        )
+        conn.execute('COMMIT')
+        _leased_owners.add(owner)
+        return free
+    except BaseException:
+        if conn.in_transaction:
+            conn.execute('ROLLBACK')
+        raise
+    finally:
+        conn.close()
 
-def create_order(order: Dict[str, Any]) -> Dict[str, Any]:
-    """Create or update an order in the database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    cur.execute('''INSERT OR REPLACE INTO orders
-        (id, items, total, customer_email, customer_name, customer_phone, customer_address, delivery_type, status, payment_status, payment_reference, created_at, updated_at, rider_id, tracking_info, customer_location, delivery_fee)
-        VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)
-    ''', (
-        order.get('id'),
+_leased_owners = set()
+
+def release_id_worker(owner: str) -> None:
+    """Give up owner's worker lease so the number is free at once"""
+    with transaction() as conn:
+        conn.execute('DELETE FROM id_worker_leases WHERE owner=?', (owner,))
+    _leased_owners.discard(owner)
+
+@atexit.register
+def _release_id_workers() -> None:
+    for owner in list(_leased_owners):
+        try:
+            release_id_worker(owner)
+        except sqlite3.Error:
+            pass
+
+ids.worker_lease = lease_id_worker
+
+def _backfill_order_events(cur: sqlite3.Cursor) -> None:
+    """Move legacy status_history / tracking_updates JSON into the event tables"""
+    cur.execute('''
+        SELECT id, rider_id, status_history, tracking_updates FROM orders
+        WHERE status_history IS NOT NULL OR tracking_updates IS NOT NULL
+    ''')
+    status_rows = []
+    location_rows = []
+    for row in cur.fetchall():
+        try:
+            history = json.loads(row['status_history']) if row['status_history'] else []
+        except (json.JSONDecodeError, TypeError):
+            history = []
+        try:
+            updates = json.loads(row['tracking_updates']) if row['tracking_updates'] else []
+        except (json.JSONDecodeError, TypeError):
+            updates = []
+        
+        for entry in history:
+            if isinstance(entry, dict) and entry.get('status'):
+                location = entry.get('location')
+                status_rows.append((
+                    row['id'], entry['status'], entry.get('note'),
+                    json.dumps(location) if location is not None else None,
+                    entry.get('timestamp') or ''
+                ))
+        for point in updates:
+            if isinstance(point, dict):
+                location_rows.append((
+                    row['id'], row['rider_id'], point.get('latitude'), point.get('longitude'),
+                    point.get('accuracy'), point.get('timestamp') or ''
+                ))
+    
+    cur.executemany(
+        'INSERT INTO order_status_events (order_id, status, note, location, created_at) VALUES (?,?,?,?,?)',
+        status_rows
+    )
+    cur.executemany(
+        '''INSERT INTO order_location_points (order_id, rider_id, latitude, longitude, accuracy, recorded_at)
+           VALUES (?,?,?,?,?,?)''',
+        location_rows
+    )
+    cur.execute('UPDATE orders SET status_history=NULL, tracking_updates=NULL')
+    if status_rows or location_rows:
+        print(f"✅ Moved {len(status_rows)} status events and {len(location_rows)} location points out of order JSON")
+
+def _json_or(default):
+    def decode(value):
+        return json.loads(value) if value else default
+    return decode
+
+def _decode_location(value):
+    if not value:
+        return None
+    return json.loads(value) if isinstance(value, str) else value
+
+def _decode_delivery_fee(value):
+    return value if value is not None else 10.0
+
+# Public order fields in output order: (key, decoder for the raw column value or None, value if the column is missing)
+ORDER_FIELDS = (
+    ('id', None, None),
+    ('items', _json_or([]), []),
+    ('total', None, None),
+    ('customer_email', None, None),
+    ('customer_name', None, None),
+    ('customer_phone', None, None),
+    ('customer_address', None, None),
+    ('delivery_type', None, None),
+    ('status', None, None),
+    ('payment_status', None, None),
+    ('payment_reference', None, None),
+    ('created_at', None, None),
+    ('updated_at', None, None),
+    ('rider_id', None, None),
+    ('tracking_info', _json_or(None), None),
+    ('estimated_delivery', None, None),
+    ('rating', None, None),
+    ('rating_comment', None, None),
+    ('rated_at', None, None),
+    ('customer_location', _decode_location, None),
+    ('delivery_fee', _decode_delivery_fee, 10.0),
+    ('assignment_expires_at', None, None),
+    ('assignment_attempts', None, 0),
+    ('assigned_riders', None, None),
+    ('distance_km', None, None),
+    ('estimated_time_minutes', None, None),
+)
+_ORDER_KEYS = tuple(field[0] for field in ORDER_FIELDS)
+
+# (pick the ORDER_FIELDS values out of a row, defaults appended for missing columns, decoders of lazy columns)
+OrderLayout = Tuple[Callable[[Sequence[Any]], Tuple[Any, ...]], Optional[Tuple[Any, ...]], Optional[Dict[str, Callable[[Any], Any]]]]
+
+# Column layouts are resolved once per distinct result shape
+_order_layouts: Dict[Tuple[str, ...], OrderLayout] = {}
+
+def _order_layout(columns: Tuple[str, ...]) -> OrderLayout:
+    layout = _order_layouts.get(columns)
+    if layout is None:
+        positions = {name: i for i, name in enumerate(columns)}
+        indexes = []
+        defaults = []
+        decoders = {}
+        for key, decoder, default in ORDER_FIELDS:
+            if key in positions:
+                indexes.append(positions[key])
+                if decoder is not None:
+                    decoders[key] = decoder
+            else:
+                # Missing columns read their default from past the end of the row
+                indexes.append(len(columns) + len(defaults))
+                defaults.append(default)
+        layout = (operator.itemgetter(*indexes), tuple(defaults) or None, decoders or None)
+        _order_layouts[columns] = layout
+    return layout
+
+class OrderRecord(dict):
+    """An orders row as a dict whose JSON columns are decoded on first access.
+
+    Plain columns are copied into the dict when the record is built. JSON
+    columns hold the raw column value until they are read: through [] or
+    get() one at a time, or all at once by anything that walks the values
+    (items(), values(), copy(), ==, json.dumps, jsonable_encoder,
+    msgpack). Decoded values replace the raw ones, so in-place edits (e.g.
+    items.append) stick. ``dict(record)`` gives a plain, fully decoded dict.
+    """
+
+    __slots__ = ('_pending',)
+
+    def __init__(self, row: Sequence[Any], layout: OrderLayout):
+        pick, defaults, decoders = layout
+        dict.__init__(self, zip(_ORDER_KEYS, pick(row if defaults is None else tuple(row) + defaults)))
+        # Lazy column -> decoder, shared with the layout until a column is decoded or replaced
+        self._pending: Optional[Dict[str, Callable[[Any], Any]]] = decoders
+
+    def _decode(self, key: str) -> None:
+        pending = self._pending
+        dict.__setitem__(self, key, pending[key](dict.__getitem__(self, key)))
+        self._forget(key)
+
+    def _forget(self, key: str) -> None:
+        pending = self._pending
+        if pending is not None and key in pending:
+            self._pending = {k: decoder for k, decoder in pending.items() if k != key} or None
+
+    def _decode_all(self) -> None:
+        while self._pending:
+            self._decode(next(iter(self._pending)))
+
+    def __getitem__(self, key: str) -> Any:
+        pending = self._pending
+        if pending is not None and key in pending:
+            self._decode(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key: str, default: Any = None) -> Any:
+        return self[key] if key in self else default
+
+    def __setitem__(self, key: str, value: Any) -> None:
+        self._forget(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key: str) -> None:
+        self._forget(key)
+        dict.__delitem__(self, key)
+
+    def __iter__(self) -> Iterator[str]:
+        # Overriding __iter__ makes dict(record), {**record} and dict.update(record)
+        # copy through keys() and __getitem__ instead of the raw storage
+        return dict.__iter__(self)
+
+    def pop(self, key: str, *default: Any) -> Any:
+        pending = self._pending
+        if pending is not None and key in pending:
+            self._decode(key)
+        return dict.pop(self, key, *default)
+
+    def setdefault(self, key: str, default: Any = None) -> Any:
+        if key in self:
+            return self[key]
+        dict.__setitem__(self, key, default)
+        return default
+
+    def popitem(self) -> Tuple[str, Any]:
+        self._decode_all()
+        return dict.popitem(self)
+
+    def clear(self) -> None:
+        self._pending = None
+        dict.clear(self)
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        self._decode_all()
+        dict.update(self, *args, **kwargs)
+
+    def __ior__(self, other: Any) -> 'OrderRecord':
+        self.update(other)
+        return self
+
+    def __or__(self, other: Any) -> Dict[str, Any]:
+        merged = self.copy()
+        merged.update(other)
+        return merged
+
+    def items(self):
+        self._decode_all()
+        return dict.items(self)
+
+    def values(self):
+        self._decode_all()
+        return dict.values(self)
+
+    def copy(self) -> Dict[str, Any]:
+        self._decode_all()
+        return dict(dict.items(self))
+
+    def __eq__(self, other: object) -> bool:
+        self._decode_all()
+        if isinstance(other, OrderRecord):
+            other._decode_all()
+        return dict.__eq__(self, other)
+
+    def __ne__(self, other: object) -> bool:
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # Pickles and deep-copies as a plain dict
+        return (dict, (self.copy(),))
+
+    def __repr__(self) -> str:
+        self._decode_all()
+        return f'OrderRecord({dict.__repr__(self)})'
+
+def _row_to_order(row: sqlite3.Row) -> OrderRecord:
+    """Wrap a SQLite orders row as an OrderRecord (history lives in the event tables, see _attach_order_events)"""
+    return OrderRecord(row, _order_layout(tuple(row.keys())))
+
+def _rows_to_orders(cur: sqlite3.Cursor) -> List[OrderRecord]:
+    """Wrap every remaining row of an orders query, resolving the column layout once"""
+    layout = _order_layout(tuple(d[0] for d in cur.description))
+    return [OrderRecord(row, layout) for row in cur.fetchall()]
+
+ORDER_COLUMNS_SQL = '''INTO orders
+    (id, items, total, customer_email, customer_name, customer_phone, customer_address, delivery_type, status, payment_status, payment_reference, created_at, updated_at, rider_id, tracking_info, customer_location, delivery_fee)
+    VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)'''
+# New orders never replace a row: an ID collision raises instead of overwriting another order
+ORDER_INSERT_SQL = 'INSERT ' + ORDER_COLUMNS_SQL
+# Re-importing legacy orders under their original IDs overwrites the earlier import
+ORDER_UPSERT_SQL = 'INSERT OR REPLACE ' + ORDER_COLUMNS_SQL
+# Orders per transaction for bulk loads, and ids per read-back query (under SQLite's variable limit)
+BULK_CHUNK_SIZE = 5000
+BULK_READ_CHUNK_SIZE = 500
+
+def _order_params(order: Dict[str, Any]) -> Tuple[Any, ...]:
+    return (
+        order.get('id') or ids.new_order_id(),
         json.dumps(order.get('items') or []),
         order.get('total'),
         order.get('customer_email'),
@@ -319,95 +949,353 @@ def create_order(order: Dict[str, Any]) -> Dict[str, Any]:
         json.dumps(order.get('tracking_info')) if order.get('tracking_info') is not None else None,
         order.get('customer_location'),
         order.get('delivery_fee', 10.0)
-    ))
-    conn.commit()
-    cur.execute('SELECT * FROM orders WHERE id=?', (order.get('id'),))
-    row = cur.fetchone()
-    conn.close()
+    )
+
+def create_order(order: Dict[str, Any]) -> Dict[str, Any]:
+    """Create an order in the database (an ID is generated if the order has none)"""
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute(ORDER_INSERT_SQL + ' RETURNING *', _order_params(order))
+        row = cur.fetchone()
     return _row_to_order(row)
 
+def create_orders(
+    orders: Iterable[Dict[str, Any]],
+    chunk_size: int = BULK_CHUNK_SIZE,
+    return_orders: bool = True,
+    replace: bool = False
+) -> Union[List[Dict[str, Any]], int]:
+    """Create many orders with executemany, one transaction per chunk.
+
+    ``orders`` may be any iterable (e.g. a generator over a CSV export); it is
+    consumed chunk by chunk so memory stays flat. Returns the stored orders in
+    input order, or only the number written when ``return_orders`` is False.
+    An order whose ID already exists raises sqlite3.IntegrityError unless
+    ``replace`` is set.
+    """
+    sql = ORDER_UPSERT_SQL if replace else ORDER_INSERT_SQL
+    written = 0
+    order_ids: List[Any] = []
+    iterator = iter(orders)
+    while True:
+        chunk = [_order_params(order) for order in itertools.islice(iterator, chunk_size)]
+        if not chunk:
+            break
+        with transaction() as conn:
+            conn.executemany(sql, chunk)
+        written += len(chunk)
+        if return_orders:
+            order_ids.extend(params[0] for params in chunk)
+    
+    if not return_orders:
+        return written
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    by_id: Dict[Any, Dict[str, Any]] = {}
+    for i in range(0, len(order_ids), BULK_READ_CHUNK_SIZE):
+        ids = order_ids[i:i + BULK_READ_CHUNK_SIZE]
+        cur.execute(f'SELECT * FROM orders WHERE id IN ({",".join("?" * len(ids))})', ids)
+        for order in _rows_to_orders(cur):
+            by_id[order['id']] = order
+    return [by_id[oid] for oid in order_ids if oid in by_id]
+
 def get_all_orders() -> List[Dict[str, Any]]:
     """Get all orders sorted by creation date (newest first)"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     cur.execute('SELECT * FROM orders ORDER BY created_at DESC')
-    rows = cur.fetchall()
-    conn.close()
-    return [_row_to_order(r) for r in rows]
+    return _rows_to_orders(cur)
 
 def get_orders_for_customer(email: str) -> List[Dict[str, Any]]:
     """Get all orders for a specific customer email"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     cur.execute('SELECT * FROM orders WHERE customer_email=? ORDER BY created_at DESC', (email,))
-    rows = cur.fetchall()
-    conn.close()
-    return [_row_to_order(r) for r in rows]
+    return _rows_to_orders(cur)
 
-def get_order_by_id(order_id: str) -> Optional[Dict[str, Any]]:
-    """Get a single order by ID"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+def get_order_by_id(order_id: str, include_events: bool = False) -> Optional[Dict[str, Any]]:
+    """Get a single order by ID, optionally with its status history and tracking updates"""
+    conn = get_connection()
     cur = conn.cursor()
     cur.execute('SELECT * FROM orders WHERE id=?', (order_id,))
     row = cur.fetchone()
-    conn.close()
-    return _row_to_order(row) if row else None
+    if not row:
+        return None
+    order = _row_to_order(row)
+    if include_events:
+        _attach_order_events(cur, order)
+    return order
+
+def _status_event_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    event = {
+        'status': row['status'],
+        'timestamp': row['created_at'],
+        'note': row['note']
+    }
+    if row['location']:
+        event['location'] = json.loads(row['location'])
+    return event
+
+def _location_point_to_dict(row: sqlite3.Row) -> Dict[str, Any]:
+    return {
+        'latitude': row['latitude'],
+        'longitude': row['longitude'],
+        'timestamp': row['recorded_at'],
+        'accuracy': row['accuracy']
+    }
+
+def _attach_order_events(cur: sqlite3.Cursor, order: Dict[str, Any], tracking_limit: int = 50) -> None:
+    cur.execute(
+        'SELECT status, note, location, created_at FROM order_status_events WHERE order_id=? ORDER BY id',
+        (order['id'],)
+    )
+    order['status_history'] = [_status_event_to_dict(r) for r in cur.fetchall()]
+    cur.execute('''
+        SELECT latitude, longitude, accuracy, recorded_at FROM order_location_points
+        WHERE order_id=? ORDER BY id DESC LIMIT ?
+    ''', (order['id'], tracking_limit))
+    order['tracking_updates'] = [_location_point_to_dict(r) for r in reversed(cur.fetchall())]
 
-def update_order_status(order_id: str, status: str, tracking_info: Optional[Dict] = None) -> Optional[Dict[str, Any]]:
-    """Update order status and optional tracking info"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+def get_order_status_history(order_id: str) -> List[Dict[str, Any]]:
+    """Status transitions for an order, oldest first"""
+    conn = get_connection()
     cur = conn.cursor()
-    updated_at = datetime.now(UTC).isoformat()
-    
-    # Get current order to build status history
-    cur.execute('SELECT status_history FROM orders WHERE id=?', (order_id,))
-    row = cur.fetchone()
-    
-    # Get existing status history or create new
-    status_history = []
-    if row and row['status_history']:
-        try:
-            status_history = json.loads(row['status_history'])
-        except:
-            status_history = []
-    
-    # Add new status to history
-    status_history.append({
-        "status": status,
-        "timestamp": updated_at,
-        "note": f"Status updated to {status}"
-    })
-    
-    # Update order with new status and history
-    tracking_json = json.dumps(tracking_info) if tracking_info else None
-    status_history_json = json.dumps(status_history)
-    
-    cur.execute('''UPDATE orders 
-                   SET status=?, updated_at=?, tracking_info=?, status_history=? 
-                   WHERE id=?''', 
-                (status, updated_at, tracking_json, status_history_json, order_id))
-    conn.commit()
-    cur.execute('SELECT * FROM orders WHERE id=?', (order_id,))
-    row = cur.fetchone()
-    conn.close()
+    cur.execute(
+        'SELECT status, note, location, created_at FROM order_status_events WHERE order_id=? ORDER BY id',
+        (order_id,)
+    )
+    return [_status_event_to_dict(r) for r in cur.fetchall()]
+
+def get_order_tracking_updates(order_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+    """Most recent rider location points for an order, oldest first"""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT latitude, longitude, accuracy, recorded_at FROM order_location_points
+        WHERE order_id=? ORDER BY id DESC LIMIT ?
+    ''', (order_id, limit))
+    return [_location_point_to_dict(r) for r in reversed(cur.fetchall())]
+
+def _record_status_event(cur: sqlite3.Cursor, order_id: str, status: str, created_at: str,
+                         note: Optional[str] = None, location: Optional[Dict[str, Any]] = None) -> None:
+    cur.execute(
+        'INSERT INTO order_status_events (order_id, status, note, location, created_at) VALUES (?,?,?,?,?)',
+        (order_id, status, note, json.dumps(location) if location is not None else None, created_at)
+    )
+
+# Columns that query_orders() may sort and paginate on
+ORDER_SORT_COLUMNS = ('created_at', 'updated_at')
+ORDER_GROUP_COLUMNS = ('status', 'rider_id', 'customer_email')
+
+def _order_filters(
+    rider_id: Optional[int] = None,
+    status: Union[str, Iterable[str], None] = None,
+    customer_email: Optional[str] = None,
+    created_after: Optional[str] = None,
+    created_before: Optional[str] = None,
+    unassigned: bool = False
+) -> Tuple[str, List[Any]]:
+    """Build a WHERE clause and parameters for the order filters"""
+    clauses = []
+    params: List[Any] = []
+    
+    if rider_id is not None:
+        clauses.append('rider_id=?')
+        params.append(rider_id)
+    if unassigned:
+        clauses.append('rider_id IS NULL')
+    if status is not None:
+        statuses = [status] if isinstance(status, str) else list(status)
+        clauses.append(f'status IN ({",".join("?" * len(statuses))})')
+        params.extend(statuses)
+    if customer_email is not None:
+        clauses.append('customer_email=?')
+        params.append(customer_email)
+    if created_after is not None:
+        clauses.append('created_at>=?')
+        params.append(created_after)
+    if created_before is not None:
+        clauses.append('created_at<?')
+        params.append(created_before)
+    
+    where = f'WHERE {" AND ".join(clauses)}' if clauses else ''
+    return where, params
+
+def query_orders(
+    rider_id: Optional[int] = None,
+    status: Union[str, Iterable[str], None] = None,
+    customer_email: Optional[str] = None,
+    created_after: Optional[str] = None,
+    created_before: Optional[str] = None,
+    unassigned: bool = False,
+    sort: str = 'created_at',
+    descending: bool = True,
+    limit: Optional[int] = None,
+    cursor: Optional[Tuple[str, str]] = None
+) -> List[Dict[str, Any]]:
+    """Get orders matching the given filters, filtered and sorted in SQL.
+
+    created_after is inclusive and created_before exclusive (ISO timestamps).
+    Pagination is keyset based: pass the (sort value, id) of the last order of
+    the previous page as `cursor` (see order_cursor()) to get the next page.
+    """
+    if sort not in ORDER_SORT_COLUMNS:
+        raise ValueError(f"Cannot sort orders by {sort!r}")
+    
+    where, params = _order_filters(rider_id, status, customer_email, created_after, created_before, unassigned)
+    direction = 'DESC' if descending else 'ASC'
+    
+    if cursor is not None:
+        comparison = '<' if descending else '>'
+        where = f'{where} AND' if where else 'WHERE'
+        where = f'{where} ({sort}, id) {comparison} (?, ?)'
+        params.extend(cursor)
+    
+    query = f'SELECT * FROM orders {where} ORDER BY {sort} {direction}, id {direction}'
+    if limit is not None:
+        query += ' LIMIT ?'
+        params.append(limit)
+    
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(query, params)
+    return _rows_to_orders(cur)
+
+def order_cursor(order: Dict[str, Any], sort: str = 'created_at') -> Tuple[str, str]:
+    """Keyset cursor pointing just past the given order"""
+    return (order.get(sort), order['id'])
+
+def count_orders(**filters) -> int:
+    """Count orders matching the query_orders() filters"""
+    where, params = _order_filters(**filters)
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(f'SELECT COUNT(*) FROM orders {where}', params)
+    return cur.fetchone()[0]
+
+def summarize_orders(group_by: str = 'status', **filters) -> Dict[Any, Dict[str, float]]:
+    """Aggregate orders matching the filters, grouped by status, rider_id or customer_email.
+
+    Returns {group value: {'count', 'total', 'delivery_fees'}} where total and
+    delivery_fees are sums (missing delivery fees count as the 10.0 default).
+    """
+    if group_by not in ORDER_GROUP_COLUMNS:
+        raise ValueError(f"Cannot group orders by {group_by!r}")
+    
+    where, params = _order_filters(**filters)
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute(f'''
+        SELECT {group_by} AS grp,
+               COUNT(*) AS count,
+               COALESCE(SUM(total), 0) AS total,
+               COALESCE(SUM(COALESCE(delivery_fee, 10.0)), 0) AS delivery_fees
+        FROM orders {where}
+        GROUP BY {group_by}
+    ''', params)
+    return {
+        row['grp']: {
+            'count': row['count'],
+            'total': row['total'],
+            'delivery_fees': row['delivery_fees']
+        }
+        for row in cur.fetchall()
+    }
+
+def update_order_status(
+    order_id: str,
+    status: str,
+    tracking_info: Optional[Dict] = None,
+    note: Optional[str] = None,
+    location: Optional[Dict[str, Any]] = None
+) -> Optional[Dict[str, Any]]:
+    """Update order status and optional tracking info, recording a status event"""
+    with transaction() as conn:
+        cur = conn.cursor()
+        updated_at = datetime.now(UTC).isoformat()
+        tracking_json = json.dumps(tracking_info) if tracking_info else None
+    
+        cur.execute('UPDATE orders SET status=?, updated_at=?, tracking_info=? WHERE id=? RETURNING *',
+                    (status, updated_at, tracking_json, order_id))
+        row = cur.fetchone()
+        if row:
+            _record_status_event(cur, order_id, status, updated_at,
+                                 note or f"Status updated to {status}", location)
     return _row_to_order(row) if row else None
 
 def delete_order(order_id: str) -> None:
     """Delete an order by ID"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute('DELETE FROM orders WHERE id=?', (order_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute('DELETE FROM orders WHERE id=?', (order_id,))
+        cur.execute('DELETE FROM order_status_events WHERE order_id=?', (order_id,))
+        cur.execute('DELETE FROM order_location_points WHERE order_id=?', (order_id,))
+
+def update_order_customer_location(order_id: str, customer_location: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Update an order's delivery location"""
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            'UPDATE orders SET customer_location=?, updated_at=? WHERE id=? RETURNING *',
+            (json.dumps(customer_location), datetime.now(UTC).isoformat(), order_id)
+        )
+        row = cur.fetchone()
+    return _row_to_order(row) if row else None
+
+def claim_order_offer(order_id: str, rider_id: int, tracking_info: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], List[int]]:
+    """Atomically give a pending, unassigned order to the first rider who accepts it.
+
+    The UPDATE only matches while the order is still unclaimed, so when
+    several riders accept a broadcast offer at once exactly one gets the
+    order back; the others get None. Open offers are closed in the same
+    transaction. Returns (order, riders whose offers were taken by the winner).
+    """
+    with transaction() as conn:
+        cur = conn.cursor()
+        updated_at = datetime.now(UTC).isoformat()
+        cur.execute('''
+            UPDATE orders
+            SET status='assigned', updated_at=?, tracking_info=?, rider_id=?, assignment_expires_at=NULL
+            WHERE id=? AND status='pending' AND rider_id IS NULL
+            RETURNING *
+        ''', (updated_at, json.dumps(tracking_info), rider_id, order_id))
+        row = cur.fetchone()
+        if not row:
+            return None, []
+        
+        _record_status_event(cur, order_id, 'assigned', updated_at, 'Order accepted by rider')
+        cur.execute('''
+            UPDATE order_offers
+            SET status=CASE WHEN rider_id=? THEN 'accepted' ELSE 'taken' END, responded_at=?
+            WHERE order_id=? AND status='open'
+            RETURNING rider_id, status
+        ''', (rider_id, updated_at, order_id))
+        outbid = [r['rider_id'] for r in cur.fetchall() if r['status'] == 'taken']
+    return _row_to_order(row), outbid
+
+def assign_pending_order(order_id: str, rider_id: int, tracking_info: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Assign a pending order to the rider who accepted it; None if another rider got there first"""
+    return claim_order_offer(order_id, rider_id, tracking_info)[0]
+
+def rate_order(order_id: str, rating: int, comment: str, rated_at: str) -> None:
+    """Store a customer's rating on an order.
+
+    riders.rating is kept by the rating aggregates (create_rating /
+    update_rating) alone, so this does not touch the rider.
+    """
+    with transaction() as conn:
+        conn.execute('''
+            UPDATE orders 
+            SET rating = ?, rating_comment = ?, rated_at = ?
+            WHERE id = ?
+        ''', (rating, comment, rated_at, order_id))
 
 def migrate_orders(orders: List[Dict[str, Any]]) -> int:
-    """Migrate in-memory orders list into SQLite DB. Returns next order_counter value."""
+    """Migrate in-memory orders list into SQLite DB. Returns one past the highest legacy ORD-<n> number."""
     init_db()
     max_idx = 0
+    to_insert = []
     for o in list(reversed(orders)):
         oid = o.get('id')
         if not oid:
@@ -419,11 +1307,61 @@ def migrate_orders(orders: List[Dict[str, Any]]) -> int:
                 max_idx = num
         except Exception:
             pass
-        # Insert into DB
-        create_order(o)
+        to_insert.append(o)
     
+    # Insert into DB
+    create_orders(to_insert, return_orders=False, replace=True)
     return max_idx + 1
 
+def _float_or_nan(value: Any) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+def recompute_delivery_fees() -> int:
+    """Re-price every located order with the current fee rules in geo.py, returns how many fees changed
+
+    Coordinates come out of the JSON in SQL, fees for every order are computed
+    in one vectorized pass and only changed fees are written back, in rowid
+    order so the UPDATEs walk the table instead of the id index. Orders whose
+    lat/lng is missing or not a number are left alone.
+    Run it with ``python update_delivery_fees.py`` or POST
+    /api/admin/delivery-fees/recompute.
+    """
+    # NumPy only for this maintenance pass; importing db must not need it
+    import numpy as np
+    import geo
+    
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.row_factory = None  # plain tuples: much cheaper than sqlite3.Row for a full-table read
+        cur.execute('''
+            SELECT rowid, total, delivery_fee,
+                   COALESCE(json_extract(customer_location, '$.lat'), json_extract(customer_location, '$.latitude')),
+                   COALESCE(json_extract(customer_location, '$.lng'), json_extract(customer_location, '$.longitude'))
+            FROM orders
+            WHERE customer_location IS NOT NULL AND json_valid(customer_location)
+            ORDER BY rowid
+        ''')
+        fetched = cur.fetchall()
+        try:
+            rows = np.array(fetched, dtype=float).reshape(-1, 5)  # NULL -> nan
+        except (TypeError, ValueError):
+            # Some location holds a non-numeric lat/lng (e.g. "unknown"): convert row by row
+            rows = np.array([[_float_or_nan(v) for v in row] for row in fetched], dtype=float).reshape(-1, 5)
+        rows = rows[np.isfinite(rows[:, 3]) & np.isfinite(rows[:, 4])]
+        if not len(rows):
+            return 0
+        
+        fees = geo.quote_delivery_fees(rows[:, 3], rows[:, 4], np.nan_to_num(rows[:, 1]))['delivery_fee']
+        changed = fees != rows[:, 2]
+        cur.executemany(
+            'UPDATE orders SET delivery_fee=? WHERE rowid=?',
+            zip(fees[changed].tolist(), rows[changed, 0].astype(np.int64).tolist())
+        )
+        return int(changed.sum())
+
 # ============================================================================
 # CHAT DATABASE FUNCTIONS
 # ============================================================================
@@ -431,8 +1369,7 @@ def migrate_orders(orders: List[Dict[str, Any]]) -> int:
 def create_or_get_chat_room(order_id: int, customer_id: int, customer_name: str, 
                             rider_id: Optional[int] = None, rider_name: Optional[str] = None) -> Dict[str, Any]:
     """Create or get existing chat room for an order"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     
     # Check if chat room exists for this order
@@ -446,28 +1383,19 @@ def create_or_get_chat_room(order_id: int, customer_id: int, customer_name: str,
         room_id = room['id']
     else:
         # Create new room
-        room_id = f"room_ORD-{order_id}"
-        cur.execute('''
-            INSERT INTO chat_rooms (id, order_id, status, created_at, updated_at)
-            VALUES (?, ?, 'active', ?, ?)
-        ''', (room_id, order_id, now, now))
-        
-        # Add customer as participant
-        cur.execute('''
-            INSERT OR IGNORE INTO chat_participants 
-            (chat_room_id, user_id, user_type, user_name, joined_at)
-            VALUES (?, ?, 'customer', ?, ?)
-        ''', (room_id, customer_id, customer_name, now))
-        
-        # Add rider as participant if provided
-        if rider_id and rider_name:
+        with transaction():
+            room_id = f"room_ORD-{order_id}"
             cur.execute('''
-                INSERT OR IGNORE INTO chat_participants 
-                (chat_room_id, user_id, user_type, user_name, joined_at)
-                VALUES (?, ?, 'rider', ?, ?)
-            ''', (room_id, rider_id, rider_name, now))
+                INSERT INTO chat_rooms (id, order_id, status, created_at, updated_at)
+                VALUES (?, ?, 'active', ?, ?)
+            ''', (room_id, order_id, now, now))
+        
+            # Add customer as participant
+            _add_chat_participant(cur, room_id, customer_id, 'customer', customer_name, now)
         
-        conn.commit()
+            # Add rider as participant if provided
+            if rider_id and rider_name:
+                _add_chat_participant(cur, room_id, rider_id, 'rider', rider_name, now)
     
     # Get complete room data with participants
     cur.execute('SELECT * FROM chat_rooms WHERE id=?', (room_id,))
@@ -478,10 +1406,22 @@ def create_or_get_chat_room(order_id: int, customer_id: int, customer_name: str,
     participants = cur.fetchall()
     
     # Get unread count (placeholder - would need user context)
-    unread_count = 0
-    
-    conn.close()
-    
+    return _chat_room_to_dict(room, participants, 0)
+
+def _add_chat_participant(cur: sqlite3.Cursor, room_id: str, user_id: int, user_type: str,
+                          user_name: str, joined_at: str) -> None:
+    cur.execute('''
+        INSERT OR IGNORE INTO chat_participants 
+        (chat_room_id, user_id, user_type, user_name, joined_at)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (room_id, user_id, user_type, user_name, joined_at))
+    cur.execute('''
+        INSERT OR IGNORE INTO chat_unread_counts (chat_room_id, user_id, user_type, unread_count)
+        VALUES (?, ?, ?, 0)
+    ''', (room_id, user_id, user_type))
+
+def _chat_room_to_dict(room: sqlite3.Row, participants: List[Any], unread_count: int) -> Dict[str, Any]:
+    """Build the chat room payload shared by the room and inbox endpoints"""
     result = {
         'id': room['id'],
         'order_id': room['order_id'],
@@ -501,108 +1441,148 @@ def create_or_get_chat_room(order_id: int, customer_id: int, customer_name: str,
             } for p in participants
         ]
     }
-    
-    # Add customer/rider specific fields for backwards compatibility
-    for p in participants:
-        if p['user_type'] == 'customer':
-            result['customer_id'] = p['user_id']
-            result['customer_name'] = p['user_name']
-            result['customer_avatar'] = p['user_avatar']
-        elif p['user_type'] == 'rider':
-            result['rider_id'] = p['user_id']
-            result['rider_name'] = p['user_name']
-            result['rider_avatar'] = p['user_avatar']
-    
-    return result
+    
+    # Add customer/rider specific fields for backwards compatibility
+    for p in participants:
+        if p['user_type'] == 'customer':
+            result['customer_id'] = p['user_id']
+            result['customer_name'] = p['user_name']
+            result['customer_avatar'] = p['user_avatar']
+        elif p['user_type'] == 'rider':
+            result['rider_id'] = p['user_id']
+            result['rider_name'] = p['user_name']
+            result['rider_avatar'] = p['user_avatar']
+    
+    return result
+
+def _row_to_message(row: sqlite3.Row) -> Dict[str, Any]:
+    # Safely parse location_data JSON
+    location = None
+    if row['location_data']:
+        try:
+            location = json.loads(row['location_data'])
+        except (json.JSONDecodeError, TypeError):
+            location = None
+    
+    return {
+        'id': row['id'],
+        'chat_room_id': row['chat_room_id'],
+        'sender_id': row['sender_id'],
+        'sender_type': row['sender_type'],
+        'sender_name': row['sender_name'],
+        'message': row['message'],
+        'message_type': row['message_type'],
+        'image_url': row['image_url'],
+        'location_data': location,
+        'is_read': bool(row['is_read']),
+        'is_delivered': bool(row['is_delivered']),
+        'created_at': row['created_at'],
+        'read_at': row['read_at']
+    }
+
+def get_chat_messages(
+    chat_room_id: str,
+    limit: int = 50,
+    offset: int = 0,
+    latest: bool = False,
+    before: Optional[Tuple[str, str]] = None,
+    after: Optional[Tuple[str, str]] = None
+) -> List[Dict[str, Any]]:
+    """Get messages for a chat room, oldest first.
 
-def get_chat_messages(chat_room_id: str, limit: int = 50, offset: int = 0) -> List[Dict[str, Any]]:
-    """Get messages for a chat room with pagination"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    Keyset modes walk idx_chat_messages_room_created, so their cost does not
+    grow with the conversation:
+    - latest: the newest ``limit`` messages
+    - before: the ``limit`` messages just older than a (created_at, id) cursor
+    - after: the first ``limit`` messages newer than a cursor
+    Without any of them the legacy LIMIT/OFFSET page from the start is returned.
+    """
+    conn = get_connection()
     cur = conn.cursor()
     
-    cur.execute('''
-        SELECT * FROM chat_messages 
-        WHERE chat_room_id=? 
-        ORDER BY created_at ASC 
-        LIMIT ? OFFSET ?
-    ''', (chat_room_id, limit, offset))
-    
-    rows = cur.fetchall()
-    conn.close()
+    if after is not None:
+        cur.execute('''
+            SELECT * FROM chat_messages 
+            WHERE chat_room_id=? AND (created_at, id) > (?, ?)
+            ORDER BY created_at ASC, id ASC 
+            LIMIT ?
+        ''', (chat_room_id, after[0], after[1], limit))
+    elif latest or before is not None:
+        keyset = 'AND (created_at, id) < (?, ?)' if before is not None else ''
+        params = (chat_room_id,) + (tuple(before) if before is not None else ()) + (limit,)
+        # Take the page newest-first from the index, then flip it to chronological order
+        cur.execute(f'''
+            SELECT * FROM (
+                SELECT * FROM chat_messages 
+                WHERE chat_room_id=? {keyset}
+                ORDER BY created_at DESC, id DESC 
+                LIMIT ?
+            ) ORDER BY created_at ASC, id ASC
+        ''', params)
+    else:
+        cur.execute('''
+            SELECT * FROM chat_messages 
+            WHERE chat_room_id=? 
+            ORDER BY created_at ASC, id ASC 
+            LIMIT ? OFFSET ?
+        ''', (chat_room_id, limit, offset))
     
     messages = []
-    for row in rows:
+    for row in cur.fetchall():
         try:
-            # Safely parse location_data JSON
-            location = None
-            if row['location_data']:
-                try:
-                    location = json.loads(row['location_data'])
-                except (json.JSONDecodeError, TypeError):
-                    location = None
-            
-            messages.append({
-                'id': row['id'],
-                'chat_room_id': row['chat_room_id'],
-                'sender_id': row['sender_id'],
-                'sender_type': row['sender_type'],
-                'sender_name': row['sender_name'],
-                'message': row['message'],
-                'message_type': row['message_type'],
-                'image_url': row['image_url'],
-                'location_data': location,
-                'is_read': bool(row['is_read']),
-                'is_delivered': bool(row['is_delivered']),
-                'created_at': row['created_at'],
-                'read_at': row['read_at']
-            })
+            messages.append(_row_to_message(row))
         except Exception as e:
-            print(f"Error parsing message {row.get('id', 'unknown')}: {e}")
+            print(f"Error parsing message {row['id']}: {e}")
             continue
     
     return messages
 
+def message_cursor(message: Dict[str, Any]) -> Tuple[str, str]:
+    """Keyset position of a message, for the before/after modes of get_chat_messages"""
+    return (message['created_at'], message['id'])
+
 def create_chat_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
     """Create a new chat message"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+    with transaction() as conn:
+        cur = conn.cursor()
     
-    now = datetime.now(UTC).isoformat()
-    message_id = f"msg_{int(datetime.now(UTC).timestamp() * 1000)}"
+        now = datetime.now(UTC).isoformat()
+        message_id = ids.new_message_id()
     
-    cur.execute('''
-        INSERT INTO chat_messages 
-        (id, chat_room_id, sender_id, sender_type, sender_name, message, 
-         message_type, image_url, location_data, is_delivered, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?)
-    ''', (
-        message_id,
-        message_data['chat_room_id'],
-        message_data['sender_id'],
-        message_data['sender_type'],
-        message_data['sender_name'],
-        message_data.get('message', ''),
-        message_data.get('message_type', 'text'),
-        message_data.get('image_url'),
-        json.dumps(message_data.get('location')) if message_data.get('location') else None,
-        now
-    ))
-    
-    # Update chat room's last message
-    cur.execute('''
-        UPDATE chat_rooms 
-        SET last_message=?, last_message_time=?, updated_at=?
-        WHERE id=?
-    ''', (message_data.get('message', ''), now, now, message_data['chat_room_id']))
+        cur.execute('''
+            INSERT INTO chat_messages 
+            (id, chat_room_id, sender_id, sender_type, sender_name, message, 
+             message_type, image_url, location_data, is_delivered, created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?)
+            RETURNING *
+        ''', (
+            message_id,
+            message_data['chat_room_id'],
+            message_data['sender_id'],
+            message_data['sender_type'],
+            message_data['sender_name'],
+            message_data.get('message', ''),
+            message_data.get('message_type', 'text'),
+            message_data.get('image_url'),
+            json.dumps(message_data.get('location')) if message_data.get('location') else None,
+            now
+        ))
+        row = cur.fetchone()
     
-    conn.commit()
+        # Update chat room's last message
+        cur.execute('''
+            UPDATE chat_rooms 
+            SET last_message=?, last_message_time=?, updated_at=?
+            WHERE id=?
+        ''', (message_data.get('message', ''), now, now, message_data['chat_room_id']))
     
-    # Fetch the created message
-    cur.execute('SELECT * FROM chat_messages WHERE id=?', (message_id,))
-    row = cur.fetchone()
-    conn.close()
+        # Bump the unread counter of every other participant
+        cur.execute('''
+            INSERT INTO chat_unread_counts (chat_room_id, user_id, user_type, unread_count)
+            SELECT chat_room_id, user_id, user_type, 1 FROM chat_participants
+            WHERE chat_room_id=? AND NOT (user_id=? AND user_type=?)
+            ON CONFLICT (chat_room_id, user_id, user_type) DO UPDATE SET unread_count = unread_count + 1
+        ''', (message_data['chat_room_id'], message_data['sender_id'], message_data['sender_type']))
     
     return {
         'id': row['id'],
@@ -622,135 +1602,124 @@ def create_chat_message(message_data: Dict[str, Any]) -> Dict[str, Any]:
 
 def mark_messages_as_read(chat_room_id: str, message_ids: List[str]) -> None:
     """Mark multiple messages as read"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    now = datetime.now(UTC).isoformat()
-    
-    placeholders = ','.join('?' * len(message_ids))
-    cur.execute(f'''
-        UPDATE chat_messages 
-        SET is_read=1, read_at=?
-        WHERE chat_room_id=? AND id IN ({placeholders})
-    ''', [now, chat_room_id] + message_ids)
-    
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cur = conn.cursor()
+        now = datetime.now(UTC).isoformat()
+    
+        placeholders = ','.join('?' * len(message_ids))
+        cur.execute(f'''
+            UPDATE chat_messages 
+            SET is_read=1, read_at=?
+            WHERE chat_room_id=? AND is_read=0 AND id IN ({placeholders})
+            RETURNING sender_id, sender_type
+        ''', [now, chat_room_id] + message_ids)
+        senders = [(r['sender_id'], r['sender_type']) for r in cur.fetchall()]
+        if not senders:
+            return
+        
+        # Each participant's counter drops by the newly read messages they didn't send
+        cur.execute('SELECT user_id, user_type FROM chat_unread_counts WHERE chat_room_id=?', (chat_room_id,))
+        decrements = []
+        for participant in cur.fetchall():
+            key = (participant['user_id'], participant['user_type'])
+            read = sum(1 for sender in senders if sender != key)
+            if read:
+                decrements.append((read, chat_room_id, key[0], key[1]))
+        cur.executemany('''
+            UPDATE chat_unread_counts SET unread_count = MAX(unread_count - ?, 0)
+            WHERE chat_room_id=? AND user_id=? AND user_type=?
+        ''', decrements)
 
 def get_user_chat_rooms(user_id: int, user_type: str) -> List[Dict[str, Any]]:
-    """Get all chat rooms for a user"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    """Get all chat rooms for a user with unread counts, in a single query"""
+    conn = get_connection()
     cur = conn.cursor()
     
-    # Get all rooms where user is a participant
+    # One row per (room, participant); unread comes from the maintained counter
     cur.execute('''
-        SELECT DISTINCT cr.* 
-        FROM chat_rooms cr
-        JOIN chat_participants cp ON cr.id = cp.chat_room_id
-        WHERE cp.user_id=? AND cp.user_type=?
-        ORDER BY cr.updated_at DESC
+        SELECT cr.*,
+               COALESCE(uc.unread_count, 0) AS unread_count,
+               p.user_id AS p_user_id, p.user_type AS p_user_type,
+               p.user_name AS p_user_name, p.user_avatar AS p_user_avatar
+        FROM chat_participants me
+        JOIN chat_rooms cr ON cr.id = me.chat_room_id
+        JOIN chat_participants p ON p.chat_room_id = cr.id
+        LEFT JOIN chat_unread_counts uc
+            ON uc.chat_room_id = me.chat_room_id AND uc.user_id = me.user_id AND uc.user_type = me.user_type
+        WHERE me.user_id=? AND me.user_type=?
+        ORDER BY cr.updated_at DESC, cr.id, p.id
     ''', (user_id, user_type))
     
-    rooms = cur.fetchall()
     result = []
+    room = None
+    participants: List[Dict[str, Any]] = []
+    for row in cur.fetchall():
+        if room is None or row['id'] != room['id']:
+            if room is not None:
+                result.append(_chat_room_to_dict(room, participants, room['unread_count']))
+            room = row
+            participants = []
+        participants.append({
+            'user_id': row['p_user_id'],
+            'user_type': row['p_user_type'],
+            'user_name': row['p_user_name'],
+            'user_avatar': row['p_user_avatar']
+        })
+    if room is not None:
+        result.append(_chat_room_to_dict(room, participants, room['unread_count']))
     
-    for room in rooms:
-        # Get participants for this room
-        cur.execute('SELECT * FROM chat_participants WHERE chat_room_id=?', (room['id'],))
-        participants = cur.fetchall()
-        
-        # Count unread messages for this user
-        cur.execute('''
-            SELECT COUNT(*) as unread_count 
-            FROM chat_messages 
-            WHERE chat_room_id=? AND is_read=0 
-            AND NOT (sender_id=? AND sender_type=?)
-        ''', (room['id'], user_id, user_type))
-        unread_row = cur.fetchone()
-        unread_count = unread_row['unread_count'] if unread_row else 0
-        
-        room_data = {
-            'id': room['id'],
-            'order_id': room['order_id'],
-            'status': room['status'],
-            'created_at': room['created_at'],
-            'updated_at': room['updated_at'],
-            'last_message': room['last_message'],
-            'last_message_time': room['last_message_time'],
-            'unread_count': unread_count,
-            'participants': [
-                {
-                    'id': p['user_id'],
-                    'name': p['user_name'],
-                    'user_type': p['user_type'],
-                    'avatar': p['user_avatar'],
-                    'is_online': False
-                } for p in participants
-            ]
-        }
-        
-        # Add customer/rider fields
-        for p in participants:
-            if p['user_type'] == 'customer':
-                room_data['customer_id'] = p['user_id']
-                room_data['customer_name'] = p['user_name']
-                room_data['customer_avatar'] = p['user_avatar']
-            elif p['user_type'] == 'rider':
-                room_data['rider_id'] = p['user_id']
-                room_data['rider_name'] = p['user_name']
-                room_data['rider_avatar'] = p['user_avatar']
-        
-        result.append(room_data)
-    
-    conn.close()
     return result
 
 def close_chat_room(chat_room_id: str) -> None:
     """Close a chat room"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    now = datetime.now(UTC).isoformat()
+    with transaction() as conn:
+        cur = conn.cursor()
+        now = datetime.now(UTC).isoformat()
     
+        cur.execute('''
+            UPDATE chat_rooms 
+            SET status='closed', updated_at=?
+            WHERE id=?
+        ''', (now, chat_room_id))
+
+def is_chat_participant(chat_room_id: str, user_id: int, user_type: str) -> bool:
+    """Whether a user belongs to a chat room"""
+    conn = get_connection()
+    cur = conn.cursor()
     cur.execute('''
-        UPDATE chat_rooms 
-        SET status='closed', updated_at=?
-        WHERE id=?
-    ''', (now, chat_room_id))
-    
-    conn.commit()
-    conn.close()
+        SELECT 1 FROM chat_participants
+        WHERE chat_room_id=? AND user_id=? AND user_type=?
+    ''', (chat_room_id, user_id, user_type))
+    return cur.fetchone() is not None
 
 # ==================== USER FUNCTIONS ====================
 
 def create_user(user_data: Dict[str, Any]) -> Dict[str, Any]:
     """Create a new user in the database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    now = datetime.now(UTC).isoformat()
+    with transaction() as conn:
+        cur = conn.cursor()
+        now = datetime.now(UTC).isoformat()
     
-    cur.execute('''
-        INSERT INTO users (username, email, password, phone, role, address, is_active, created_at, updated_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        user_data.get('username'),
-        user_data.get('email'),
-        user_data.get('password'),
-        user_data.get('phone'),
-        user_data.get('role', 'user'),
-        user_data.get('address'),
-        user_data.get('is_active', 1),
-        user_data.get('created_at', now),
-        user_data.get('updated_at', now)
-    ))
-    
-    user_id = cur.lastrowid
-    conn.commit()
+        cur.execute('''
+            INSERT INTO users (username, email, password, phone, role, address, is_active, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            user_data.get('username'),
+            user_data.get('email'),
+            user_data.get('password'),
+            user_data.get('phone'),
+            user_data.get('role', 'user'),
+            user_data.get('address'),
+            user_data.get('is_active', 1),
+            user_data.get('created_at', now),
+            user_data.get('updated_at', now)
+        ))
+    
+        user_id = cur.lastrowid
     
     # Fetch and return the created user
     cur.execute('SELECT * FROM users WHERE id=?', (user_id,))
     row = cur.fetchone()
-    conn.close()
     
     return {
         'id': row['id'],
@@ -767,13 +1736,11 @@ def create_user(user_data: Dict[str, Any]) -> Dict[str, Any]:
 
 def get_user_by_email(email: str) -> Optional[Dict[str, Any]]:
     """Get user by email"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     
     cur.execute('SELECT * FROM users WHERE email=?', (email,))
     row = cur.fetchone()
-    conn.close()
     
     if not row:
         return None
@@ -793,13 +1760,11 @@ def get_user_by_email(email: str) -> Optional[Dict[str, Any]]:
 
 def get_user_by_id(user_id: int) -> Optional[Dict[str, Any]]:
     """Get user by ID"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     
     cur.execute('SELECT * FROM users WHERE id=?', (user_id,))
     row = cur.fetchone()
-    conn.close()
     
     if not row:
         return None
@@ -819,13 +1784,11 @@ def get_user_by_id(user_id: int) -> Optional[Dict[str, Any]]:
 
 def get_all_users() -> List[Dict[str, Any]]:
     """Get all users"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     
     cur.execute('SELECT * FROM users ORDER BY created_at DESC')
     rows = cur.fetchall()
-    conn.close()
     
     return [
         {
@@ -845,44 +1808,39 @@ def get_all_users() -> List[Dict[str, Any]]:
 
 def update_user(user_id: int, update_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     """Update user data"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    now = datetime.now(UTC).isoformat()
+    with transaction() as conn:
+        cur = conn.cursor()
+        now = datetime.now(UTC).isoformat()
     
-    # Build dynamic UPDATE query
-    fields = []
-    values = []
+        # Build dynamic UPDATE query
+        fields = []
+        values = []
     
-    for key in ['username', 'phone', 'address', 'is_active']:
-        if key in update_data:
-            fields.append(f'{key}=?')
-            values.append(update_data[key])
+        for key in ['username', 'phone', 'address', 'is_active']:
+            if key in update_data:
+                fields.append(f'{key}=?')
+                values.append(update_data[key])
     
-    if not fields:
-        return get_user_by_id(user_id)
+        if not fields:
+            return get_user_by_id(user_id)
     
-    fields.append('updated_at=?')
-    values.append(now)
-    values.append(user_id)
+        fields.append('updated_at=?')
+        values.append(now)
+        values.append(user_id)
     
-    query = f'UPDATE users SET {", ".join(fields)} WHERE id=?'
-    cur.execute(query, values)
-    conn.commit()
-    conn.close()
+        query = f'UPDATE users SET {", ".join(fields)} WHERE id=?'
+        cur.execute(query, values)
     
     return get_user_by_id(user_id)
 
 def delete_user(user_id: int) -> bool:
     """Delete user (soft delete by setting is_active=0)"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    now = datetime.now(UTC).isoformat()
+    with transaction() as conn:
+        cur = conn.cursor()
+        now = datetime.now(UTC).isoformat()
     
-    cur.execute('UPDATE users SET is_active=0, updated_at=? WHERE id=?', (now, user_id))
-    conn.commit()
+        cur.execute('UPDATE users SET is_active=0, updated_at=? WHERE id=?', (now, user_id))
     affected = cur.rowcount
-    conn.close()
     
     return affected > 0
 
@@ -890,69 +1848,64 @@ def delete_user(user_id: int) -> bool:
 
 def create_rider(rider_data: Dict[str, Any]) -> Dict[str, Any]:
     """Create a new rider in the database"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    now = datetime.now(UTC).isoformat()
+    with transaction() as conn:
+        cur = conn.cursor()
+        now = datetime.now(UTC).isoformat()
     
-    cur.execute('''
-        INSERT INTO riders (
-            username, email, password, phone, license_number, vehicle_type, 
-            vehicle_number, emergency_contact, area_coverage, status, location,
-            rating, total_deliveries, successful_deliveries, earnings,
-            commission_rate, delivery_fee, is_verified, is_active, is_suspended,
-            verification_date, verification_notes, document_status,
-            suspension_date, suspension_reason, created_at, updated_at
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-    ''', (
-        rider_data.get('username'),
-        rider_data.get('email'),
-        rider_data.get('password'),
-        rider_data.get('phone'),
-        rider_data.get('license_number'),
-        rider_data.get('vehicle_type'),
-        rider_data.get('vehicle_number'),
-        rider_data.get('emergency_contact'),
-        rider_data.get('area_coverage'),
-        rider_data.get('status', 'offline'),
-        rider_data.get('location'),
-        rider_data.get('rating', 0.0),
-        rider_data.get('total_deliveries', 0),
-        rider_data.get('successful_deliveries', 0),
-        rider_data.get('earnings', 0.0),
-        rider_data.get('commission_rate', 0.8),
-        rider_data.get('delivery_fee', 10.0),
-        rider_data.get('is_verified', 0),
-        rider_data.get('is_active', 1),
-        rider_data.get('is_suspended', 0),
-        rider_data.get('verification_date'),
-        rider_data.get('verification_notes'),
-        rider_data.get('document_status', 'pending'),
-        rider_data.get('suspension_date'),
-        rider_data.get('suspension_reason'),
-        rider_data.get('created_at', now),
-        rider_data.get('updated_at', now)
-    ))
-    
-    rider_id = cur.lastrowid
-    conn.commit()
+        cur.execute('''
+            INSERT INTO riders (
+                username, email, password, phone, license_number, vehicle_type, 
+                vehicle_number, emergency_contact, area_coverage, status, location,
+                rating, total_deliveries, successful_deliveries, earnings,
+                commission_rate, delivery_fee, is_verified, is_active, is_suspended,
+                verification_date, verification_notes, document_status,
+                suspension_date, suspension_reason, created_at, updated_at
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (
+            rider_data.get('username'),
+            rider_data.get('email'),
+            rider_data.get('password'),
+            rider_data.get('phone'),
+            rider_data.get('license_number'),
+            rider_data.get('vehicle_type'),
+            rider_data.get('vehicle_number'),
+            rider_data.get('emergency_contact'),
+            rider_data.get('area_coverage'),
+            rider_data.get('status', 'offline'),
+            rider_data.get('location'),
+            rider_data.get('rating', 0.0),
+            rider_data.get('total_deliveries', 0),
+            rider_data.get('successful_deliveries', 0),
+            rider_data.get('earnings', 0.0),
+            rider_data.get('commission_rate', 0.8),
+            rider_data.get('delivery_fee', 10.0),
+            rider_data.get('is_verified', 0),
+            rider_data.get('is_active', 1),
+            rider_data.get('is_suspended', 0),
+            rider_data.get('verification_date'),
+            rider_data.get('verification_notes'),
+            rider_data.get('document_status', 'pending'),
+            rider_data.get('suspension_date'),
+            rider_data.get('suspension_reason'),
+            rider_data.get('created_at', now),
+            rider_data.get('updated_at', now)
+        ))
+    
+        rider_id = cur.lastrowid
     
     # Fetch and return the created rider
     cur.execute('SELECT * FROM riders WHERE id=?', (rider_id,))
     row = cur.fetchone()
-    conn.close()
     
     return _row_to_rider(row)
 
 def get_rider_by_email(email: str) -> Optional[Dict[str, Any]]:
     """Get rider by email"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     
     cur.execute('SELECT * FROM riders WHERE email=?', (email,))
     row = cur.fetchone()
-    conn.close()
     
     if not row:
         return None
@@ -961,13 +1914,11 @@ def get_rider_by_email(email: str) -> Optional[Dict[str, Any]]:
 
 def get_rider_by_id(rider_id: int) -> Optional[Dict[str, Any]]:
     """Get rider by ID"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     
     cur.execute('SELECT * FROM riders WHERE id=?', (rider_id,))
     row = cur.fetchone()
-    conn.close()
     
     if not row:
         return None
@@ -976,52 +1927,47 @@ def get_rider_by_id(rider_id: int) -> Optional[Dict[str, Any]]:
 
 def get_all_riders() -> List[Dict[str, Any]]:
     """Get all riders"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     
     cur.execute('SELECT * FROM riders ORDER BY created_at DESC')
     rows = cur.fetchall()
-    conn.close()
     
     return [_row_to_rider(row) for row in rows]
 
 def update_rider(rider_id: int, update_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     """Update rider data"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    now = datetime.now(UTC).isoformat()
-    
-    # Build dynamic UPDATE query
-    fields = []
-    values = []
-    
-    allowed_fields = [
-        'username', 'phone', 'license_number', 'vehicle_type', 'vehicle_number',
-        'emergency_contact', 'area_coverage', 'status', 'location', 'rating',
-        'total_deliveries', 'successful_deliveries', 'earnings', 'commission_rate',
-        'delivery_fee', 'is_verified', 'is_active', 'is_suspended',
-        'verification_date', 'verification_notes', 'document_status',
-        'suspension_date', 'suspension_reason', 'license_photo_url', 'vehicle_photo_url'
-    ]
+    with transaction() as conn:
+        cur = conn.cursor()
+        now = datetime.now(UTC).isoformat()
+    
+        # Build dynamic UPDATE query
+        fields = []
+        values = []
+    
+        allowed_fields = [
+            'username', 'phone', 'license_number', 'vehicle_type', 'vehicle_number',
+            'emergency_contact', 'area_coverage', 'status', 'location', 'rating',
+            'total_deliveries', 'successful_deliveries', 'earnings', 'commission_rate',
+            'delivery_fee', 'is_verified', 'is_active', 'is_suspended',
+            'verification_date', 'verification_notes', 'document_status',
+            'suspension_date', 'suspension_reason', 'license_photo_url', 'vehicle_photo_url'
+        ]
     
-    for key in allowed_fields:
-        if key in update_data:
-            fields.append(f'{key}=?')
-            values.append(update_data[key])
+        for key in allowed_fields:
+            if key in update_data:
+                fields.append(f'{key}=?')
+                values.append(update_data[key])
     
-    if not fields:
-        return get_rider_by_id(rider_id)
+        if not fields:
+            return get_rider_by_id(rider_id)
     
-    fields.append('updated_at=?')
-    values.append(now)
-    values.append(rider_id)
+        fields.append('updated_at=?')
+        values.append(now)
+        values.append(rider_id)
     
-    query = f'UPDATE riders SET {", ".join(fields)} WHERE id=?'
-    cur.execute(query, values)
-    conn.commit()
-    conn.close()
+        query = f'UPDATE riders SET {", ".join(fields)} WHERE id=?'
+        cur.execute(query, values)
     
     return get_rider_by_id(rider_id)
 
@@ -1032,23 +1978,58 @@ def update_rider_status(rider_id: int, status: str, location: Optional[str] = No
         update_data['location'] = location
     return update_rider(rider_id, update_data)
 
+def write_rider_locations(positions: Dict[int, Dict[str, Any]],
+                          points: List[Tuple[str, int, Dict[str, Any]]]) -> None:
+    """Group commit: latest fix per rider and (order_id, rider_id, fix) tracking points, in one transaction"""
+    now = datetime.now(UTC).isoformat()
+    with transaction() as conn:
+        conn.executemany(
+            'UPDATE riders SET location = ?, updated_at = ? WHERE id = ?',
+            [(json.dumps(fix), now, rider_id) for rider_id, fix in positions.items()]
+        )
+        conn.executemany(
+            '''INSERT INTO order_location_points (order_id, rider_id, latitude, longitude, accuracy, recorded_at)
+               VALUES (?,?,?,?,?,?)''',
+            [(order_id, rider_id, fix.get('latitude'), fix.get('longitude'), fix.get('accuracy'),
+              fix.get('timestamp') or now) for order_id, rider_id, fix in points]
+        )
+
+def get_available_riders_for_map() -> List[Dict[str, Any]]:
+    """Get available, verified riders with their location and delivered order count"""
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    cur.execute('''
+        SELECT 
+            r.id,
+            r.username,
+            r.phone,
+            r.rating,
+            r.status,
+            r.location AS current_location,
+            r.is_verified,
+            COUNT(DISTINCT o.id) as total_deliveries
+        FROM riders r
+        LEFT JOIN orders o ON o.rider_id = r.id AND o.status = 'delivered'
+        WHERE r.status = 'available' AND r.is_verified = 1
+        GROUP BY r.id
+    ''')
+    return [tuple(row) for row in cur.fetchall()]
+
 def delete_rider(rider_id: int) -> bool:
     """Delete rider (soft delete by setting is_active=0)"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    now = datetime.now(UTC).isoformat()
+    with transaction() as conn:
+        cur = conn.cursor()
+        now = datetime.now(UTC).isoformat()
     
-    cur.execute('UPDATE riders SET is_active=0, updated_at=? WHERE id=?', (now, rider_id))
-    conn.commit()
+        cur.execute('UPDATE riders SET is_active=0, updated_at=? WHERE id=?', (now, rider_id))
     affected = cur.rowcount
-    conn.close()
     
     return affected > 0
 
 def get_available_riders() -> List[Dict[str, Any]]:
     """Get all riders with status 'available' who are active and verified"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     
     cur.execute('''
@@ -1060,19 +2041,41 @@ def get_available_riders() -> List[Dict[str, Any]]:
         ORDER BY rating DESC, total_deliveries DESC
     ''')
     rows = cur.fetchall()
-    conn.close()
     
     return [_row_to_rider(row) for row in rows]
 
+def get_available_riders_by_ids(rider_ids: Sequence[int]) -> Dict[int, Dict[str, Any]]:
+    """The riders among rider_ids that get_available_riders() would return, keyed by ID"""
+    if not rider_ids:
+        return {}
+    conn = get_connection()
+    cur = conn.cursor()
+    
+    cur.execute(f'''
+        SELECT * FROM riders 
+        WHERE id IN ({','.join('?' * len(rider_ids))})
+        AND status='available' 
+        AND is_active=1 
+        AND is_verified=1 
+        AND is_suspended=0
+    ''', list(rider_ids))
+    
+    return {row['id']: _row_to_rider(row) for row in cur.fetchall()}
+
+def get_rider_locations() -> List[Tuple[int, Optional[str]]]:
+    """(rider_id, location JSON) for every active rider that has reported a position"""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute("SELECT id, location FROM riders WHERE is_active=1 AND location IS NOT NULL AND location != ''")
+    return [(row['id'], row['location']) for row in cur.fetchall()]
+
 def get_riders_by_status(status: str) -> List[Dict[str, Any]]:
     """Get all riders with a specific status"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     
     cur.execute('SELECT * FROM riders WHERE status=? AND is_active=1', (status,))
     rows = cur.fetchall()
-    conn.close()
     
     return [_row_to_rider(row) for row in rows]
 
@@ -1083,195 +2086,286 @@ def assign_order_to_rider(
     estimated_time_minutes: int = None,
     expires_in_seconds: int = 30
 ) -> Optional[Dict[str, Any]]:
-    """Assign an order to a rider with timeout"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+    """Offer a pending order to a rider with timeout; None if it is no longer pending"""
     now = datetime.now(UTC)
     expires_at = (now + timedelta(seconds=expires_in_seconds)).isoformat()
     
     try:
-        # Get current assignment attempts and assigned riders
-        cur.execute('SELECT assignment_attempts, assigned_riders FROM orders WHERE id=?', (order_id,))
-        row = cur.fetchone()
-        
-        if not row:
-            conn.close()
-            return None
-        
-        attempts = (row['assignment_attempts'] or 0) + 1
-        assigned_riders_str = row['assigned_riders'] or ''
-        assigned_riders_list = assigned_riders_str.split(',') if assigned_riders_str else []
-        assigned_riders_list.append(str(rider_id))
-        new_assigned_riders = ','.join(assigned_riders_list)
-        
-        # Update order with assignment
-        cur.execute('''
-            UPDATE orders 
-            SET rider_id=?, 
-                status='assigned',
-                assignment_expires_at=?,
-                assignment_attempts=?,
-                assigned_riders=?,
-                distance_km=?,
-                estimated_time_minutes=?,
-                updated_at=?
-            WHERE id=?
-        ''', (
-            rider_id, 
-            expires_at, 
-            attempts, 
-            new_assigned_riders,
-            distance_km,
-            estimated_time_minutes,
-            now.isoformat(), 
-            order_id
-        ))
-        
-        # Update rider status to busy
-        cur.execute('UPDATE riders SET status=?, updated_at=? WHERE id=?', ('busy', now.isoformat(), rider_id))
-        
-        conn.commit()
-        
-        # Fetch and return updated order
-        cur.execute('SELECT * FROM orders WHERE id=?', (order_id,))
-        updated_row = cur.fetchone()
-        conn.close()
+        with transaction() as conn:
+            cur = conn.cursor()
+            # Bump attempts and append to assigned riders in the same statement
+            cur.execute('''
+                UPDATE orders 
+                SET rider_id=?, 
+                    status='assigned',
+                    assignment_expires_at=?,
+                    assignment_attempts=COALESCE(assignment_attempts, 0) + 1,
+                    assigned_riders=CASE
+                        WHEN assigned_riders IS NULL OR assigned_riders='' THEN ?
+                        ELSE assigned_riders || ',' || ?
+                    END,
+                    distance_km=?,
+                    estimated_time_minutes=?,
+                    updated_at=?
+                WHERE id=? AND status='pending'
+                RETURNING *
+            ''', (
+                rider_id, 
+                expires_at, 
+                str(rider_id),
+                str(rider_id),
+                distance_km,
+                estimated_time_minutes,
+                now.isoformat(), 
+                order_id
+            ))
+            updated_row = cur.fetchone()
+            
+            if not updated_row:
+                return None
+            
+            # Update rider status to busy
+            cur.execute('UPDATE riders SET status=?, updated_at=? WHERE id=?', ('busy', now.isoformat(), rider_id))
         
-        return _row_to_order(updated_row) if updated_row else None
+        return _row_to_order(updated_row)
         
     except Exception as e:
-        conn.rollback()
-        conn.close()
         print(f"Error assigning order: {e}")
         return None
 
 def accept_order_assignment(order_id: str, rider_id: int) -> Optional[Dict[str, Any]]:
     """Rider accepts the order assignment"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
     now = datetime.now(UTC).isoformat()
     
     try:
-        # Verify the order is assigned to this rider
-        cur.execute('SELECT * FROM orders WHERE id=? AND rider_id=?', (order_id, rider_id))
-        row = cur.fetchone()
-        
-        if not row:
-            conn.close()
-            return None
-        
-        # Clear assignment timeout
-        cur.execute('''
-            UPDATE orders 
-            SET assignment_expires_at=NULL,
-                updated_at=?
-            WHERE id=?
-        ''', (now, order_id))
-        
-        conn.commit()
-        
-        # Fetch and return updated order
-        cur.execute('SELECT * FROM orders WHERE id=?', (order_id,))
-        updated_row = cur.fetchone()
-        conn.close()
+        with transaction() as conn:
+            cur = conn.cursor()
+            # Clear assignment timeout, only if the order is assigned to this rider
+            cur.execute('''
+                UPDATE orders 
+                SET assignment_expires_at=NULL,
+                    updated_at=?
+                WHERE id=? AND rider_id=?
+                RETURNING *
+            ''', (now, order_id, rider_id))
+            updated_row = cur.fetchone()
         
         return _row_to_order(updated_row) if updated_row else None
         
     except Exception as e:
-        conn.rollback()
-        conn.close()
         print(f"Error accepting order: {e}")
         return None
 
 def reject_order_assignment(order_id: str, rider_id: int) -> bool:
     """Rider rejects the order assignment"""
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
     now = datetime.now(UTC).isoformat()
     
     try:
-        # Verify the order is assigned to this rider
-        cur.execute('SELECT rider_id FROM orders WHERE id=?', (order_id,))
-        row = cur.fetchone()
-        
-        if not row or row[0] != rider_id:
-            conn.close()
-            return False
-        
-        # Clear assignment and revert to pending
-        cur.execute('''
-            UPDATE orders 
-            SET rider_id=NULL,
-                status='pending',
-                assignment_expires_at=NULL,
-                updated_at=?
-            WHERE id=?
-        ''', (now, order_id))
-        
-        # Update rider status back to available
-        cur.execute('UPDATE riders SET status=?, updated_at=? WHERE id=?', ('available', now, rider_id))
-        
-        conn.commit()
-        conn.close()
+        with transaction() as conn:
+            cur = conn.cursor()
+            # Clear assignment and revert to pending, only if the order is assigned to this rider
+            cur.execute('''
+                UPDATE orders 
+                SET rider_id=NULL,
+                    status='pending',
+                    assignment_expires_at=NULL,
+                    updated_at=?
+                WHERE id=? AND rider_id=?
+            ''', (now, order_id, rider_id))
+            if cur.rowcount == 0:
+                return False
+            
+            # Update rider status back to available
+            cur.execute('UPDATE riders SET status=?, updated_at=? WHERE id=?', ('available', now, rider_id))
         return True
         
     except Exception as e:
-        conn.rollback()
-        conn.close()
         print(f"Error rejecting order: {e}")
         return False
 
-def clear_expired_assignments() -> List[str]:
-    """Clear assignments that have timed out, returns list of expired order IDs"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+def clear_expired_assignments(order_ids: Optional[Sequence[str]] = None) -> List[str]:
+    """Release assignments and broadcast offers whose window has closed, returns the expired order IDs
+
+    Riders go back to available and orders back to pending in two set-based
+    statements. Pass order_ids to limit the sweep to the orders a timer fired
+    for; offers that were accepted or re-assigned meanwhile no longer match
+    and are left alone.
+    """
     now = datetime.now(UTC).isoformat()
+    expired_filter = '''status IN ('assigned', 'pending')
+                AND assignment_expires_at IS NOT NULL
+                AND assignment_expires_at <= ?'''
+    params: List[Any] = [now]
+    if order_ids is not None:
+        if not order_ids:
+            return []
+        expired_filter += f" AND id IN ({','.join('?' * len(order_ids))})"
+        params.extend(order_ids)
     
     try:
-        # Find expired assignments
-        cur.execute('''
-            SELECT id, rider_id FROM orders 
-            WHERE assignment_expires_at IS NOT NULL 
-            AND assignment_expires_at < ?
-            AND status='assigned'
-        ''', (now,))
-        expired = cur.fetchall()
-        
-        expired_order_ids = []
-        for row in expired:
-            order_id = row['id']
-            rider_id = row['rider_id']
+        with transaction() as conn:
+            cur = conn.cursor()
+            # Riders first: RETURNING only sees the cleared rider_id.
+            # Only riders still marked busy; one who went offline stays offline
+            cur.execute(f'''
+                UPDATE riders SET status='available', updated_at=?
+                WHERE status='busy' AND id IN (
+                    SELECT rider_id FROM orders WHERE {expired_filter}
+                )
+            ''', [now, *params])
             
-            # Clear assignment
-            cur.execute('''
+            cur.execute(f'''
                 UPDATE orders 
                 SET rider_id=NULL,
                     status='pending',
                     assignment_expires_at=NULL,
                     updated_at=?
-                WHERE id=?
-            ''', (now, order_id))
-            
-            # Update rider status if they're still busy
-            if rider_id:
-                cur.execute('UPDATE riders SET status=?, updated_at=? WHERE id=? AND status=?', 
-                           ('available', now, rider_id, 'busy'))
+                WHERE {expired_filter}
+                RETURNING id
+            ''', [now, *params])
+            expired = [row['id'] for row in cur.fetchall()]
             
-            expired_order_ids.append(order_id)
+            if expired:
+                # Broadcast offers nobody accepted
+                cur.execute(f'''
+                    UPDATE order_offers SET status='expired'
+                    WHERE status='open' AND order_id IN ({','.join('?' * len(expired))})
+                ''', expired)
         
-        conn.commit()
-        conn.close()
-        return expired_order_ids
+        return expired
         
     except Exception as e:
-        conn.rollback()
-        conn.close()
         print(f"Error clearing expired assignments: {e}")
         return []
 
+def get_assignment_deadlines() -> List[Tuple[str, str]]:
+    """(order_id, assignment_expires_at) for every offer still awaiting a reply"""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT id, assignment_expires_at FROM orders
+        WHERE status IN ('assigned', 'pending') AND assignment_expires_at IS NOT NULL
+    ''')
+    return [(row['id'], row['assignment_expires_at']) for row in cur.fetchall()]
+
+def create_order_offers(order_id: str, rider_ids: Sequence[int], expires_in_seconds: int = 30) -> Optional[Dict[str, Any]]:
+    """Offer a pending order to several riders at once; the first claim_order_offer() wins.
+
+    The order stays pending and unassigned with assignment_expires_at set to
+    the end of the offer window. Returns None if the order is no longer
+    pending or is already out on offer.
+    """
+    if not rider_ids:
+        return None
+    now = datetime.now(UTC)
+    expires_at = (now + timedelta(seconds=expires_in_seconds)).isoformat()
+    offered = ','.join(str(rider_id) for rider_id in rider_ids)
+    
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            UPDATE orders
+            SET assignment_expires_at=?,
+                assignment_attempts=COALESCE(assignment_attempts, 0) + 1,
+                assigned_riders=CASE
+                    WHEN assigned_riders IS NULL OR assigned_riders='' THEN ?
+                    ELSE assigned_riders || ',' || ?
+                END,
+                updated_at=?
+            WHERE id=? AND status='pending' AND rider_id IS NULL AND assignment_expires_at IS NULL
+            RETURNING *
+        ''', (expires_at, offered, offered, now.isoformat(), order_id))
+        row = cur.fetchone()
+        if not row:
+            return None
+        
+        cur.executemany('''
+            INSERT OR REPLACE INTO order_offers (order_id, rider_id, status, offered_at, expires_at)
+            VALUES (?, ?, 'open', ?, ?)
+        ''', [(order_id, rider_id, now.isoformat(), expires_at) for rider_id in rider_ids])
+    
+    return _row_to_order(row)
+
+def decline_order_offer(order_id: str, rider_id: int) -> Optional[int]:
+    """Decline a rider's open offer, returns how many offers are still open (None if there was none).
+
+    When the last open offer is declined the order's offer window closes
+    immediately so it can be dispatched again without waiting for expiry.
+    """
+    now = datetime.now(UTC).isoformat()
+    with transaction() as conn:
+        cur = conn.cursor()
+        cur.execute('''
+            UPDATE order_offers SET status='declined', responded_at=?
+            WHERE order_id=? AND rider_id=? AND status='open'
+        ''', (now, order_id, rider_id))
+        if cur.rowcount == 0:
+            return None
+        
+        cur.execute("SELECT COUNT(*) FROM order_offers WHERE order_id=? AND status='open'", (order_id,))
+        still_open = cur.fetchone()[0]
+        if still_open == 0:
+            cur.execute('''
+                UPDATE orders SET assignment_expires_at=NULL, updated_at=?
+                WHERE id=? AND status='pending' AND rider_id IS NULL
+            ''', (now, order_id))
+    return still_open
+
+def get_open_offers_for_rider(rider_id: int) -> List[Dict[str, Any]]:
+    """Orders currently on broadcast offer to a rider"""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT o.* FROM order_offers f
+        JOIN orders o ON o.id = f.order_id
+        WHERE f.rider_id=? AND f.status='open' AND f.expires_at > ?
+        ORDER BY f.offered_at
+    ''', (rider_id, datetime.now(UTC).isoformat()))
+    return _rows_to_orders(cur)
+
+def get_offer_metrics(since: str) -> Dict[str, Any]:
+    """Broadcast offer outcomes and offer-to-accept latency for offers made since an ISO timestamp"""
+    conn = get_connection()
+    cur = conn.cursor()
+    cur.execute('''
+        SELECT status, COUNT(*) AS count FROM order_offers
+        WHERE offered_at >= ?
+        GROUP BY status
+    ''', (since,))
+    by_status = {row['status']: row['count'] for row in cur.fetchall()}
+    
+    cur.execute('''
+        SELECT (julianday(responded_at) - julianday(offered_at)) * 86400.0 AS latency
+        FROM order_offers
+        WHERE offered_at >= ? AND status='accepted'
+        ORDER BY latency
+    ''', (since,))
+    latencies = [row['latency'] for row in cur.fetchall()]
+    
+    def percentile(p: float) -> Optional[float]:
+        if not latencies:
+            return None
+        return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 3)
+    
+    cur.execute('''
+        SELECT COUNT(DISTINCT order_id) AS orders,
+               COUNT(DISTINCT CASE WHEN status='accepted' THEN order_id END) AS accepted
+        FROM order_offers WHERE offered_at >= ?
+    ''', (since,))
+    totals = cur.fetchone()
+    
+    return {
+        'offers': sum(by_status.values()),
+        'by_status': by_status,
+        'orders_offered': totals['orders'],
+        'orders_accepted': totals['accepted'],
+        'accept_latency_seconds': {
+            'median': percentile(0.5),
+            'p90': percentile(0.9),
+            'max': round(latencies[-1], 3) if latencies else None
+        }
+    }
+
 def _row_to_rider(row: sqlite3.Row) -> Dict[str, Any]:
     """Convert SQLite row to rider dict"""
     rider_dict = {
@@ -1322,76 +2416,113 @@ def _row_to_rider(row: sqlite3.Row) -> Dict[str, Any]:
 
 def create_rating(rating_data: Dict[str, Any]) -> Dict[str, Any]:
     """Create a new rating"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    now = datetime.now(UTC).isoformat()
+    with transaction() as conn:
+        cur = conn.cursor()
+        now = datetime.now(UTC).isoformat()
     
-    rating_id = f"rating_{int(datetime.now(UTC).timestamp() * 1000)}"
+        rating_id = ids.new_rating_id()
     
-    cur.execute('''
-        INSERT INTO ratings (
-            id, order_id, rating_type, reviewer_id, reviewer_name, reviewer_type,
-            reviewee_id, reviewee_name, reviewee_type, rating, comment, tags,
-            created_at, disputed, dispute_status
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, 'none')
-    ''', (
-        rating_id,
-        rating_data['order_id'],
-        rating_data['rating_type'],
-        rating_data['reviewer_id'],
-        rating_data['reviewer_name'],
-        rating_data['reviewer_type'],
-        rating_data['reviewee_id'],
-        rating_data['reviewee_name'],
-        rating_data['reviewee_type'],
-        rating_data['rating'],
-        rating_data.get('comment'),
-        json.dumps(rating_data.get('tags', [])),
-        now
-    ))
-    
-    conn.commit()
-    
-    # Update average rating for the reviewee
-    if rating_data['reviewee_type'] == 'rider':
-        update_rider_average_rating(rating_data['reviewee_id'])
-    
-    # Get and return the created rating
-    cur.execute('SELECT * FROM ratings WHERE id=?', (rating_id,))
-    row = cur.fetchone()
-    conn.close()
+        cur.execute('''
+            INSERT INTO ratings (
+                id, order_id, rating_type, reviewer_id, reviewer_name, reviewer_type,
+                reviewee_id, reviewee_name, reviewee_type, rating, comment, tags,
+                created_at, disputed, dispute_status
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 0, 'none')
+            RETURNING *
+        ''', (
+            rating_id,
+            rating_data['order_id'],
+            rating_data['rating_type'],
+            rating_data['reviewer_id'],
+            rating_data['reviewer_name'],
+            rating_data['reviewer_type'],
+            rating_data['reviewee_id'],
+            rating_data['reviewee_name'],
+            rating_data['reviewee_type'],
+            rating_data['rating'],
+            rating_data.get('comment'),
+            json.dumps(rating_data.get('tags', [])),
+            now
+        ))
+        row = cur.fetchone()
+    
+        # Fold into the reviewee's aggregate (and rider average) in the same transaction
+        _adjust_rating_aggregate(
+            cur, rating_data['reviewee_id'], rating_data['reviewee_type'],
+            rating_data['rating'], rating_data.get('tags') or [], 1, now
+        )
     
     return _row_to_rating(row) if row else None
 
+def _adjust_rating_aggregate(cur: sqlite3.Cursor, user_id: int, user_type: str, rating: int,
+                             tags: List[str], sign: int, now: str) -> None:
+    """Add (sign=1) or remove (sign=-1) one rating from a reviewee's aggregate.
+
+    Tags count every time they appear, repeats within a rating included, the
+    same rule as the migration 8 backfill.
+    """
+    stars = [sign if rating == star else 0 for star in (1, 2, 3, 4, 5)]
+    cur.execute('''
+        INSERT INTO rating_aggregates
+            (user_id, user_type, total_ratings, rating_sum, one_star, two_star, three_star, four_star, five_star, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (user_id, user_type) DO UPDATE SET
+            total_ratings = total_ratings + excluded.total_ratings,
+            rating_sum = rating_sum + excluded.rating_sum,
+            one_star = one_star + excluded.one_star,
+            two_star = two_star + excluded.two_star,
+            three_star = three_star + excluded.three_star,
+            four_star = four_star + excluded.four_star,
+            five_star = five_star + excluded.five_star,
+            updated_at = excluded.updated_at
+    ''', (user_id, user_type, sign, sign * rating, *stars, now))
+    
+    if tags:
+        cur.executemany('''
+            INSERT INTO rating_tag_counts (user_id, user_type, tag, count) VALUES (?, ?, ?, ?)
+            ON CONFLICT (user_id, user_type, tag) DO UPDATE SET count = count + excluded.count
+        ''', [(user_id, user_type, tag, sign * count) for tag, count in Counter(tags).items()])
+        if sign < 0:
+            cur.execute('DELETE FROM rating_tag_counts WHERE user_id=? AND user_type=? AND count <= 0',
+                        (user_id, user_type))
+    
+    if user_type == 'rider':
+        _refresh_rider_rating(cur, user_id)
+
+def _refresh_rider_rating(cur: sqlite3.Cursor, rider_id: int) -> None:
+    cur.execute('''
+        UPDATE riders SET rating = (
+            SELECT ROUND(CAST(rating_sum AS REAL) / total_ratings, 2) FROM rating_aggregates
+            WHERE user_id=? AND user_type='rider'
+        )
+        WHERE id=? AND EXISTS (
+            SELECT 1 FROM rating_aggregates WHERE user_id=? AND user_type='rider' AND total_ratings > 0
+        )
+    ''', (rider_id, rider_id, rider_id))
+
 def get_rating_by_id(rating_id: str) -> Optional[Dict[str, Any]]:
     """Get rating by ID"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     
     cur.execute('SELECT * FROM ratings WHERE id=?', (rating_id,))
     row = cur.fetchone()
-    conn.close()
     
     return _row_to_rating(row) if row else None
 
 def get_ratings_for_order(order_id: str) -> List[Dict[str, Any]]:
     """Get all ratings for an order"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     
     cur.execute('SELECT * FROM ratings WHERE order_id=? ORDER BY created_at DESC', (order_id,))
     rows = cur.fetchall()
-    conn.close()
     
     return [_row_to_rating(row) for row in rows]
 
 def get_ratings_for_user(user_id: int, user_type: str) -> List[Dict[str, Any]]:
     """Get all ratings received by a user"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     
     cur.execute('''
@@ -1400,14 +2531,12 @@ def get_ratings_for_user(user_id: int, user_type: str) -> List[Dict[str, Any]]:
         ORDER BY created_at DESC
     ''', (user_id, user_type))
     rows = cur.fetchall()
-    conn.close()
     
     return [_row_to_rating(row) for row in rows]
 
 def get_ratings_by_user(user_id: int, user_type: str) -> List[Dict[str, Any]]:
     """Get all ratings given by a user"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     
     cur.execute('''
@@ -1416,19 +2545,18 @@ def get_ratings_by_user(user_id: int, user_type: str) -> List[Dict[str, Any]]:
         ORDER BY created_at DESC
     ''', (user_id, user_type))
     rows = cur.fetchall()
-    conn.close()
     
     return [_row_to_rating(row) for row in rows]
 
 def get_rating_stats(user_id: int, user_type: str) -> Dict[str, Any]:
-    """Get rating statistics for a user"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    """Get rating statistics for a user from the maintained aggregate"""
+    conn = get_connection()
     cur = conn.cursor()
     
-    ratings = get_ratings_for_user(user_id, user_type)
+    cur.execute('SELECT * FROM rating_aggregates WHERE user_id=? AND user_type=?', (user_id, user_type))
+    aggregate = cur.fetchone()
     
-    if not ratings:
+    if not aggregate or not aggregate['total_ratings']:
         return {
             'user_id': user_id,
             'user_type': user_type,
@@ -1443,70 +2571,80 @@ def get_rating_stats(user_id: int, user_type: str) -> Dict[str, Any]:
             'top_tags': []
         }
     
-    total = len(ratings)
-    avg = sum(r['rating'] for r in ratings) / total
-    
-    # Count stars
-    star_counts = {5: 0, 4: 0, 3: 0, 2: 0, 1: 0}
-    for r in ratings:
-        star_counts[r['rating']] += 1
-    
-    # Count tags
-    tag_counts = {}
-    for r in ratings:
-        if r.get('tags'):
-            for tag in r['tags']:
-                tag_counts[tag] = tag_counts.get(tag, 0) + 1
+    cur.execute('''
+        SELECT tag, count FROM rating_tag_counts
+        WHERE user_id=? AND user_type=?
+        ORDER BY count DESC, tag
+        LIMIT 5
+    ''', (user_id, user_type))
+    top_tags = [{'tag': row['tag'], 'count': row['count']} for row in cur.fetchall()]
     
-    top_tags = sorted(
-        [{'tag': tag, 'count': count} for tag, count in tag_counts.items()],
-        key=lambda x: x['count'],
-        reverse=True
-    )[:5]
+    cur.execute('''
+        SELECT * FROM ratings 
+        WHERE reviewee_id=? AND reviewee_type=? 
+        ORDER BY created_at DESC
+        LIMIT 10
+    ''', (user_id, user_type))
+    recent_ratings = [_row_to_rating(row) for row in cur.fetchall()]
     
     return {
         'user_id': user_id,
         'user_type': user_type,
-        'average_rating': round(avg, 2),
-        'total_ratings': total,
-        'five_star': star_counts[5],
-        'four_star': star_counts[4],
-        'three_star': star_counts[3],
-        'two_star': star_counts[2],
-        'one_star': star_counts[1],
-        'recent_ratings': ratings[:10],
+        'average_rating': round(aggregate['rating_sum'] / aggregate['total_ratings'], 2),
+        'total_ratings': aggregate['total_ratings'],
+        'five_star': aggregate['five_star'],
+        'four_star': aggregate['four_star'],
+        'three_star': aggregate['three_star'],
+        'two_star': aggregate['two_star'],
+        'one_star': aggregate['one_star'],
+        'recent_ratings': recent_ratings,
         'top_tags': top_tags
     }
 
 def update_rating(rating_id: str, update_data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
-    """Update a rating"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    now = datetime.now(UTC).isoformat()
-    
-    update_data['updated_at'] = now
-    
-    fields = []
-    values = []
-    
-    for key, value in update_data.items():
-        if key in ['comment', 'disputed', 'dispute_status', 'dispute_reason', 
-                   'dispute_date', 'admin_response', 'admin_resolved_date', 'updated_at']:
-            fields.append(f'{key}=?')
-            values.append(value)
-    
-    if not fields:
-        conn.close()
-        return get_rating_by_id(rating_id)
+    """Update a rating; star or tag changes are carried into the reviewee's aggregate"""
+    with transaction() as conn:
+        cur = conn.cursor()
+        now = datetime.now(UTC).isoformat()
+    
+        update_data['updated_at'] = now
+    
+        fields = []
+        values = []
+    
+        for key, value in update_data.items():
+            if key in ['comment', 'disputed', 'dispute_status', 'dispute_reason', 
+                       'dispute_date', 'admin_response', 'admin_resolved_date', 'updated_at']:
+                fields.append(f'{key}=?')
+                values.append(value)
+            elif key == 'rating':
+                fields.append('rating=?')
+                values.append(value)
+            elif key == 'tags':
+                fields.append('tags=?')
+                values.append(json.dumps(value or []))
+    
+        if not fields:
+            return get_rating_by_id(rating_id)
+    
+        rescored = 'rating' in update_data or 'tags' in update_data
+        if rescored:
+            cur.execute('SELECT * FROM ratings WHERE id=?', (rating_id,))
+            before = cur.fetchone()
+    
+        values.append(rating_id)
+        query = f'UPDATE ratings SET {", ".join(fields)} WHERE id=? RETURNING *'
+        cur.execute(query, values)
+        row = cur.fetchone()
     
-    values.append(rating_id)
-    query = f'UPDATE ratings SET {", ".join(fields)} WHERE id=?'
-    cur.execute(query, values)
-    conn.commit()
-    conn.close()
+        if rescored and before and row:
+            old, new = _row_to_rating(before), _row_to_rating(row)
+            _adjust_rating_aggregate(cur, old['reviewee_id'], old['reviewee_type'],
+                                     old['rating'], old['tags'] or [], -1, now)
+            _adjust_rating_aggregate(cur, new['reviewee_id'], new['reviewee_type'],
+                                     new['rating'], new['tags'] or [], 1, now)
     
-    return get_rating_by_id(rating_id)
+    return _row_to_rating(row) if row else None
 
 def dispute_rating(rating_id: str, dispute_reason: str) -> Optional[Dict[str, Any]]:
     """Mark a rating as disputed"""
@@ -1529,8 +2667,7 @@ def resolve_dispute(rating_id: str, admin_response: str, status: str) -> Optiona
 
 def get_disputed_ratings() -> List[Dict[str, Any]]:
     """Get all disputed ratings (admin only)"""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
+    conn = get_connection()
     cur = conn.cursor()
     
     cur.execute('''
@@ -1539,24 +2676,13 @@ def get_disputed_ratings() -> List[Dict[str, Any]]:
         ORDER BY dispute_date DESC
     ''')
     rows = cur.fetchall()
-    conn.close()
     
     return [_row_to_rating(row) for row in rows]
 
 def update_rider_average_rating(rider_id: int):
-    """Update rider's average rating based on all their ratings"""
-    ratings = get_ratings_for_user(rider_id, 'rider')
-    
-    if not ratings:
-        return
-    
-    avg_rating = sum(r['rating'] for r in ratings) / len(ratings)
-    
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute('UPDATE riders SET rating=? WHERE id=?', (round(avg_rating, 2), rider_id))
-    conn.commit()
-    conn.close()
+    """Update rider's average rating from their rating aggregate"""
+    with transaction() as conn:
+        _refresh_rider_rating(conn.cursor(), rider_id)
 
 def _row_to_rating(row: sqlite3.Row) -> Dict[str, Any]:
     """Convert SQLite row to rating dict"""
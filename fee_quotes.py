@@ -0,0 +1,139 @@
+"""
+Fee Quote Cache
+Memoizes delivery fee quotes per geohash cell for the checkout screen.
+
+The checkout screen re-quotes as the customer drags the map pin, and most
+quotes repeat within a neighbourhood. A cell's entry holds the distance from
+the station to the cell centre and the uncapped fee, in an LRU that also
+expires entries after TTL_SECONDS.
+
+Quotes stay exact:
+- A cell is only cached when every point in it falls in the same
+  BASE_DISTANCE_M fee step. Cells that straddle a step boundary are split
+  into finer geohash cells, and quoted point by point at the finest level.
+- The order-total cap is a single min(), so it is applied per request
+  rather than bucketing totals into the key.
+
+The cache remembers geo.fee_parameters() and clears itself as soon as any
+fee parameter changes.
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+import geo
+
+GEOHASH_PRECISION = 7  # ~150 m x 150 m cells
+MAX_REFINEMENT = 2     # straddling cells split down to geohash-9 (~5 m)
+MAX_ENTRIES = 50000
+TTL_SECONDS = 600.0
+
+class FeeQuoteCache:
+    """LRU + TTL map of geohash cell -> (expires_at, distance_m, uncapped_fee)
+
+    A cell that straddles a fee step is stored with no quote and answered
+    from its sub-cells, up to MAX_REFINEMENT geohash characters deeper.
+    """
+
+    def __init__(self, precision: int = GEOHASH_PRECISION, max_entries: int = MAX_ENTRIES, ttl: float = TTL_SECONDS):
+        self.precision = precision
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[float, Optional[float], Optional[float]]]" = OrderedDict()
+        self._parameters = geo.fee_parameters()
+        self.hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+        self.invalidations = 0
+
+    def invalidate(self) -> None:
+        """Drop every cached quote, e.g. after fee parameters change"""
+        with self._lock:
+            self._entries.clear()
+            self._parameters = geo.fee_parameters()
+            self.invalidations += 1
+
+    def _cell_quote(self, bounds: Tuple[float, float, float, float]) -> Optional[Tuple[float, float]]:
+        """(centre distance, uncapped fee) if the whole cell is in one fee step, else None"""
+        lat_lo, lat_hi, lng_lo, lng_hi = bounds
+        lat = (lat_lo + lat_hi) / 2
+        lng = (lng_lo + lng_hi) / 2
+        distance = geo.distance_m(geo.STATION_LAT, geo.STATION_LNG, lat, lng)
+        # No point in the cell is further from its centre than the furthest corner
+        reach = max(geo.distance_m(lat, lng, lat_lo, lng_hi), geo.distance_m(lat, lng, lat_hi, lng_hi))
+        if geo.distance_steps(distance - reach) != geo.distance_steps(distance + reach):
+            return None
+        return distance, geo.delivery_fee(distance)
+
+    def _lookup(self, lat: float, lng: float) -> Tuple[float, float, bool]:
+        """(distance, uncapped fee, cached) for a point, refining straddling cells"""
+        geohash, _ = geo.geohash_cell(lat, lng, self.precision + MAX_REFINEMENT)
+        now = time.monotonic()
+        for precision in range(self.precision, self.precision + MAX_REFINEMENT + 1):
+            cell = geohash[:precision]
+            with self._lock:
+                entry = self._entries.get(cell)
+                if entry is not None and entry[0] > now:
+                    self._entries.move_to_end(cell)
+                    if entry[1] is not None:
+                        self.hits += 1
+                        return entry[1], entry[2], True
+                    continue  # split cell; look one level down
+
+            cell_quote = self._cell_quote(geo.geohash_cell(lat, lng, precision)[1])
+            if cell_quote is None and precision < self.precision + MAX_REFINEMENT:
+                self._store(cell, (now + self.ttl, None, None))
+                continue
+            if cell_quote is None:
+                break
+            with self._lock:
+                self.misses += 1
+            self._store(cell, (now + self.ttl,) + cell_quote)
+            return cell_quote + (False,)
+
+        with self._lock:
+            self.uncacheable += 1
+        distance = geo.distance_m(geo.STATION_LAT, geo.STATION_LNG, lat, lng)
+        return distance, geo.delivery_fee(distance), False
+
+    def _store(self, cell: str, entry: Tuple) -> None:
+        with self._lock:
+            self._entries[cell] = entry
+            self._entries.move_to_end(cell)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def quote(self, lat: float, lng: float, order_total: float = 0) -> Dict[str, Any]:
+        """{delivery_fee, distance_meters, uncapped_fee, cached}; distance is the cell centre's on cached quotes"""
+        if self._parameters != geo.fee_parameters():
+            self.invalidate()
+
+        distance, uncapped, cached = self._lookup(lat, lng)
+        fee = uncapped
+        if order_total and order_total > 0:
+            fee = round(min(fee, order_total * geo.MAX_FEE_SHARE), 2)
+        return {
+            'delivery_fee': fee,
+            'distance_meters': distance,
+            'uncapped_fee': uncapped,
+            'cached': cached,
+        }
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses + self.uncacheable
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl_seconds': self.ttl,
+                'geohash_precision': self.precision,
+                'hits': self.hits,
+                'misses': self.misses,
+                'uncacheable': self.uncacheable,
+                'invalidations': self.invalidations,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else None,
+            }
+
+cache = FeeQuoteCache()
@@ -16,7 +16,7 @@ import { Ionicons } from '@expo/vector-icons';
 import MapView, { Marker, Polyline, PROVIDER_DEFAULT } from 'react-native-maps';
 import * as Location from 'expo-location';
 import { apiService } from '../services/api';
-import { useWebSocketEvent } from '../context/WebSocketContext';
+import { useWebSocket, useWebSocketEvent } from '../context/WebSocketContext';
 import locationTrackingService from '../services/locationTracking';
 import geocodingService from '../services/geocodingService';
 import Loading from '../components/Loading';
@@ -83,6 +83,15 @@ const DeliveryTrackingScreen: React.FC<TrackingScreenProps> = ({ navigation, rou
   const orderId = route.params?.orderId;
   const isLoadingRef = useRef(false);
 
+  const { isConnected, send } = useWebSocket();
+
+  // The server only sends an order's tracking events to sockets subscribed to it
+  useEffect(() => {
+    if (!isConnected || !orderId) return;
+    send('subscribe', { topic: `order:${orderId}` });
+    return () => send('unsubscribe', { topic: `order:${orderId}` });
+  }, [isConnected, orderId, send]);
+
   // Subscribe to rider location updates via WebSocket
   useWebSocketEvent('rider_location', (data) => {
     console.log('[DeliveryTracking] Rider location update:', data);
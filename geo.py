@@ -0,0 +1,127 @@
+"""
+Geo & Fees
+Distance and delivery-fee maths shared by order pricing, the delivery fee
+migration, rider dispatch and batch matching.
+
+Every formula has a vectorized form that takes NumPy arrays (or anything
+array-like, broadcast together) and a scalar form on plain floats. The
+scalar forms use the math module because NumPy's per-call overhead dominates
+single-point work; both read the same constants, so they cannot drift apart.
+
+Delivery fee: BASE_FEE for the first BASE_DISTANCE_M metres from the
+station, ADDITIONAL_FEE per further BASE_DISTANCE_M started, capped at
+MAX_FEE_SHARE of the order total when a total is given. This is the rule
+delivery fee migration 5 priced existing orders with.
+"""
+import math
+from typing import Dict, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371000.0
+EARTH_RADIUS_KM = EARTH_RADIUS_M / 1000
+
+# GasFill Main Station - Accra, Ghana
+STATION_LAT = 5.6037
+STATION_LNG = -0.1870
+
+BASE_DISTANCE_M = 500.0
+BASE_FEE = 10.0  # GHS
+ADDITIONAL_FEE = 2.0  # GHS per additional BASE_DISTANCE_M
+MAX_FEE_SHARE = 0.5  # of the order total
+DEFAULT_DELIVERY_FEE = BASE_FEE
+
+GEOHASH_BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+def fee_parameters() -> Tuple[float, ...]:
+    """Everything a quote depends on besides the customer location and order total"""
+    return (STATION_LAT, STATION_LNG, BASE_DISTANCE_M, BASE_FEE, ADDITIONAL_FEE, MAX_FEE_SHARE)
+
+# Vectorized
+
+def haversine_m(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """Element-wise great-circle distance in metres; inputs broadcast together"""
+    lat1, lng1, lat2, lng2 = (np.radians(np.asarray(x, dtype=float)) for x in (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+def distance_matrix_km(lat1, lng1, lat2, lng2) -> np.ndarray:
+    """Pairwise distances in km between points 1 (rows) and points 2 (columns)"""
+    lat1, lng1 = np.asarray(lat1, dtype=float)[:, None], np.asarray(lng1, dtype=float)[:, None]
+    lat2, lng2 = np.asarray(lat2, dtype=float)[None, :], np.asarray(lng2, dtype=float)[None, :]
+    return haversine_m(lat1, lng1, lat2, lng2) / 1000
+
+def delivery_fees(distance_m, order_total=0.0) -> np.ndarray:
+    """Element-wise delivery fee in GHS; totals <= 0 mean no cap"""
+    distance_m = np.asarray(distance_m, dtype=float)
+    order_total = np.asarray(order_total, dtype=float)
+    steps = np.ceil(np.maximum(distance_m - BASE_DISTANCE_M, 0.0) / BASE_DISTANCE_M)
+    fee = BASE_FEE + steps * ADDITIONAL_FEE
+    fee = np.where(order_total > 0, np.minimum(fee, order_total * MAX_FEE_SHARE), fee)
+    return np.round(fee, 2)
+
+def quote_delivery_fees(lat, lng, order_total=0.0) -> Dict[str, np.ndarray]:
+    """Station distance, fee and uncapped fee for customer locations; inputs broadcast together"""
+    lat, lng, order_total = np.broadcast_arrays(
+        np.asarray(lat, dtype=float), np.asarray(lng, dtype=float), np.asarray(order_total, dtype=float)
+    )
+    distance_m = haversine_m(STATION_LAT, STATION_LNG, lat, lng)
+    return {
+        'distance_m': distance_m,
+        'delivery_fee': delivery_fees(distance_m, order_total),
+        'uncapped_fee': delivery_fees(distance_m),
+    }
+
+# Scalar
+
+def distance_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    """Great-circle distance in metres between two points"""
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(a, 1.0)))
+
+def distance_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    return distance_m(lat1, lng1, lat2, lng2) / 1000
+
+def delivery_fee(distance_meters: float, order_total: float = 0) -> float:
+    """Delivery fee in GHS for one distance; same rule as delivery_fees()"""
+    fee = BASE_FEE + distance_steps(distance_meters) * ADDITIONAL_FEE
+    if order_total and order_total > 0:
+        fee = min(fee, order_total * MAX_FEE_SHARE)
+    return round(fee, 2)
+
+def distance_steps(distance_meters: float) -> int:
+    """Number of ADDITIONAL_FEE steps charged for a distance"""
+    return math.ceil(max(distance_meters - BASE_DISTANCE_M, 0.0) / BASE_DISTANCE_M)
+
+def geohash_cell(lat: float, lng: float, precision: int = 7) -> Tuple[str, Tuple[float, float, float, float]]:
+    """Geohash of a point and its cell bounds (lat_lo, lat_hi, lng_lo, lng_hi)"""
+    lat_lo, lat_hi, lng_lo, lng_hi = -90.0, 90.0, -180.0, 180.0
+    chars = []
+    bits = 0
+    value = 0
+    even = True  # geohash interleaves bits starting with longitude
+    while len(chars) < precision:
+        if even:
+            mid = (lng_lo + lng_hi) / 2
+            if lng >= mid:
+                value = value * 2 + 1
+                lng_lo = mid
+            else:
+                value *= 2
+                lng_hi = mid
+        else:
+            mid = (lat_lo + lat_hi) / 2
+            if lat >= mid:
+                value = value * 2 + 1
+                lat_lo = mid
+            else:
+                value *= 2
+                lat_hi = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            chars.append(GEOHASH_BASE32[value])
+            bits = 0
+            value = 0
+    return ''.join(chars), (lat_lo, lat_hi, lng_lo, lng_hi)
@@ -0,0 +1,117 @@
+"""
+ID Service
+Time-ordered, collision-free IDs for orders, chat messages and ratings.
+
+IDs are snowflake-style integers packed into 53 bits so they survive a round
+trip through JavaScript numbers (the mobile app parses "ORD-<n>"):
+
+    | 41 bits milliseconds since ID_EPOCH | 5 bits worker | 7 bits sequence |
+
+That gives 128 IDs per millisecond per worker and 32 workers for ~69 years.
+Two processes sharing a worker number can mint the same ID, so each process
+either takes a fixed number from GASFILL_WORKER_ID (0-31; the process
+refuses to start on anything else) or, when it is unset, leases a free one
+from the database through worker_lease (db.lease_id_worker). A lease lasts
+WORKER_LEASE_SECONDS and is renewed before IDs are minted past half of it;
+a process that finds its lease taken over leases a new number. Pin every
+process or none: leases do not know about pinned numbers.
+"""
+import os
+import socket
+import threading
+import time
+import uuid
+from typing import Callable, Optional
+
+ID_EPOCH_MS = 1735689600000  # 2025-01-01T00:00:00Z
+WORKER_BITS = 5
+SEQUENCE_BITS = 7
+MAX_WORKER_ID = (1 << WORKER_BITS) - 1
+SEQUENCE_MASK = (1 << SEQUENCE_BITS) - 1
+WORKER_LEASE_SECONDS = 300.0
+
+class IdGenerator:
+    """Monotonic snowflake generator for one worker.
+
+    The critical section is a few integer operations; under the GIL a plain
+    lock around it is cheaper than any retry scheme and keeps IDs strictly
+    increasing even if the wall clock steps backwards.
+    """
+
+    def __init__(self, worker_id: int):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"worker_id must be between 0 and {MAX_WORKER_ID}")
+        self.worker_id = worker_id
+        self._lock = threading.Lock()
+        self._last_ms = -1
+        self._sequence = 0
+
+    def next_id(self) -> int:
+        with self._lock:
+            now_ms = int(time.time() * 1000) - ID_EPOCH_MS
+            if now_ms > self._last_ms:
+                self._last_ms = now_ms
+                self._sequence = 0
+            else:
+                # Same millisecond (or the clock went back): keep counting from the last timestamp
+                self._sequence = (self._sequence + 1) & SEQUENCE_MASK
+                if self._sequence == 0:
+                    # Sequence exhausted; borrow the next millisecond
+                    self._last_ms += 1
+            return (self._last_ms << (WORKER_BITS + SEQUENCE_BITS)) | (self.worker_id << SEQUENCE_BITS) | self._sequence
+
+def _configured_worker_id() -> Optional[int]:
+    configured = os.environ.get('GASFILL_WORKER_ID')
+    if configured is None:
+        return None
+    try:
+        worker_id = int(configured)
+    except ValueError:
+        worker_id = -1
+    if not 0 <= worker_id <= MAX_WORKER_ID:
+        raise ValueError(f"GASFILL_WORKER_ID must be an integer between 0 and {MAX_WORKER_ID}, got {configured!r}")
+    return worker_id
+
+# (owner, worker_id or None, lease seconds) -> leased worker_id; set by db
+worker_lease: Optional[Callable[[str, Optional[int], float], int]] = None
+LEASE_OWNER = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+_pinned_worker_id = _configured_worker_id()
+_generator: Optional[IdGenerator] = IdGenerator(_pinned_worker_id) if _pinned_worker_id is not None else None
+_renew_at = float('inf')
+_lease_lock = threading.Lock()
+
+def _leased_generator() -> IdGenerator:
+    """Lease a worker number, or renew the current one, before minting more IDs"""
+    global _generator, _renew_at
+    with _lease_lock:
+        if _generator is not None and time.monotonic() < _renew_at:
+            return _generator
+        if worker_lease is None:
+            raise RuntimeError("Set GASFILL_WORKER_ID or import db so a worker number can be leased")
+        current = _generator.worker_id if _generator is not None else None
+        worker_id = worker_lease(LEASE_OWNER, current, WORKER_LEASE_SECONDS)
+        if worker_id != current:
+            _generator = IdGenerator(worker_id)
+        _renew_at = time.monotonic() + WORKER_LEASE_SECONDS / 2
+        return _generator
+
+def next_id() -> int:
+    """Next raw ID for this process"""
+    generator = _generator
+    if generator is None or time.monotonic() >= _renew_at:
+        generator = _leased_generator()
+    return generator.next_id()
+
+def new_order_id() -> str:
+    return f"ORD-{next_id()}"
+
+def new_message_id() -> str:
+    return f"msg_{next_id()}"
+
+def new_rating_id() -> str:
+    return f"rating_{next_id()}"
+
+def id_timestamp_ms(raw_id: int) -> int:
+    """Unix milliseconds encoded in a raw ID"""
+    return (raw_id >> (WORKER_BITS + SEQUENCE_BITS)) + ID_EPOCH_MS
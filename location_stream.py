@@ -0,0 +1,242 @@
+"""
+Location Stream
+Ingests rider GPS fixes and decides what gets published and what gets stored.
+
+Riders report a fix every few seconds over HTTP (PUT /api/rider/location) or
+the WebSocket (rider_location_update), whether or not they have moved. Every
+fix used to write the riders table and fan out to subscribers. Now:
+
+1. A fix names the order it is for, but only counts for that order while
+   the rider is assigned to it (checked once and cached until
+   order_changed()); otherwise it is treated as an idle fix, so riders
+   cannot post positions into orders that are not theirs.
+2. Dead-band: a fix is dropped unless the rider moved at least
+   DEADBAND_METERS from the last fix accepted for the same order, or
+   DEADBAND_SECONDS have passed since it (a heartbeat, so a parked rider
+   still looks live).
+3. Accepted fixes update the in-memory rider index immediately, so dispatch
+   always sees the newest position.
+4. Publishing is coalesced per order: every PUBLISH_INTERVAL the latest
+   accepted fix for each order that moved is published once.
+5. Storage is write-behind. The stream holds each rider's latest fix and is
+   the source of truth for reads (position(), location()); every
+   FLUSH_INTERVAL the dirty positions and the new tracking points of
+   assigned orders are group-committed in one transaction. A crash loses at
+   most one flush window, and stop() flushes whatever is left. If a flush
+   fails, its rows are kept for the next one (tracking points up to
+   MAX_PENDING_POINTS, oldest dropped first).
+"""
+import asyncio
+import json
+import time
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Tuple
+
+import db
+import geo
+from rider_index import index as rider_index
+
+DEADBAND_METERS = 10.0
+DEADBAND_SECONDS = 30.0
+PUBLISH_INTERVAL = 2.0
+FLUSH_INTERVAL = 0.25
+MAX_PENDING_POINTS = 50000
+PRUNE_AFTER = 600.0  # forget riders and orders with no accepted fix for this long
+
+# (rider_id, order_id or None for idle fixes, fix)
+PublishCallback = Callable[[int, Optional[str], Dict[str, Any]], Awaitable[None]]
+Track = Tuple[int, Optional[str]]  # (rider_id, order_id); order_id None for idle riders
+Point = Tuple[str, int, Dict[str, Any]]  # (order_id, rider_id, fix)
+
+def coordinates(fix: Dict[str, Any]) -> Optional[Tuple[float, float]]:
+    """(lat, lng) of a fix, or None unless both are numbers within range"""
+    try:
+        lat, lng = float(fix.get("latitude")), float(fix.get("longitude"))
+    except (TypeError, ValueError):
+        return None
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):  # also rejects NaN
+        return None
+    return lat, lng
+
+class _RiderState:
+    __slots__ = ("fix", "accepted_at", "delivering")
+
+    def __init__(self):
+        self.fix: Optional[Dict[str, Any]] = None
+        self.accepted_at = 0.0
+        self.delivering: Dict[str, bool] = {}  # order_id -> rider is assigned (checked once)
+
+class LocationStream:
+    """Dead-band per (rider, order), publish tick per order, group-committed write-behind storage"""
+
+    def __init__(self, on_publish: Optional[PublishCallback] = None):
+        self.on_publish = on_publish
+        self._riders: Dict[int, _RiderState] = {}
+        # Last accepted (lat, lng, time) per track, for the dead-band
+        self._tracks: Dict[Track, Tuple[float, float, float]] = {}
+        self._to_publish: Dict[Track, Dict[str, Any]] = {}
+        # Write-behind buffers, swapped out by each flush
+        self._dirty: Dict[int, Dict[str, Any]] = {}
+        self._points: List[Point] = []
+        self._task: Optional[asyncio.Task] = None
+        self._published_at = time.monotonic()
+        self._pruned_at = time.monotonic()
+        self.received = 0
+        self.accepted = 0
+        self.published = 0
+        self.flushes = 0
+        self.positions_written = 0
+        self.points_written = 0
+        self.points_dropped = 0
+        self.flush_failures = 0
+        self.last_flush_ms: Optional[float] = None
+
+    async def ingest(self, rider_id: int, fix: Dict[str, Any], order_id: Optional[str] = None) -> bool:
+        """Offer a GPS fix ({latitude, longitude, ...}); False if it is invalid or the dead-band dropped it"""
+        self.received += 1
+        point = coordinates(fix)
+        if point is None:
+            return False
+        lat, lng = point
+        now = time.monotonic()
+
+        state = self._riders.get(rider_id)
+        if state is None:
+            state = self._riders[rider_id] = _RiderState()
+        if order_id is not None:
+            if order_id not in state.delivering:
+                order = await db.aio.get_order_by_id(order_id)
+                state.delivering[order_id] = bool(order and order.get("rider_id") == rider_id)
+            if not state.delivering[order_id]:
+                order_id = None  # not this rider's order: no order topic, no tracking trail
+
+        track = (rider_id, order_id)
+        last = self._tracks.get(track)
+        if (last is not None and now - last[2] < DEADBAND_SECONDS
+                and geo.distance_m(last[0], last[1], lat, lng) < DEADBAND_METERS):
+            return False
+        self._tracks[track] = (lat, lng, now)
+        self.accepted += 1
+        rider_index.update(rider_id, lat, lng)
+        # Only the newest fix per track survives until the next tick
+        self._to_publish[track] = fix
+
+        state.fix, state.accepted_at = fix, now
+        self._dirty[rider_id] = fix
+        if order_id is not None:
+            self._points.append((order_id, rider_id, fix))
+        return True
+
+    def order_changed(self, order_id: str) -> None:
+        """Forget who is assigned to an order (call on reassignment and status changes)"""
+        for state in self._riders.values():
+            state.delivering.pop(order_id, None)
+
+    def position(self, rider_id: int) -> Optional[Dict[str, Any]]:
+        """Latest accepted fix for a rider, including ones not yet written"""
+        state = self._riders.get(rider_id)
+        return state.fix if state else None
+
+    def location(self, rider_id: int, stored: Optional[str] = None) -> Optional[str]:
+        """A rider's location as the riders table would hold it once flushed; stored if the stream has none"""
+        fix = self.position(rider_id)
+        return json.dumps(fix) if fix is not None else stored
+
+    def locations(self, rows: Iterable[Tuple[int, Optional[str]]]) -> List[Tuple[int, Optional[str]]]:
+        """(rider_id, location JSON) rows from the riders table with unwritten fixes applied"""
+        return [(rider_id, self.location(rider_id, stored)) for rider_id, stored in rows]
+
+    async def publish(self) -> None:
+        """Publish the newest accepted fix of every track since the last tick"""
+        pending, self._to_publish = self._to_publish, {}
+        self._published_at = time.monotonic()
+        if not self.on_publish:
+            return
+        for (rider_id, order_id), fix in pending.items():
+            try:
+                await self.on_publish(rider_id, order_id, fix)
+                self.published += 1
+            except Exception as e:
+                print(f"Error publishing rider {rider_id} location: {e}")
+
+    async def flush(self) -> None:
+        """Group-commit dirty positions and pending tracking points"""
+        if not self._dirty and not self._points:
+            return
+        positions, self._dirty = self._dirty, {}
+        points, self._points = self._points, []
+        started = time.perf_counter()
+        try:
+            await db.aio.write_rider_locations(positions, points)
+        except Exception as e:
+            self.flush_failures += 1
+            print(f"Error writing {len(positions)} rider locations: {e}")
+            # Fixes that arrived during the failed write are newer
+            for rider_id, fix in positions.items():
+                self._dirty.setdefault(rider_id, fix)
+            self._points = points + self._points
+            overflow = len(self._points) - MAX_PENDING_POINTS
+            if overflow > 0:
+                del self._points[:overflow]
+                self.points_dropped += overflow
+            return
+        self.flushes += 1
+        self.positions_written += len(positions)
+        self.points_written += len(points)
+        self.last_flush_ms = round((time.perf_counter() - started) * 1000, 2)
+
+    def _prune(self, now: float) -> None:
+        stale = now - PRUNE_AFTER
+        for track in [t for t, (_, _, accepted_at) in self._tracks.items() if accepted_at < stale]:
+            del self._tracks[track]
+        for rider_id in [r for r, state in self._riders.items() if r not in self._dirty and state.accepted_at < stale]:
+            del self._riders[rider_id]
+        self._pruned_at = now
+
+    async def run(self) -> None:
+        while True:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            try:
+                now = time.monotonic()
+                if now - self._published_at >= PUBLISH_INTERVAL:
+                    await self.publish()
+                await self.flush()
+                if now - self._pruned_at >= PRUNE_AFTER:
+                    self._prune(now)
+            except Exception as e:
+                print(f"Error in location stream: {e}")
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self.run())
+        print(f"✅ Location stream started (dead-band {DEADBAND_METERS:g}m/{DEADBAND_SECONDS:g}s, "
+              f"publish every {PUBLISH_INTERVAL:g}s, flush every {FLUSH_INTERVAL * 1000:g}ms)")
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.publish()
+        await self.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "riders": len(self._riders),
+            "tracks": len(self._tracks),
+            "received": self.received,
+            "accepted": self.accepted,
+            "published": self.published,
+            "flushes": self.flushes,
+            "positions_written": self.positions_written,
+            "points_written": self.points_written,
+            "pending_positions": len(self._dirty),
+            "pending_points": len(self._points),
+            "points_dropped": self.points_dropped,
+            "flush_failures": self.flush_failures,
+            "last_flush_ms": self.last_flush_ms,
+            "accept_rate": round(self.accepted / self.received, 4) if self.received else None,
+        }
+
+stream = LocationStream()
@@ -4,7 +4,7 @@ GasFill Python Backend Server
 A modern FastAPI server for the GasFill LPG delivery application
 """
 
-from fastapi import FastAPI, HTTPException, Depends, status, Request, File, UploadFile
+from fastapi import FastAPI, HTTPException, Depends, status, Request, Response, File, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
@@ -18,11 +18,22 @@ import secrets
 import hmac
 import requests
 import asyncio
+import numpy as np
 from datetime import datetime, timedelta, UTC
 import json
 import os
 from pathlib import Path
 import db  # Import the database module
+import ids
+from assignment_scheduler import scheduler as assignment_scheduler
+from rider_index import index as rider_index, parse_location
+from fee_quotes import cache as fee_quote_cache
+from location_stream import stream as location_stream, coordinates as location_coordinates
+import batch_dispatch
+import geo
+import realtime
+import ws_codec
+from query_advisor import advisor as query_advisor
 
 # Configuration
 SECRET_KEY = "gasfill_super_secret_key_2025"
@@ -82,6 +93,18 @@ def safe_parse_date(date_string: str) -> Optional[datetime]:
     parsed_dt = safe_parse_datetime(date_string)
     return parsed_dt.date() if parsed_dt else None
 
+def encode_cursor(position) -> str:
+    """Encode a keyset position (sort value, id) as an opaque pagination cursor"""
+    sort_value, row_id = position
+    return f"{sort_value or ''}|{row_id}"
+
+def decode_cursor(cursor: str):
+    """Decode a cursor produced by encode_cursor"""
+    sort_value, sep, row_id = cursor.rpartition("|")
+    if not sep:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return (sort_value, row_id)
+
 # Serve HTML files at root
 @app.get("/admin.html")
 async def serve_admin_html():
@@ -131,7 +154,6 @@ users_db: Dict[str, Dict] = {}
 orders_db: List[Dict] = []
 services_db: List[Dict] = []
 riders_db: Dict[str, Dict] = {}  # Rider database
-order_counter = 1
 service_counter = 1
 rider_counter = 1
 
@@ -217,6 +239,11 @@ class OrderCreate(BaseModel):
     total: float
     delivery_type: Optional[str] = "standard"
 
+class FeeQuoteBatch(BaseModel):
+    locations: List[Dict[str, Any]]  # {lat, lng} or {latitude, longitude}
+    order_totals: Optional[List[float]] = None
+    order_total: float = 0  # used for every location when order_totals is omitted
+
 class OrderStatusUpdate(BaseModel):
     status: str
 
@@ -317,23 +344,7 @@ def calculate_distance(lat1: float, lng1: float, lat2: float, lng2: float) -> fl
     Calculate distance between two coordinates using Haversine formula
     Returns distance in meters
     """
-    from math import radians, sin, cos, sqrt, atan2
-    
-    # Earth's radius in meters
-    R = 6371000
-    
-    # Convert to radians
-    lat1_rad = radians(lat1)
-    lat2_rad = radians(lat2)
-    delta_lat = radians(lat2 - lat1)
-    delta_lng = radians(lng2 - lng1)
-    
-    # Haversine formula
-    a = sin(delta_lat / 2) ** 2 + cos(lat1_rad) * cos(lat2_rad) * sin(delta_lng / 2) ** 2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    distance = R * c
-    
-    return distance
+    return geo.distance_m(lat1, lng1, lat2, lng2)
 
 def calculate_delivery_fee(distance_meters: float, order_total: float = 0) -> float:
     """
@@ -342,32 +353,9 @@ def calculate_delivery_fee(distance_meters: float, order_total: float = 0) -> fl
     Additional: 2 GHS per additional 500 meters
     Maximum: 50% of order total (gas price cap)
     
-    Args:
-        distance_meters: Distance from customer location to gas station in meters
-        order_total: Total value of gas order (to apply 50% cap)
-    
-    Returns:
-        Delivery fee in GHS, capped at 50% of order total
+    See geo.delivery_fees() for the vectorized version used by batch quotes.
     """
-    BASE_DISTANCE = 500  # meters
-    BASE_FEE = 10.0  # GHS
-    ADDITIONAL_FEE_PER_500M = 2.0  # GHS
-    MAX_FEE_PERCENTAGE = 0.5  # 50% of order total
-    
-    if distance_meters <= BASE_DISTANCE:
-        calculated_fee = BASE_FEE
-    else:
-        # Calculate additional 500m increments
-        additional_distance = distance_meters - BASE_DISTANCE
-        additional_increments = (additional_distance + BASE_DISTANCE - 1) // BASE_DISTANCE  # Ceiling division
-        calculated_fee = BASE_FEE + (additional_increments * ADDITIONAL_FEE_PER_500M)
-    
-    # Apply 50% cap based on order total
-    if order_total > 0:
-        max_fee = order_total * MAX_FEE_PERCENTAGE
-        calculated_fee = min(calculated_fee, max_fee)
-    
-    return round(calculated_fee, 2)
+    return geo.delivery_fee(distance_meters, order_total)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     """Create JWT access token"""
@@ -510,7 +498,7 @@ async def health_check():
 async def register_user(user_data: UserRegister):
     """Register a new user"""
     # Check if user already exists
-    existing_user = db.get_user_by_email(user_data.email)
+    existing_user = await db.aio.get_user_by_email(user_data.email)
     if existing_user:
         raise HTTPException(
             status_code=400,
@@ -520,7 +508,7 @@ async def register_user(user_data: UserRegister):
     # Create new user in database
     hashed_password = hash_password(user_data.password)
     
-    user = db.create_user({
+    user = await db.aio.create_user({
         "username": user_data.username,
         "email": user_data.email,
         "password": hashed_password,
@@ -557,7 +545,7 @@ async def login_user(login_data: dict):
     if not email or not password:
         raise HTTPException(status_code=400, detail="Email and password required")
     
-    user = db.get_user_by_email(email)
+    user = await db.aio.get_user_by_email(email)
     
     if not user:
         raise HTTPException(
@@ -599,7 +587,7 @@ async def admin_login(admin_data: AdminLogin):
             detail="Invalid admin key"
         )
     
-    user = db.get_user_by_email(admin_data.email)
+    user = await db.aio.get_user_by_email(admin_data.email)
     
     if not user or not verify_password(admin_data.password, user["password"]):
         raise HTTPException(
@@ -671,7 +659,7 @@ async def list_all_users():
 async def rider_register(rider_data: RiderRegister):
     """Register a new rider"""
     # Check if rider already exists
-    existing_rider = db.get_rider_by_email(rider_data.email)
+    existing_rider = await db.aio.get_rider_by_email(rider_data.email)
     if existing_rider:
         raise HTTPException(
             status_code=400,
@@ -682,7 +670,7 @@ async def rider_register(rider_data: RiderRegister):
     hashed_password = hash_password(rider_data.password)
     
     # Create rider record in database
-    rider = db.create_rider({
+    rider = await db.aio.create_rider({
         "username": rider_data.username,
         "email": rider_data.email,
         "password": hashed_password,
@@ -729,7 +717,7 @@ async def rider_register(rider_data: RiderRegister):
 @app.post("/api/auth/rider-login")
 async def rider_login(rider_data: RiderLogin):
     """Rider login"""
-    rider = db.get_rider_by_email(rider_data.email)
+    rider = await db.aio.get_rider_by_email(rider_data.email)
     
     if not rider or not verify_password(rider_data.password, rider["password"]):
         raise HTTPException(
@@ -790,8 +778,6 @@ async def get_current_user_info(current_user: dict = Depends(get_current_user)):
 @app.post("/api/orders", status_code=status.HTTP_201_CREATED)
 async def create_order(order_data: OrderCreate):
     """Create a new order"""
-    global order_counter
-    
     print(f"📦 Creating order with data:")
     print(f"  - customer_name: {order_data.customer_name}")
     print(f"  - customer_address: {order_data.customer_address}")
@@ -803,16 +789,12 @@ async def create_order(order_data: OrderCreate):
     delivery_fee = 10.0  # Default delivery fee
     
     if order_data.customer_location:
-        # Gas Station/Depot location (GasFill Main Station - Accra, Ghana)
-        station_lat = 5.6037
-        station_lng = -0.1870
-        
         customer_lat = order_data.customer_location.get("lat")
         customer_lng = order_data.customer_location.get("lng")
         
         if customer_lat and customer_lng:
             # Calculate distance in meters from gas station to customer
-            distance_meters = calculate_distance(station_lat, station_lng, customer_lat, customer_lng)
+            distance_meters = calculate_distance(geo.STATION_LAT, geo.STATION_LNG, customer_lat, customer_lng)
             
             # Calculate delivery fee based on distance, capped at 50% of order total
             delivery_fee = calculate_delivery_fee(distance_meters, order_data.total)
@@ -821,7 +803,7 @@ async def create_order(order_data: OrderCreate):
             print(f"💰 Calculated delivery fee: ₵{delivery_fee} (max 50% of ₵{order_data.total})")
     
     order = {
-        "id": f"ORD-{order_counter}",
+        "id": ids.new_order_id(),
         "items": [item.model_dump() for item in order_data.items],
         "customer_name": order_data.customer_name or "Anonymous",
         "customer_phone": order_data.customer_phone or "",
@@ -840,14 +822,12 @@ async def create_order(order_data: OrderCreate):
     print(f"💾 Saving order with customer_location: {order['customer_location']}")
     
     # Save to database
-    result = db.create_order(order)
+    result = await db.aio.create_order(order)
     
     print(f"✅ Order created: {result.get('id')}")
     print(f"✅ Returned customer_location: {result.get('customer_location')}")
     print(f"✅ Delivery fee: ₵{result.get('delivery_fee')}")
     
-    order_counter += 1
-    
     return result
 
 @app.post("/api/orders/calculate-fee")
@@ -862,10 +842,6 @@ async def calculate_order_delivery_fee(location_data: dict):
         }
     """
     try:
-        # Gas Station/Depot location (GasFill Main Station - Accra, Ghana)
-        station_lat = 5.6037
-        station_lng = -0.1870
-        
         customer_lat = location_data.get("lat")
         customer_lng = location_data.get("lng")
         order_total = location_data.get("order_total", 0)  # Get order total for 50% cap
@@ -877,18 +853,16 @@ async def calculate_order_delivery_fee(location_data: dict):
                 "message": "Using default fee - location not provided"
             }
         
-        # Calculate distance in meters from gas station to customer
-        distance_meters = calculate_distance(station_lat, station_lng, customer_lat, customer_lng)
-        
-        # Calculate delivery fee based on distance, capped at 50% of order total
-        delivery_fee = calculate_delivery_fee(distance_meters, order_total)
-        
-        # Calculate what the fee would be without cap for transparency
-        uncapped_fee = calculate_delivery_fee(distance_meters, 0)
+        # Quotes repeat as the pin moves; the cache returns the exact fee for the cell
+        quote = fee_quote_cache.quote(float(customer_lat), float(customer_lng), order_total)
+        delivery_fee = quote["delivery_fee"]
+        distance_meters = quote["distance_meters"]
+        uncapped_fee = quote["uncapped_fee"]
         was_capped = uncapped_fee != delivery_fee
         
-        print(f"📍 Fee calculation: Distance {distance_meters:.2f}m ({distance_meters/1000:.2f}km)")
-        print(f"💰 Delivery fee: ₵{delivery_fee}" + (f" (capped from ₵{uncapped_fee})" if was_capped else ""))
+        if not quote["cached"]:
+            print(f"📍 Fee calculation: Distance {distance_meters:.2f}m ({distance_meters/1000:.2f}km), "
+                  f"fee ₵{delivery_fee}" + (f" (capped from ₵{uncapped_fee})" if was_capped else ""))
         
         return {
             "delivery_fee": delivery_fee,
@@ -912,6 +886,52 @@ async def calculate_order_delivery_fee(location_data: dict):
             "error": str(e)
         }
 
+MAX_FEE_QUOTES = 10000
+
+@app.post("/api/orders/calculate-fee/batch")
+async def calculate_delivery_fees_batch(quote_data: FeeQuoteBatch):
+    """Quote delivery fees for many locations and/or order totals in one request
+    
+    locations and order_totals are paired element-wise; a single location or
+    total is applied to every entry of the other list.
+    """
+    locations = quote_data.locations
+    totals = quote_data.order_totals if quote_data.order_totals is not None else [quote_data.order_total]
+    if not locations:
+        raise HTTPException(status_code=400, detail="At least one location is required")
+    if len(locations) != len(totals) and 1 not in (len(locations), len(totals)):
+        raise HTTPException(
+            status_code=400,
+            detail="locations and order_totals must have the same length, or one of them a single entry"
+        )
+    if max(len(locations), len(totals)) > MAX_FEE_QUOTES:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_FEE_QUOTES} quotes per request")
+    
+    points = [parse_location(location) for location in locations]
+    located = np.array([p is not None for p in points])
+    lat = np.array([p['lat'] if p else geo.STATION_LAT for p in points])
+    lng = np.array([p['lng'] if p else geo.STATION_LNG for p in points])
+    quotes = geo.quote_delivery_fees(lat, lng, np.array(totals, dtype=float))
+    located = np.broadcast_to(located, quotes['delivery_fee'].shape)
+    
+    # Locations without coordinates get the default fee, like /api/orders/calculate-fee
+    fees = np.where(located, quotes['delivery_fee'], geo.DEFAULT_DELIVERY_FEE)
+    distance_m = np.where(located, quotes['distance_m'], 0.0)
+    capped = located & (quotes['delivery_fee'] != quotes['uncapped_fee'])
+    
+    return {
+        "count": int(fees.size),
+        "quotes": [
+            {
+                "delivery_fee": float(fee),
+                "distance_meters": round(float(meters), 2),
+                "distance_km": round(float(meters) / 1000, 2),
+                "capped": bool(was_capped)
+            }
+            for fee, meters, was_capped in zip(fees, distance_m, capped)
+        ]
+    }
+
 @app.get("/api/map/locations")
 async def get_map_locations():
     """
@@ -936,31 +956,12 @@ async def get_map_locations():
         ]
         
         # Get all available riders with their current locations
-        conn = db.get_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute("""
-            SELECT 
-                r.id,
-                r.username,
-                r.phone,
-                r.rating,
-                r.status,
-                r.current_location,
-                r.is_verified,
-                COUNT(DISTINCT o.id) as total_deliveries
-            FROM riders r
-            LEFT JOIN orders o ON o.rider_id = r.id AND o.status = 'delivered'
-            WHERE r.status = 'available' AND r.is_verified = 1
-            GROUP BY r.id
-        """)
-        
-        riders_data = cursor.fetchall()
-        conn.close()
+        riders_data = await db.aio.get_available_riders_for_map()
         
         available_riders = []
         for rider in riders_data:
             rider_id, username, phone, rating, status, current_location, is_verified, total_deliveries = rider
+            current_location = location_stream.location(rider_id, current_location)
             
             # Parse current_location if it exists
             location = None
@@ -1029,20 +1030,20 @@ async def get_map_locations():
 async def get_orders(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get all orders or customer's orders if authenticated"""
     # Try to get current user
-    user = get_current_user(credentials)
+    user = await db.run_blocking(get_current_user, credentials)
     
     # If user is authenticated and not admin, return only their orders
     if user and not is_admin(user):
-        customer_orders = db.get_orders_for_customer(user.get("email"))
+        customer_orders = await db.aio.get_orders_for_customer(user.get("email"))
         return customer_orders
     
     # If not authenticated or is admin, return all orders
-    return db.get_all_orders()
+    return await db.aio.get_all_orders()
 
 @app.get("/api/customer/orders")
 async def get_customer_orders(credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get customer's orders with rider information (requires authentication)"""
-    current_user = get_current_user(credentials)
+    current_user = await db.run_blocking(get_current_user, credentials)
     
     if not current_user:
         raise HTTPException(
@@ -1051,7 +1052,7 @@ async def get_customer_orders(credentials: HTTPAuthorizationCredentials = Depend
         )
     
     customer_email = current_user.get("email")
-    customer_orders = db.get_orders_for_customer(customer_email)
+    customer_orders = await db.aio.get_orders_for_customer(customer_email)
     
     # Enrich orders with rider information
     enriched_orders = []
@@ -1061,7 +1062,7 @@ async def get_customer_orders(credentials: HTTPAuthorizationCredentials = Depend
         # Add rider info if order has a rider assigned
         rider_id = order.get("rider_id")
         if rider_id:
-            rider = db.get_rider_by_id(rider_id)
+            rider = await db.aio.get_rider_by_id(rider_id)
             if rider:
                 enriched_order["rider_name"] = rider.get("username")
                 enriched_order["rider_phone"] = rider.get("phone")
@@ -1074,7 +1075,7 @@ async def get_customer_orders(credentials: HTTPAuthorizationCredentials = Depend
 @app.get("/api/orders/{order_id}")
 async def get_order(order_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
     """Get a specific order by ID (with permission check)"""
-    order = db.get_order_by_id(order_id)
+    order = await db.aio.get_order_by_id(order_id, include_events=True)
     
     if not order:
         raise HTTPException(
@@ -1083,7 +1084,7 @@ async def get_order(order_id: str, credentials: HTTPAuthorizationCredentials = D
         )
     
     # Check permissions - allow if user is admin or owns the order
-    user = get_current_user(credentials)
+    user = await db.run_blocking(get_current_user, credentials)
     if user:
         if is_admin(user):
             return order
@@ -1101,7 +1102,8 @@ async def get_order(order_id: str, credentials: HTTPAuthorizationCredentials = D
 @app.patch("/api/orders/{order_id}/status")
 async def update_order_status(order_id: str, status_update: OrderStatusUpdate):
     """Update order status and send push notification"""
-    order = db.update_order_status(order_id, status_update.status)
+    order = await db.aio.update_order_status(order_id, status_update.status)
+    location_stream.order_changed(order_id)
     
     if not order:
         raise HTTPException(
@@ -1117,15 +1119,17 @@ async def update_order_status(order_id: str, status_update: OrderStatusUpdate):
             "status": status_update.status,
             "timestamp": utc_now().isoformat()
         }
-        await manager.broadcast(json.dumps(status_notification))
-        print(f"✅ Broadcasted order status update: {order_id} -> {status_update.status}")
+        await manager.publish(
+            [realtime.order_topic(order_id), realtime.ADMIN_TOPIC], status_notification
+        )
+        print(f"✅ Published order status update: {order_id} -> {status_update.status}")
     except Exception as e:
         print(f"⚠️ Failed to broadcast status update: {e}")
     
     # Send push notification to customer about status change
     try:
         # Get customer user ID from email
-        customer = db.get_user_by_email(order["customer_email"])
+        customer = await db.aio.get_user_by_email(order["customer_email"])
         if customer:
             status_messages = {
                 "pending": "Your order has been received and is being processed",
@@ -1162,7 +1166,7 @@ async def update_order_status(order_id: str, status_update: OrderStatusUpdate):
 @app.patch("/api/orders/{order_id}/location")
 async def update_order_location(order_id: str, location_data: dict):
     """Update order delivery location"""
-    order = db.get_order_by_id(order_id)
+    order = await db.aio.get_order_by_id(order_id)
     
     if not order:
         raise HTTPException(
@@ -1189,26 +1193,7 @@ async def update_order_location(order_id: str, location_data: dict):
     print(f"📍 Updating location for order {order_id}: {customer_location}")
     
     # Update order in database
-    import sqlite3
-    conn = sqlite3.connect(db.DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
-    
-    # Convert location to JSON string for storage
-    location_json = json.dumps(customer_location)
-    
-    cur.execute(
-        'UPDATE orders SET customer_location=?, updated_at=? WHERE id=?',
-        (location_json, utc_now().isoformat(), order_id)
-    )
-    conn.commit()
-    
-    # Fetch updated order
-    cur.execute('SELECT * FROM orders WHERE id=?', (order_id,))
-    row = cur.fetchone()
-    conn.close()
-    
-    updated_order = db._row_to_order(row) if row else None
+    updated_order = await db.aio.update_order_customer_location(order_id, customer_location)
     
     print(f"✅ Location updated successfully for order {order_id}")
     
@@ -1217,13 +1202,13 @@ async def update_order_location(order_id: str, location_data: dict):
 @app.delete("/api/orders/{order_id}")
 async def delete_order(order_id: str):
     """Delete an order"""
-    db.delete_order(order_id)
+    await db.aio.delete_order(order_id)
     return {"message": "Order deleted successfully"}
 
 @app.get("/api/order/tracking/{order_id}")
 async def get_order_tracking(order_id: str):
     """Get real-time order tracking information"""
-    order = db.get_order_by_id(order_id)
+    order = await db.aio.get_order_by_id(order_id, include_events=True)
     
     if not order:
         raise HTTPException(
@@ -1235,9 +1220,10 @@ async def get_order_tracking(order_id: str):
     rider_info = None
     rider_location = None
     if order.get("rider_id"):
-        rider = db.get_rider_by_id(order["rider_id"])
+        rider = await db.aio.get_rider_by_id(order["rider_id"])
         if rider:
-            # Parse rider location if it exists
+            # Parse rider location if it exists (the location stream has fixes not yet written)
+            rider["location"] = location_stream.location(rider["id"], rider.get("location"))
             rider_loc_data = rider.get("location")
             if rider_loc_data:
                 if isinstance(rider_loc_data, str):
@@ -1264,13 +1250,13 @@ async def get_order_tracking(order_id: str):
             }
     
     # Get status history from order (if exists) or create from current status
-    status_history = order.get("status_history", [
+    status_history = order.get("status_history") or [
         {
             "status": order["status"],
             "timestamp": order.get("updated_at", order["created_at"]),
             "note": "Current status"
         }
-    ])
+    ]
     
     # Parse customer location from order
     customer_location = None
@@ -1364,61 +1350,26 @@ async def update_rider_location(
         "accuracy": location_data.get("accuracy"),
         "timestamp": utc_now().isoformat()
     }
+    point = location_coordinates(location)
+    if point is None:
+        raise HTTPException(status_code=400, detail="latitude and longitude must be numbers within range")
+    location["latitude"], location["longitude"] = point
     
-    # Update rider location using raw SQL
-    import sqlite3
-    conn = sqlite3.connect(db.DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        UPDATE riders 
-        SET location = ?, updated_at = ?
-        WHERE id = ?
-    """, (json.dumps(location), utc_now().isoformat(), rider_id))
-    conn.commit()
-    conn.close()
-    
-    # If rider has an active order, add tracking update
-    active_order_id = location_data.get("order_id")
-    if active_order_id:
-        order = db.get_order_by_id(active_order_id)
-        if order and order.get("rider_id") == rider_id:
-            # Get existing tracking updates
-            tracking_updates = order.get("tracking_updates", [])
-            if isinstance(tracking_updates, str):
-                try:
-                    tracking_updates = json.loads(tracking_updates)
-                except:
-                    tracking_updates = []
-            
-            # Add new location update
-            tracking_updates.append({
-                "latitude": location["latitude"],
-                "longitude": location["longitude"],
-                "timestamp": location["timestamp"],
-                "accuracy": location.get("accuracy")
-            })
-            
-            # Keep only last 50 updates to avoid bloat
-            if len(tracking_updates) > 50:
-                tracking_updates = tracking_updates[-50:]
-            
-            # Update order with new tracking data
-            conn = sqlite3.connect(db.DB_PATH)
-            cur = conn.cursor()
-            cur.execute("""
-                UPDATE orders 
-                SET tracking_updates = ?
-                WHERE id = ?
-            """, (json.dumps(tracking_updates), active_order_id))
-            conn.commit()
-            conn.close()
+    # Dead-banded, then published on the stream's tick and written behind (with the active order's tracking trail)
+    accepted = await location_stream.ingest(rider_id, location, location_data.get("order_id"))
     
     return {
         "success": True,
         "location": location,
-        "message": "Location updated successfully"
+        "accepted": accepted,
+        "message": "Location updated successfully" if accepted else "Location unchanged"
     }
 
+@app.get("/api/admin/location-stream")
+async def get_location_stream_stats(current_admin: dict = Depends(get_current_admin)):
+    """Rider GPS fix counters and the write-behind backlog"""
+    return location_stream.stats()
+
 @app.post("/api/orders/{order_id}/rating")
 async def rate_order(
     order_id: str,
@@ -1426,7 +1377,7 @@ async def rate_order(
     current_user: dict = Depends(get_current_user)
 ):
     """Submit rating for a completed order"""
-    order = db.get_order_by_id(order_id)
+    order = await db.aio.get_order_by_id(order_id)
     
     if not order:
         raise HTTPException(
@@ -1457,11 +1408,6 @@ async def rate_order(
             detail="Rating must be between 1 and 5"
         )
     
-    # Update order with rating
-    import sqlite3
-    conn = sqlite3.connect(db.DB_PATH)
-    cur = conn.cursor()
-    
     rating_info = {
         "rating": rating,
         "comment": comment,
@@ -1469,35 +1415,8 @@ async def rate_order(
         "rated_by": current_user.get("id")
     }
     
-    cur.execute("""
-        UPDATE orders 
-        SET rating = ?, rating_comment = ?, rated_at = ?
-        WHERE id = ?
-    """, (rating, comment, rating_info["rated_at"], order_id))
-    
-    # Update rider's average rating if rider exists
-    if order.get("rider_id"):
-        rider = db.get_rider_by_id(order["rider_id"])
-        if rider:
-            # Get all ratings for this rider
-            cur.execute("""
-                SELECT rating FROM orders 
-                WHERE rider_id = ? AND rating IS NOT NULL
-            """, (order["rider_id"],))
-            
-            ratings = cur.fetchall()
-            if ratings:
-                avg_rating = sum(r[0] for r in ratings) / len(ratings)
-                
-                # Update rider's rating
-                cur.execute("""
-                    UPDATE riders 
-                    SET rating = ?, total_deliveries = ?
-                    WHERE id = ?
-                """, (avg_rating, len(ratings), order["rider_id"]))
-    
-    conn.commit()
-    conn.close()
+    # Store the rating on the order; rider averages come from /api/ratings
+    await db.aio.rate_order(order_id, rating, comment, rating_info["rated_at"])
     
     return {
         "success": True,
@@ -1508,17 +1427,18 @@ async def rate_order(
 @app.get("/api/stats")
 async def get_stats():
     """Get application statistics"""
-    all_orders = db.get_all_orders()
-    total_orders = len(all_orders)
-    pending_orders = len([o for o in all_orders if o["status"] in ["pending", "accepted", "assigned"]])
-    total_revenue = sum(order["total"] for order in all_orders if order["status"] == "delivered")
+    order_stats = await db.aio.summarize_orders()
+    total_orders = sum(s["count"] for s in order_stats.values())
+    pending_orders = sum(order_stats.get(s, {}).get("count", 0) for s in ["pending", "accepted", "assigned"])
+    total_revenue = order_stats.get("delivered", {}).get("total", 0)
+    recent_orders = await db.aio.query_orders(limit=5)
     
     return {
         "totalOrders": total_orders,
         "pendingOrders": pending_orders,
         "totalRevenue": total_revenue,
         "totalUsers": len(users_db),
-        "recentOrders": all_orders[:5]  # Last 5 orders
+        "recentOrders": recent_orders  # Last 5 orders
     }
 
 # Service Management Endpoints
@@ -2066,22 +1986,20 @@ async def get_service_assignments(current_admin: dict = Depends(get_current_admi
 @app.get("/api/admin/dashboard")
 async def get_admin_dashboard(current_admin: dict = Depends(get_current_admin)):
     """Get admin dashboard overview"""
-    all_orders = db.get_all_orders()
-    all_users = db.get_all_users()
+    order_stats = await db.aio.summarize_orders()
+    month_start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    monthly_stats = await db.aio.summarize_orders(status="delivered", created_after=month_start.isoformat())
+    all_users = await db.aio.get_all_users()
     total_users = len(all_users)
-    total_orders = len(all_orders)
+    total_orders = sum(s["count"] for s in order_stats.values())
     total_services = len(services_db)
     active_users = len([u for u in all_users if u.get("is_active", True)])
-    pending_orders = len([o for o in all_orders if o["status"] == "pending"])
+    pending_orders = order_stats.get("pending", {}).get("count", 0)
     pending_services = len([s for s in services_db if s["status"] == "pending"])
     
     # Calculate revenue
-    total_revenue = sum(order["total"] for order in all_orders if order["status"] == "delivered")
-    monthly_revenue = sum(
-        order["total"] for order in all_orders 
-        if order["status"] == "delivered" and 
-        datetime.fromisoformat(order["created_at"]).month == datetime.now().month
-    )
+    total_revenue = order_stats.get("delivered", {}).get("total", 0)
+    monthly_revenue = monthly_stats.get("delivered", {}).get("total", 0)
     
     return {
         "users": {
@@ -2093,7 +2011,7 @@ async def get_admin_dashboard(current_admin: dict = Depends(get_current_admin)):
         "orders": {
             "total": total_orders,
             "pending": pending_orders,
-            "completed": len([o for o in all_orders if o["status"] == "delivered"])
+            "completed": order_stats.get("delivered", {}).get("count", 0)
         },
         "services": {
             "total": total_services,
@@ -2113,13 +2031,13 @@ async def get_admin_dashboard(current_admin: dict = Depends(get_current_admin)):
 @app.get("/api/admin/users")
 async def get_all_users(current_admin: dict = Depends(get_current_admin)):
     """Get all users for admin dashboard"""
-    users = db.get_all_users()
-    all_orders = db.get_all_orders()
+    users = await db.aio.get_all_users()
+    orders_by_customer = await db.aio.summarize_orders(group_by="customer_email")
     
     users_list = []
     for user in users:
         # Count user's orders and services
-        user_orders = len([o for o in all_orders if o.get("customer_email") == user["email"]])
+        user_orders = orders_by_customer.get(user["email"], {}).get("count", 0)
         user_services = len([s for s in services_db if s.get("customer_email") == user["email"]])
         
         users_list.append({
@@ -2139,7 +2057,33 @@ async def get_all_users(current_admin: dict = Depends(get_current_admin)):
 @app.get("/api/admin/orders")
 async def get_all_orders(current_admin: dict = Depends(get_current_admin)):
     """Get all orders for admin dashboard"""
-    return db.get_all_orders()
+    return await db.aio.get_all_orders()
+
+@app.get("/api/admin/query-advisor")
+async def get_query_advisor_report(current_admin: dict = Depends(get_current_admin)):
+    """Query plans for every recorded query shape, full table scans first"""
+    results = await db.run_blocking(query_advisor.report)
+    return {
+        "recording": query_advisor.recording,
+        "total_shapes": len(results),
+        "full_scan_count": len([r for r in results if r["full_scans"]]),
+        "queries": results
+    }
+
+@app.post("/api/admin/query-advisor/start")
+async def start_query_advisor(reset: bool = True, current_admin: dict = Depends(get_current_admin)):
+    """Start recording the queries issued by db.py"""
+    if reset:
+        query_advisor.reset()
+    query_advisor.start()
+    print("🔍 Query advisor recording started")
+    return {"success": True, "recording": True}
+
+@app.post("/api/admin/query-advisor/stop")
+async def stop_query_advisor(current_admin: dict = Depends(get_current_admin)):
+    """Stop recording queries; recorded shapes stay available for the report"""
+    query_advisor.stop()
+    return {"success": True, "recording": False}
 
 @app.get("/api/admin/services")
 async def get_all_services(current_admin: dict = Depends(get_current_admin)):
@@ -2149,13 +2093,13 @@ async def get_all_services(current_admin: dict = Depends(get_current_admin)):
 @app.get("/api/admin/riders")
 async def get_all_riders(current_admin: dict = Depends(get_current_admin)):
     """Get all riders for admin dashboard"""
-    riders = db.get_all_riders()
-    all_orders = db.get_all_orders()
+    riders = await db.aio.get_all_riders()
+    deliveries_by_rider = await db.aio.summarize_orders(group_by="rider_id", status="delivered")
     
     riders_list = []
     for rider in riders:
         # Count rider's deliveries
-        rider_deliveries = len([o for o in all_orders if o.get("rider_id") == rider.get("id") and o.get("status") == "delivered"])
+        rider_deliveries = deliveries_by_rider.get(rider.get("id"), {}).get("count", 0)
         
         riders_list.append({
             "id": rider.get("id"),
@@ -2186,7 +2130,7 @@ async def get_all_riders(current_admin: dict = Depends(get_current_admin)):
 @app.post("/api/admin/riders/{rider_id}/verify")
 async def verify_rider(rider_id: int, verification_data: dict, current_admin: dict = Depends(get_current_admin)):
     """Verify rider documents and approve for deliveries"""
-    rider = db.get_rider_by_id(rider_id)
+    rider = await db.aio.get_rider_by_id(rider_id)
     
     if not rider:
         raise HTTPException(status_code=404, detail="Rider not found")
@@ -2196,14 +2140,14 @@ async def verify_rider(rider_id: int, verification_data: dict, current_admin: di
     document_status = "approved" if is_verified else "rejected"
     
     # Update rider verification status
-    db.update_rider(rider_id, {
+    await db.aio.update_rider(rider_id, {
         "is_verified": is_verified,
         "verification_date": utc_now().isoformat(),
         "verification_notes": notes,
         "document_status": document_status
     })
     
-    updated_rider = db.get_rider_by_id(rider_id)
+    updated_rider = await db.aio.get_rider_by_id(rider_id)
     
     # Send WebSocket notification to rider
     try:
@@ -2218,7 +2162,7 @@ async def verify_rider(rider_id: int, verification_data: dict, current_admin: di
             "message": f"Your account has been {'approved' if is_verified else 'rejected'}",
             "title": "Verification Status Update"
         }
-        await manager.broadcast(json.dumps(notification_message))
+        await manager.publish(realtime.rider_topic(rider_id), notification_message)
         print(f"✅ Sent verification notification to rider {rider_id}")
     except Exception as e:
         print(f"⚠️ Failed to send WebSocket notification: {e}")
@@ -2237,7 +2181,7 @@ async def verify_rider(rider_id: int, verification_data: dict, current_admin: di
 @app.post("/api/admin/riders/{rider_id}/suspend")
 async def suspend_rider(rider_id: int, suspension_data: dict, current_admin: dict = Depends(get_current_admin)):
     """Suspend or reactivate rider account"""
-    rider = db.get_rider_by_id(rider_id)
+    rider = await db.aio.get_rider_by_id(rider_id)
     
     if not rider:
         raise HTTPException(status_code=404, detail="Rider not found")
@@ -2245,7 +2189,7 @@ async def suspend_rider(rider_id: int, suspension_data: dict, current_admin: dic
     is_suspended = suspension_data.get("is_suspended", True)
     
     # Update rider suspension status
-    db.update_rider(rider_id, {
+    await db.aio.update_rider(rider_id, {
         "is_suspended": is_suspended,
         "is_active": not is_suspended,
         "status": "suspended" if is_suspended else "available",
@@ -2253,7 +2197,7 @@ async def suspend_rider(rider_id: int, suspension_data: dict, current_admin: dic
         "suspension_reason": suspension_data.get("reason", "No reason provided") if is_suspended else None
     })
     
-    updated_rider = db.get_rider_by_id(rider_id)
+    updated_rider = await db.aio.get_rider_by_id(rider_id)
     
     return {
         "message": f"Rider {'suspended' if is_suspended else 'reactivated'} successfully",
@@ -2269,7 +2213,7 @@ async def suspend_rider(rider_id: int, suspension_data: dict, current_admin: dic
 @app.get("/api/admin/riders/{rider_id}/earnings")
 async def get_rider_earnings(rider_id: int, current_admin: dict = Depends(get_current_admin)):
     """Get detailed rider earnings breakdown"""
-    rider = db.get_rider_by_id(rider_id)
+    rider = await db.aio.get_rider_by_id(rider_id)
     
     if not rider:
         raise HTTPException(status_code=404, detail="Rider not found")
@@ -2350,14 +2294,13 @@ async def get_rider_earnings(rider_id: int, current_admin: dict = Depends(get_cu
 @app.get("/api/admin/riders/{rider_id}/performance")
 async def get_rider_performance(rider_id: int, current_admin: dict = Depends(get_current_admin)):
     """Get rider performance metrics and ratings"""
-    rider = db.get_rider_by_id(rider_id)
+    rider = await db.aio.get_rider_by_id(rider_id)
     
     if not rider:
         raise HTTPException(status_code=404, detail="Rider not found")
     
     # Get all orders (delivered and others)
-    all_orders_db = db.get_all_orders()
-    all_orders = [o for o in all_orders_db if o.get("rider_id") == rider_id]
+    all_orders = await db.aio.query_orders(rider_id=rider_id)
     delivered_orders = [o for o in all_orders if o.get("status") == "delivered"]
     cancelled_orders = [o for o in all_orders if o.get("status") == "cancelled"]
     
@@ -2410,7 +2353,7 @@ async def get_rider_performance(rider_id: int, current_admin: dict = Depends(get
 @app.patch("/api/admin/users/{user_id}/status")
 async def update_user_status(user_id: int, status_data: dict, current_admin: dict = Depends(get_current_admin)):
     """Update user status (activate/deactivate)"""
-    user = db.get_user_by_id(user_id)
+    user = await db.aio.get_user_by_id(user_id)
     
     if not user:
         raise HTTPException(
@@ -2418,8 +2361,8 @@ async def update_user_status(user_id: int, status_data: dict, current_admin: dic
             detail="User not found"
         )
     
-    db.update_user(user_id, {"is_active": status_data.get("is_active", True)})
-    updated_user = db.get_user_by_id(user_id)
+    await db.aio.update_user(user_id, {"is_active": status_data.get("is_active", True)})
+    updated_user = await db.aio.get_user_by_id(user_id)
     
     return {"message": "User status updated successfully", "user": updated_user}
 
@@ -2482,7 +2425,7 @@ async def delete_user(user_id: int, current_admin: dict = Depends(get_current_ad
 @app.get("/api/riders/{rider_id}")
 async def get_rider_by_id(rider_id: int):
     """Get public rider information by ID (for order tracking, etc.)"""
-    rider = db.get_rider_by_id(rider_id)
+    rider = await db.aio.get_rider_by_id(rider_id)
     
     if not rider:
         raise HTTPException(
@@ -2491,6 +2434,7 @@ async def get_rider_by_id(rider_id: int):
         )
     
     # Return only public information (no sensitive data like password)
+    rider["location"] = location_stream.location(rider["id"], rider.get("location"))
     return {
         "id": rider["id"],
         "username": rider["username"],
@@ -2523,14 +2467,8 @@ async def get_rider_dashboard(current_rider: dict = Depends(get_current_rider)):
     print(f"👤 Rider Username: {current_rider.get('username')}")
     print(f"👤 Rider Status: {current_rider.get('status')}")
     
-    # Get all orders from database
-    all_orders = db.get_all_orders()
-    
-    # Filter for orders assigned to this rider
-    rider_orders = [
-        order for order in all_orders 
-        if order.get("rider_id") == rider_id
-    ]
+    # Get orders assigned to this rider
+    rider_orders = await db.aio.query_orders(rider_id=rider_id)
     
     # Get rider's assigned services
     rider_services = [
@@ -2539,7 +2477,6 @@ async def get_rider_dashboard(current_rider: dict = Depends(get_current_rider)):
     ]
     
     print(f"\n📦 ORDERS ANALYSIS:")
-    print(f"   Total orders in DB: {len(all_orders)}")
     print(f"   Rider's orders found: {len(rider_orders)}")
     if rider_orders:
         print(f"   Order IDs: {[o.get('id') for o in rider_orders]}")
@@ -2648,13 +2585,12 @@ async def get_rider_analytics(
     rider_id = current_rider.get("id") or current_rider.get("rider_id")
     
     # Get rider details for commission rate
-    rider = db.get_rider_by_id(rider_id)
+    rider = await db.aio.get_rider_by_id(rider_id)
     if not rider:
         raise HTTPException(status_code=404, detail="Rider not found")
     
     # Get all orders for this rider
-    all_orders = db.get_all_orders()
-    rider_orders = [o for o in all_orders if o.get("rider_id") == rider_id]
+    rider_orders = await db.aio.query_orders(rider_id=rider_id)
     
     # Get commission rate
     commission_rate = rider.get("commission_rate", 0.8)
@@ -2897,7 +2833,7 @@ async def create_rating(
             user_name = current_user.get("username", "Customer")
         
         # Get order to determine the other party
-        order = db.get_order_by_id(rating_data["order_id"])
+        order = await db.aio.get_order_by_id(rating_data["order_id"])
         if not order:
             raise HTTPException(status_code=404, detail="Order not found")
         
@@ -2915,11 +2851,11 @@ async def create_rating(
             reviewee_id = order.get("rider_id")
             if not reviewee_id:
                 raise HTTPException(status_code=400, detail="Order has no assigned rider")
-            rider = db.get_rider_by_id(reviewee_id)
+            rider = await db.aio.get_rider_by_id(reviewee_id)
             reviewee_name = rider.get("username", "Rider") if rider else "Rider"
         
         # Create rating
-        new_rating = db.create_rating({
+        new_rating = await db.aio.create_rating({
             "order_id": rating_data["order_id"],
             "rating_type": rating_type,
             "reviewer_id": user_id,
@@ -2946,7 +2882,7 @@ async def get_order_ratings(
     current_user: dict = Depends(get_current_user_flexible)
 ):
     """Get all ratings for an order"""
-    ratings = db.get_ratings_for_order(order_id)
+    ratings = await db.aio.get_ratings_for_order(order_id)
     return {"ratings": ratings}
 
 @app.get("/api/ratings/user/{user_id}")
@@ -2956,8 +2892,8 @@ async def get_user_ratings(
     current_user: dict = Depends(get_current_user_flexible)
 ):
     """Get all ratings received by a user"""
-    ratings = db.get_ratings_for_user(user_id, user_type)
-    stats = db.get_rating_stats(user_id, user_type)
+    ratings = await db.aio.get_ratings_for_user(user_id, user_type)
+    stats = await db.aio.get_rating_stats(user_id, user_type)
     return {
         "ratings": ratings,
         "stats": stats
@@ -2974,7 +2910,7 @@ async def get_my_rating_stats(
     else:
         user_id = current_user.get("id") or current_user.get("user_id")
     
-    stats = db.get_rating_stats(user_id, user_type)
+    stats = await db.aio.get_rating_stats(user_id, user_type)
     return stats
 
 @app.put("/api/ratings/{rating_id}/dispute")
@@ -2985,7 +2921,7 @@ async def dispute_rating(
 ):
     """Dispute a rating"""
     try:
-        rating = db.get_rating_by_id(rating_id)
+        rating = await db.aio.get_rating_by_id(rating_id)
         if not rating:
             raise HTTPException(status_code=404, detail="Rating not found")
         
@@ -3002,7 +2938,7 @@ async def dispute_rating(
         if rating["disputed"]:
             raise HTTPException(status_code=400, detail="Rating already disputed")
         
-        updated_rating = db.dispute_rating(rating_id, dispute_data.get("reason", ""))
+        updated_rating = await db.aio.dispute_rating(rating_id, dispute_data.get("reason", ""))
         return updated_rating
     except HTTPException:
         raise
@@ -3015,7 +2951,7 @@ async def get_disputed_ratings(
     current_admin: dict = Depends(get_current_admin)
 ):
     """Get all disputed ratings (admin only)"""
-    disputed = db.get_disputed_ratings()
+    disputed = await db.aio.get_disputed_ratings()
     return {"disputes": disputed}
 
 @app.put("/api/admin/ratings/{rating_id}/resolve")
@@ -3026,14 +2962,14 @@ async def resolve_rating_dispute(
 ):
     """Resolve a rating dispute (admin only)"""
     try:
-        rating = db.get_rating_by_id(rating_id)
+        rating = await db.aio.get_rating_by_id(rating_id)
         if not rating:
             raise HTTPException(status_code=404, detail="Rating not found")
         
         if not rating["disputed"]:
             raise HTTPException(status_code=400, detail="Rating is not disputed")
         
-        updated_rating = db.resolve_dispute(
+        updated_rating = await db.aio.resolve_dispute(
             rating_id,
             resolution_data.get("admin_response", ""),
             resolution_data.get("status", "resolved")
@@ -3047,10 +2983,13 @@ async def resolve_rating_dispute(
 
 @app.get("/api/rider/orders")
 async def get_rider_orders(
+    response: Response,
     status: Optional[str] = None,
+    limit: Optional[int] = None,
+    cursor: Optional[str] = None,
     current_rider: dict = Depends(get_current_rider)
 ):
-    """Get orders assigned to the current rider
+    """Get orders assigned to the current rider, newest first
     
     Status filter options:
     - assigned: Orders accepted but not yet started
@@ -3058,32 +2997,24 @@ async def get_rider_orders(
     - in_transit: Orders being delivered to customer
     - delivered: Completed deliveries
     - None (default): All orders for this rider
-    """
-    # Get all orders from database
-    all_orders = db.get_all_orders()
     
+    Pass `limit` to page through results; when more orders exist the
+    X-Next-Cursor response header holds the `cursor` for the next page.
+    """
     # Get rider ID (handle both 'id' and 'rider_id' fields)
     rider_id = current_rider.get("id") or current_rider.get("rider_id")
     
-    # Filter for orders assigned to this rider
-    rider_orders = [
-        order for order in all_orders 
-        if order.get("rider_id") == rider_id
-    ]
-    
-    # Apply status filter if provided
-    if status:
-        rider_orders = [
-            order for order in rider_orders 
-            if order.get("status") == status
-        ]
-    
-    # Sort by creation date (newest first)
-    rider_orders.sort(
-        key=lambda x: x.get("created_at", ""), 
-        reverse=True
+    # Filter, sort and paginate in the database
+    rider_orders = await db.aio.query_orders(
+        rider_id=rider_id,
+        status=status or None,
+        limit=limit,
+        cursor=decode_cursor(cursor) if cursor else None
     )
     
+    if limit and len(rider_orders) == limit:
+        response.headers["X-Next-Cursor"] = encode_cursor(db.order_cursor(rider_orders[-1]))
+    
     # Add default pickup location and delivery fee to all orders
     for order in rider_orders:
         if not order.get("pickup_location"):
@@ -3099,11 +3030,7 @@ async def get_rider_orders(
 async def get_available_orders(current_rider: dict = Depends(get_current_rider)):
     """Get orders available for pickup in rider's area"""
     # Get unassigned orders from SQLite database
-    all_orders = db.get_all_orders()
-    available_orders = [
-        order for order in all_orders 
-        if order.get("status") == "pending" and not order.get("rider_id")
-    ]
+    available_orders = await db.aio.query_orders(status="pending", unassigned=True, limit=20)
     
     # Add default pickup location and delivery fee to all orders
     for order in available_orders:
@@ -3115,7 +3042,7 @@ async def get_available_orders(current_rider: dict = Depends(get_current_rider))
             order["delivery_fee"] = 10.0
     
     # TODO: Filter by rider's area coverage and location proximity
-    return available_orders[:20]  # Limit to 20 orders
+    return available_orders
 
 @app.post("/api/rider/orders/{order_id}/accept")
 async def accept_order(order_id: str, current_rider: dict = Depends(get_current_rider)):
@@ -3148,7 +3075,7 @@ async def accept_order(order_id: str, current_rider: dict = Depends(get_current_
         )
     
     # Get order from database
-    order = db.get_order_by_id(order_id)
+    order = await db.aio.get_order_by_id(order_id)
     
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
@@ -3175,37 +3102,28 @@ async def accept_order(order_id: str, current_rider: dict = Depends(get_current_
         "rider_name": current_rider.get("username", "Unknown Rider"),
         "rider_phone": current_rider.get("phone", ""),
         "assigned_at": utc_now().isoformat(),
-        "status_history": [
-            {
-                "status": "assigned",
-                "timestamp": utc_now().isoformat(),
-                "note": "Order accepted by rider"
-            }
-        ],
         "current_location": None,
         "notes": []
     }
     
-    # Update order: set status to 'assigned' and assign rider
-    updated_at = utc_now().isoformat()
-    
-    from pathlib import Path
-    import sqlite3
-    
-    DB_PATH = Path(__file__).parent / 'gasfill.db'
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+    # Claim the order: exactly one of several concurrent accepts wins
+    updated_order, outbid = await db.aio.claim_order_offer(order_id, rider_id, tracking_info)
+    location_stream.order_changed(order_id)
     
-    tracking_json = json.dumps(tracking_info)
-    cur.execute(
-        '''UPDATE orders SET status=?, updated_at=?, tracking_info=?, rider_id=? WHERE id=?''', 
-        ("assigned", updated_at, tracking_json, rider_id, order_id)
-    )
-    conn.commit()
-    conn.close()
+    if not updated_order:
+        raise HTTPException(status_code=409, detail="Order already taken by another rider")
     
-    # Get the updated order
-    updated_order = db.get_order_by_id(order_id)
+    assignment_scheduler.cancel(order_id)
+    if outbid:
+        try:
+            await manager.publish([realtime.rider_topic(r) for r in outbid], {
+                "type": "order_offer_taken",
+                "order_id": order_id,
+                "rider_ids": outbid,
+                "timestamp": utc_now().isoformat()
+            })
+        except Exception as e:
+            print(f"⚠️ Failed to broadcast offer taken: {e}")
     
     return {
         "success": True,
@@ -3220,7 +3138,7 @@ async def accept_order(order_id: str, current_rider: dict = Depends(get_current_
 async def confirm_order_assignment(order_id: str, current_rider: dict = Depends(get_current_rider)):
     """Confirm acceptance of an auto-assigned order"""
     # Get order from database
-    order = db.get_order_by_id(order_id)
+    order = await db.aio.get_order_by_id(order_id)
     
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
@@ -3241,11 +3159,13 @@ async def confirm_order_assignment(order_id: str, current_rider: dict = Depends(
         )
     
     # Accept the assignment (clears timeout)
-    updated_order = db.accept_order_assignment(order_id, rider_id)
+    updated_order = await db.aio.accept_order_assignment(order_id, rider_id)
     
     if not updated_order:
         raise HTTPException(status_code=500, detail="Failed to confirm assignment")
     
+    assignment_scheduler.cancel(order_id)
+    
     return {
         "success": True,
         "message": "Assignment confirmed successfully",
@@ -3259,13 +3179,30 @@ async def confirm_order_assignment(order_id: str, current_rider: dict = Depends(
 async def reject_order(order_id: str, current_rider: dict = Depends(get_current_rider)):
     """Reject an order assignment"""
     # Get order from database
-    order = db.get_order_by_id(order_id)
+    order = await db.aio.get_order_by_id(order_id)
     
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
     
-    # Verify order is assigned to this rider
     rider_id = current_rider.get("id") or current_rider.get("rider_id")
+    
+    # Declining a broadcast offer: once every offered rider declines, dispatch again
+    if order.get("status") == "pending":
+        still_open = await db.aio.decline_order_offer(order_id, rider_id)
+        if still_open is None:
+            raise HTTPException(status_code=403, detail="No open offer for you on this order")
+        redispatched = None
+        if still_open == 0:
+            assignment_scheduler.cancel(order_id)
+            redispatched = await redispatch_order(order_id)
+        return {
+            "success": True,
+            "message": "Order offer declined",
+            "order_id": order_id,
+            "status": "assigned" if redispatched and "rider" in redispatched else "pending"
+        }
+    
+    # Verify order is assigned to this rider
     if order.get("rider_id") != rider_id:
         raise HTTPException(
             status_code=403,
@@ -3280,154 +3217,125 @@ async def reject_order(order_id: str, current_rider: dict = Depends(get_current_
         )
     
     # Reject the assignment
-    success = db.reject_order_assignment(order_id, rider_id)
+    success = await db.aio.reject_order_assignment(order_id, rider_id)
+    location_stream.order_changed(order_id)
     
     if not success:
         raise HTTPException(status_code=500, detail="Failed to reject order")
     
+    assignment_scheduler.cancel(order_id)
+    
+    # Offer it straight to the next-nearest rider
+    redispatched = await redispatch_order(order_id)
+    
     return {
         "success": True,
         "message": "Order rejected successfully",
         "order_id": order_id,
-        "status": "pending"
+        "status": "assigned" if redispatched and "rider" in redispatched else "pending"
     }
 
-@app.post("/api/orders/{order_id}/assign")
-async def auto_assign_order(
-    order_id: str,
-    customer_location: Dict[str, float] = None  # {lat, lng} or {latitude, longitude}
-):
-    """Auto-assign order to nearest available rider"""
-    try:
-        # Get order from database
-        order = db.get_order_by_id(order_id)
-        
-        if not order:
-            raise HTTPException(status_code=404, detail="Order not found")
-        
-        # Check if order is already assigned
-        if order.get("status") != "pending":
-            raise HTTPException(
-                status_code=400,
-                detail=f"Order is not available for assignment (status: {order.get('status')})"
-            )
-        
-        # Get all available riders
-        available_riders = db.get_available_riders()
-        
-        if not available_riders:
-            raise HTTPException(
-                status_code=404,
-                detail="No available riders at the moment"
-            )
-        
-        # Filter riders with location data
-        riders_with_location = [r for r in available_riders if r.get('location')]
-        
-        if not riders_with_location:
-            raise HTTPException(
-                status_code=404,
-                detail="No riders with location data available"
-            )
-        
-        # Calculate distances and find nearest rider
-        import json
-        best_rider = None
-        min_distance = float('inf')
-        estimated_time = 0
-        
-        # Use customer location from order if not provided
-        if not customer_location and order.get('customer_location'):
-            try:
-                customer_location = json.loads(order['customer_location']) if isinstance(order['customer_location'], str) else order['customer_location']
-            except Exception as e:
-                print(f"Error parsing customer location: {e}")
-                pass
-        
-        if customer_location:
-            for rider in riders_with_location:
-                try:
-                    rider_loc = json.loads(rider['location']) if isinstance(rider['location'], str) else rider['location']
-                    
-                    # Simple distance calculation (Haversine)
-                    from math import radians, cos, sin, asin, sqrt
-                    
-                    # Support both formats: {lat, lng} and {latitude, longitude}
-                    cust_lat = customer_location.get('lat') or customer_location.get('latitude')
-                    cust_lng = customer_location.get('lng') or customer_location.get('longitude')
-                    
-                    if not cust_lat or not cust_lng:
-                        print(f"Invalid customer location format: {customer_location}")
-                        continue
-                    
-                    lat1, lon1 = radians(cust_lat), radians(cust_lng)
-                    lat2, lon2 = radians(rider_loc['lat']), radians(rider_loc['lng'])
-                    
-                    dlat = lat2 - lat1
-                    dlon = lon2 - lon1
-                    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-                    c = 2 * asin(sqrt(a))
-                    distance = 6371 * c  # Radius of earth in km
-                    
-                    if distance < min_distance:
-                        min_distance = distance
-                        best_rider = rider
-                        # Estimate time: assume 30 km/h average speed
-                        estimated_time = int((distance / 30) * 60)  # minutes
-                        
-                except Exception as e:
-                    print(f"Error calculating distance for rider {rider['id']}: {e}")
-                    continue
-        else:
-            # No location data, just pick the highest rated available rider
-            best_rider = max(riders_with_location, key=lambda r: (r.get('rating', 0), r.get('total_deliveries', 0)))
-            min_distance = 0
-            estimated_time = 15  # Default estimate
-        
-        if not best_rider:
-            raise HTTPException(
-                status_code=404,
-                detail="Could not find suitable rider"
-            )
-        
-        # Assign order to rider
-        assigned_order = db.assign_order_to_rider(
-            order_id=order_id,
-            rider_id=best_rider['id'],
-            distance_km=round(min_distance, 2) if min_distance != float('inf') else None,
-            estimated_time_minutes=estimated_time,
-            expires_in_seconds=30
+# Dispatch: offer pending orders to the nearest available rider and cascade on timeout/rejection
+MAX_ASSIGNMENT_ATTEMPTS = 5  # offers per order before an admin has to step in
+ASSIGNMENT_OFFER_SECONDS = 30
+DISPATCH_CANDIDATES = 10  # nearest riders checked against the riders table per batch
+BATCH_DISPATCH_INTERVAL = 15  # seconds between global matching rounds
+ACTIVE_ORDER_STATUSES = ["assigned", "pickup", "picked_up", "in_transit"]
+# "sequential" offers an order to one rider at a time; "broadcast" offers it to the
+# BROADCAST_OFFER_RIDERS nearest riders at once and the first to accept gets it
+DISPATCH_MODE = os.environ.get("GASFILL_DISPATCH_MODE", "sequential")
+BROADCAST_OFFER_RIDERS = 3
+
+def assigned_rider_ids(order: dict) -> set:
+    """Riders an order has already been offered to (orders.assigned_riders is comma separated)"""
+    return {int(r) for r in (order.get('assigned_riders') or '').split(',') if r.strip().isdigit()}
+
+async def nearest_available_riders(
+    location: Dict[str, float],
+    count: int,
+    exclude_rider_ids: set = frozenset()
+) -> List[tuple]:
+    """Up to count (distance_km, rider) pairs, closest first, confirmed available in batches"""
+    found = []
+    checked = set(exclude_rider_ids)
+    k = max(DISPATCH_CANDIDATES, count)
+    while len(found) < count:
+        nearest = rider_index.nearest(location['lat'], location['lng'], k=k, exclude=checked)
+        if not nearest:
+            break
+        available = await db.aio.get_available_riders_by_ids([rider_id for _, rider_id in nearest])
+        found.extend((distance, available[rider_id]) for distance, rider_id in nearest if rider_id in available)
+        if len(nearest) < k:
+            break
+        checked.update(rider_id for _, rider_id in nearest)
+        k *= 2
+    return found[:count]
+
+async def dispatch_order(
+    order: dict,
+    customer_location: Optional[Dict[str, float]] = None,
+    exclude_rider_ids: set = frozenset(),
+    broadcast: Optional[bool] = None
+) -> dict:
+    """Offer a pending order to the nearest available rider(s) not in exclude_rider_ids"""
+    order_id = order['id']
+    if order.get("status") != "pending":
+        raise HTTPException(
+            status_code=400,
+            detail=f"Order is not available for assignment (status: {order.get('status')})"
         )
-        
-        if not assigned_order:
-            raise HTTPException(status_code=500, detail="Failed to assign order")
-        
-        return {
-            "success": True,
-            "message": "Order assigned successfully",
-            "order_id": order_id,
-            "rider": {
-                "id": best_rider['id'],
-                "username": best_rider['username'],
-                "phone": best_rider['phone'],
-                "vehicle_type": best_rider['vehicle_type'],
-                "rating": best_rider['rating']
-            },
-            "distance_km": round(min_distance, 2) if min_distance != float('inf') else None,
-            "estimated_time_minutes": estimated_time,
-            "assignment_expires_at": assigned_order.get('assignment_expires_at')
-        }
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"Error in auto_assign_order: {e}")
-        import traceback
-        traceback.print_exc()
-        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+    if order.get("assignment_expires_at"):
+        raise HTTPException(status_code=409, detail="Order is already on offer to riders")
+    
+    if broadcast is None:
+        broadcast = DISPATCH_MODE == "broadcast"
+    count = BROADCAST_OFFER_RIDERS if broadcast else 1
+    
+    # Use customer location from order if not provided
+    customer_location = parse_location(customer_location or order.get('customer_location'))
+    
+    if customer_location:
+        matches = await nearest_available_riders(customer_location, count, exclude_rider_ids)
+    else:
+        # No location data, just pick the highest rated available riders
+        available_riders = await db.aio.get_available_riders()
+        matches = [
+            (None, r) for r in available_riders
+            if r['id'] not in exclude_rider_ids and parse_location(r.get('location'))
+        ][:count]
+    
+    if not matches:
+        raise HTTPException(
+            status_code=404,
+            detail="No available riders at the moment"
+        )
+    
+    if broadcast:
+        return await broadcast_order_offers(order, matches)
+    
+    distance, best_rider = matches[0]
+    if distance is None:
+        min_distance, estimated_time = 0, 15  # Default estimate
+    else:
+        # Estimate time: assume 30 km/h average speed
+        min_distance, estimated_time = distance, int((distance / 30) * 60)  # minutes
+    
+    # Assign order to rider
+    assigned_order = await db.aio.assign_order_to_rider(
+        order_id=order_id,
+        rider_id=best_rider['id'],
+        distance_km=round(min_distance, 2),
+        estimated_time_minutes=estimated_time,
+        expires_in_seconds=ASSIGNMENT_OFFER_SECONDS
+    )
+    location_stream.order_changed(order_id)
     
     if not assigned_order:
         raise HTTPException(status_code=500, detail="Failed to assign order")
     
+    # Release the rider the moment the offer window closes
+    assignment_scheduler.schedule(order_id, assigned_order['assignment_expires_at'])
+    
     return {
         "success": True,
         "message": "Order assigned successfully",
@@ -3439,23 +3347,233 @@ async def auto_assign_order(
             "vehicle_type": best_rider['vehicle_type'],
             "rating": best_rider['rating']
         },
-        "distance_km": round(min_distance, 2) if min_distance != float('inf') else None,
+        "distance_km": round(min_distance, 2),
         "estimated_time_minutes": estimated_time,
-        "assignment_expires_at": assigned_order.get('assignment_expires_at')
+        "assignment_expires_at": assigned_order.get('assignment_expires_at'),
+        "assignment_attempts": assigned_order.get('assignment_attempts')
     }
 
+async def broadcast_order_offers(order: dict, matches: List[tuple]) -> dict:
+    """Offer an order to several riders at once; the first /accept claims it"""
+    order_id = order['id']
+    offers = [
+        {
+            "rider_id": rider['id'],
+            "username": rider['username'],
+            "distance_km": round(distance, 2) if distance is not None else None,
+            "estimated_time_minutes": int((distance / 30) * 60) if distance is not None else 15
+        }
+        for distance, rider in matches
+    ]
+    
+    offered_order = await db.aio.create_order_offers(
+        order_id, [offer["rider_id"] for offer in offers], ASSIGNMENT_OFFER_SECONDS
+    )
+    if not offered_order:
+        raise HTTPException(status_code=409, detail="Order is no longer available for offers")
+    
+    expires_at = offered_order['assignment_expires_at']
+    assignment_scheduler.schedule(order_id, expires_at)
+    
+    try:
+        topics = [realtime.rider_topic(offer["rider_id"]) for offer in offers] + [realtime.ADMIN_TOPIC]
+        await manager.publish(topics, {
+            "type": "order_offer",
+            "order_id": order_id,
+            "rider_ids": [offer["rider_id"] for offer in offers],
+            "offers": offers,
+            "delivery_fee": order.get('delivery_fee'),
+            "total": order.get('total'),
+            "expires_at": expires_at,
+            "timestamp": utc_now().isoformat()
+        })
+    except Exception as e:
+        print(f"⚠️ Failed to broadcast order offer: {e}")
+    
+    return {
+        "success": True,
+        "message": f"Order offered to {len(offers)} riders",
+        "order_id": order_id,
+        "mode": "broadcast",
+        "offers": offers,
+        "assignment_expires_at": expires_at,
+        "assignment_attempts": offered_order.get('assignment_attempts')
+    }
+
+async def escalate_dispatch(order: dict, reason: str):
+    """Tell admins an order could not be dispatched automatically"""
+    print(f"🚨 Order {order['id']} needs manual dispatch: {reason}")
+    try:
+        await manager.publish(realtime.ADMIN_TOPIC, {
+            "type": "dispatch_escalation",
+            "order_id": order['id'],
+            "reason": reason,
+            "assignment_attempts": order.get('assignment_attempts') or 0,
+            "timestamp": utc_now().isoformat()
+        })
+    except Exception as e:
+        print(f"⚠️ Failed to broadcast dispatch escalation: {e}")
+
+async def redispatch_order(order_id: str) -> Optional[dict]:
+    """Offer an order that was just released to the next-nearest rider it has not been offered to"""
+    order = await db.aio.get_order_by_id(order_id)
+    if not order or order.get("status") != "pending":
+        return None
+    
+    attempts = order.get('assignment_attempts') or 0
+    if attempts >= MAX_ASSIGNMENT_ATTEMPTS:
+        await escalate_dispatch(order, f"No rider accepted after {attempts} offers")
+        return None
+    
+    try:
+        result = await dispatch_order(order, exclude_rider_ids=assigned_rider_ids(order))
+    except HTTPException as e:
+        if e.status_code == 404:
+            await escalate_dispatch(order, e.detail)
+        else:
+            print(f"Error re-dispatching order {order_id}: {e.detail}")
+        return None
+    
+    riders = [o["rider_id"] for o in result["offers"]] if "offers" in result else [result["rider"]["id"]]
+    print(f"🔁 Re-dispatched order {order_id} to riders {riders} (round {result['assignment_attempts']})")
+    return result
+
+async def redispatch_expired_orders(order_ids: List[str]):
+    """Assignment scheduler callback: cascade every expired offer"""
+    # One at a time so each dispatch sees the riders the previous one made busy
+    for order_id in order_ids:
+        location_stream.order_changed(order_id)  # the expired rider no longer tracks it
+        try:
+            await redispatch_order(order_id)
+        except Exception as e:
+            print(f"Error re-dispatching order {order_id}: {e}")
+
+async def run_batch_dispatch() -> dict:
+    """Match every pending, unassigned order to the available riders in one round and send the offers"""
+    pending = await db.aio.query_orders(status="pending", unassigned=True, descending=False)
+    orders = []
+    for order in pending:
+        if (order.get('assignment_attempts') or 0) >= MAX_ASSIGNMENT_ATTEMPTS:
+            continue  # already escalated to admins
+        if order.get('assignment_expires_at'):
+            continue  # out on broadcast offer
+        point = parse_location(order.get('customer_location'))
+        if point:
+            orders.append({**point, 'id': order['id'], 'exclude': assigned_rider_ids(order)})
+    
+    if not orders:
+        return {"pending": len(pending), "riders": 0, "offered": 0, "offers": []}
+    
+    available_riders = await db.aio.get_available_riders()
+    loads = await db.aio.summarize_orders(group_by='rider_id', status=ACTIVE_ORDER_STATUSES)
+    riders = []
+    for rider in available_riders:
+        # The index holds the latest fix; the stored location may lag behind it
+        position = rider_index.position(rider['id'])
+        point = {'lat': position[0], 'lng': position[1]} if position else parse_location(rider.get('location'))
+        if point:
+            riders.append({
+                **point,
+                'id': rider['id'],
+                'rating': rider.get('rating'),
+                'load': loads.get(rider['id'], {}).get('count', 0)
+            })
+    
+    # Solving a large matrix takes a while; keep it off the event loop
+    plan = await asyncio.to_thread(batch_dispatch.plan_batch, orders, riders)
+    
+    offers = []
+    for order_id, rider_id, distance in plan:
+        assigned_order = await db.aio.assign_order_to_rider(
+            order_id=order_id,
+            rider_id=rider_id,
+            distance_km=round(distance, 2),
+            estimated_time_minutes=int((distance / 30) * 60),
+            expires_in_seconds=ASSIGNMENT_OFFER_SECONDS
+        )
+        location_stream.order_changed(order_id)
+        if not assigned_order:
+            continue  # taken by someone else since the snapshot
+        assignment_scheduler.schedule(order_id, assigned_order['assignment_expires_at'])
+        offers.append({"order_id": order_id, "rider_id": rider_id, "distance_km": round(distance, 2)})
+    
+    if offers:
+        print(f"🧮 Batch dispatch offered {len(offers)} of {len(orders)} pending orders to {len(riders)} riders")
+    return {"pending": len(pending), "riders": len(riders), "offered": len(offers), "offers": offers}
+
+async def batch_dispatch_task():
+    """Background task that periodically matches all pending orders to riders"""
+    while True:
+        await asyncio.sleep(BATCH_DISPATCH_INTERVAL)
+        try:
+            await run_batch_dispatch()
+        except Exception as e:
+            print(f"Error in batch_dispatch_task: {e}")
+
+@app.post("/api/admin/dispatch/batch")
+async def trigger_batch_dispatch(current_admin: dict = Depends(get_current_admin)):
+    """Run a batch matching round now instead of waiting for the next interval"""
+    return await run_batch_dispatch()
+
+@app.get("/api/admin/dispatch/metrics")
+async def get_dispatch_metrics(hours: int = 24, current_admin: dict = Depends(get_current_admin)):
+    """Broadcast offer outcomes and offer-to-accept latency over the last `hours`"""
+    since = (utc_now() - timedelta(hours=hours)).isoformat()
+    metrics = await db.aio.get_offer_metrics(since)
+    return {"mode": DISPATCH_MODE, "hours": hours, **metrics}
+
+@app.get("/api/admin/fee-quotes/cache")
+async def get_fee_quote_cache_stats(current_admin: dict = Depends(get_current_admin)):
+    """Hit/miss counters for the checkout fee quote cache"""
+    return fee_quote_cache.stats()
+
+@app.post("/api/admin/fee-quotes/cache/invalidate")
+async def invalidate_fee_quote_cache(current_admin: dict = Depends(get_current_admin)):
+    """Drop every cached fee quote"""
+    fee_quote_cache.invalidate()
+    print("🧹 Fee quote cache invalidated")
+    return {"success": True}
+
+@app.post("/api/admin/delivery-fees/recompute")
+async def recompute_order_delivery_fees(current_admin: dict = Depends(get_current_admin)):
+    """Re-price every located order with the current fee rules; returns how many fees changed"""
+    updated = await db.run_blocking(db.recompute_delivery_fees)
+    print(f"💰 Delivery fees recomputed: {updated} orders updated")
+    return {"success": True, "updated": updated}
+
+@app.post("/api/orders/{order_id}/assign")
+async def auto_assign_order(
+    order_id: str,
+    customer_location: Dict[str, float] = None,  # {lat, lng} or {latitude, longitude}
+    broadcast: Optional[bool] = None  # override DISPATCH_MODE for this order
+):
+    """Auto-assign order to nearest available rider"""
+    try:
+        # Get order from database
+        order = await db.aio.get_order_by_id(order_id)
+        
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        
+        return await dispatch_order(order, customer_location, broadcast=broadcast)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Error in auto_assign_order: {e}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
+
 @app.get("/api/rider/orders/pending")
 async def get_pending_assignments(current_rider: dict = Depends(get_current_rider)):
     """Get orders pending acceptance by this rider"""
     rider_id = current_rider.get("id") or current_rider.get("rider_id")
     
-    all_orders = db.get_all_orders()
-    pending = [
-        order for order in all_orders
-        if order.get("rider_id") == rider_id 
-        and order.get("status") == "assigned"
-        and order.get("assignment_expires_at")
-    ]
+    assigned_orders = await db.aio.query_orders(rider_id=rider_id, status="assigned")
+    pending = [order for order in assigned_orders if order.get("assignment_expires_at")]
+    
+    # Broadcast offers this rider can claim through /accept
+    pending.extend(await db.aio.get_open_offers_for_rider(rider_id))
     
     return pending
 
@@ -3467,7 +3585,7 @@ async def update_delivery_status(
 ):
     """Update delivery status with proper state validation"""
     # Get order from database
-    order = db.get_order_by_id(order_id)
+    order = await db.aio.get_order_by_id(order_id)
     
     if not order:
         raise HTTPException(status_code=404, detail="Order not found")
@@ -3497,22 +3615,10 @@ async def update_delivery_status(
     tracking_info = order.get("tracking_info") or {
         "rider_id": current_rider_id,
         "rider_name": current_rider.get("username", "Unknown"),
-        "status_history": [],
         "notes": []
     }
-    
-    # Add status to history
-    status_entry = {
-        "status": new_status,
-        "timestamp": utc_now().isoformat(),
-        "location": status_update.location
-    }
-    if status_update.notes:
-        status_entry["note"] = status_update.notes
-    
-    if "status_history" not in tracking_info:
-        tracking_info["status_history"] = []
-    tracking_info["status_history"].append(status_entry)
+    # Status history now lives in order_status_events; drop any legacy copy
+    tracking_info.pop("status_history", None)
     
     # Update current location if provided
     if status_update.location:
@@ -3540,7 +3646,11 @@ async def update_delivery_status(
         current_rider["total_deliveries"] = current_rider.get("total_deliveries", 0) + 1
     
     # Update order in database
-    updated_order = db.update_order_status(order_id, new_status, tracking_info)
+    updated_order = await db.aio.update_order_status(
+        order_id, new_status, tracking_info,
+        note=status_update.notes, location=status_update.location
+    )
+    location_stream.order_changed(order_id)
     
     # Build response with status labels
     status_labels = {
@@ -3634,7 +3744,7 @@ async def update_rider_status(
         location_str = json.dumps(status_update.location)
     
     # Update database
-    updated_rider = db.update_rider_status(
+    updated_rider = await db.aio.update_rider_status(
         current_rider["id"], 
         status_update.status,
         location_str
@@ -3668,7 +3778,7 @@ async def get_rider_profile(current_rider: dict = Depends(get_current_rider)):
         "successful_deliveries": current_rider["successful_deliveries"],
         "earnings": current_rider["earnings"],
         "is_verified": current_rider["is_verified"],
-        "location": current_rider.get("location"),
+        "location": location_stream.location(current_rider["id"], current_rider.get("location")),
         "created_at": current_rider["created_at"]
     }
 
@@ -4295,7 +4405,7 @@ async def upload_rider_documents(
         raise HTTPException(status_code=401, detail="Rider ID not found")
     
     # Get rider from database
-    rider = db.get_rider_by_id(rider_id)
+    rider = await db.aio.get_rider_by_id(rider_id)
     if not rider:
         raise HTTPException(status_code=404, detail="Rider not found")
     
@@ -4366,7 +4476,7 @@ async def upload_rider_documents(
     update_data["verification_notes"] = ""  # Clear any previous rejection notes
     
     # Update rider in database
-    updated_rider = db.update_rider(rider_id, update_data)
+    updated_rider = await db.aio.update_rider(rider_id, update_data)
     
     if not updated_rider:
         raise HTTPException(status_code=500, detail="Failed to update rider documents")
@@ -4531,7 +4641,7 @@ async def process_payment_request(
                 raise HTTPException(status_code=404, detail="Rider email not found in payment request")
             
             # Get rider from database
-            rider = db.get_rider_by_email(rider_email)
+            rider = await db.aio.get_rider_by_email(rider_email)
             if not rider:
                 print(f"❌ Rider email '{rider_email}' not found in database!")
                 raise HTTPException(status_code=404, detail="Rider not found")
@@ -4543,7 +4653,7 @@ async def process_payment_request(
 
             # Deduct earnings and update rider in database
             new_earnings = rider["earnings"] - payment_request["amount"]
-            db.update_rider(rider["id"], {
+            await db.aio.update_rider(rider["id"], {
                 "earnings": new_earnings,
                 "updated_at": utc_now().isoformat()
             })
@@ -4703,25 +4813,14 @@ async def get_admin_analytics(
         start_date = today.replace(month=1, day=1)
         start_datetime = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
     
-    # Get all data
-    all_orders = db.get_all_orders()
-    all_users = db.get_all_users()
+    # Get all data; orders are filtered by period in the database
+    # (created_at is stored as a naive ISO string, so compare against a naive bound)
+    period_orders = await db.aio.query_orders(created_after=start_datetime.replace(tzinfo=None).isoformat())
+    total_orders = await db.aio.count_orders()
+    all_users = await db.aio.get_all_users()
     all_riders = list(riders_db.values())
     
-    # Filter orders by period
-    period_orders = []
-    for order in all_orders:
-        try:
-            created_at = order.get("created_at")
-            if created_at and isinstance(created_at, str):
-                order_date = datetime.fromisoformat(created_at.replace('Z', '+00:00'))
-                if order_date >= start_datetime:
-                    period_orders.append(order)
-        except (ValueError, TypeError):
-            continue
-    
     # Order statistics
-    total_orders = len(all_orders)
     period_order_count = len(period_orders)
     completed_orders = [o for o in period_orders if o.get("status") == "delivered"]
     pending_orders = [o for o in period_orders if o.get("status") == "pending"]
@@ -5028,60 +5127,15 @@ async def assign_service_to_rider(service_id: str, assignment_data: dict,
 # WebSocket support for real-time features (optional)
 try:
     from fastapi import WebSocket, WebSocketDisconnect
-    from typing import List as TypingList
+    from realtime import ConnectionManager
     
-    class ConnectionManager:
-        def __init__(self):
-            self.active_connections: TypingList[WebSocket] = []
-
-        async def connect(self, websocket: WebSocket):
-            try:
-                await websocket.accept()
-                self.active_connections.append(websocket)
-                print(f"[ConnectionManager] New connection. Total active: {len(self.active_connections)}")
-            except Exception as e:
-                print(f"[ConnectionManager] Error accepting connection: {e}")
-                raise
-
-        def disconnect(self, websocket: WebSocket):
-            try:
-                if websocket in self.active_connections:
-                    self.active_connections.remove(websocket)
-                    print(f"[ConnectionManager] Connection removed. Total active: {len(self.active_connections)}")
-            except Exception as e:
-                print(f"[ConnectionManager] Error disconnecting: {e}")
-
-        async def send_personal_message(self, message: str, websocket: WebSocket):
-            try:
-                await websocket.send_text(message)
-            except (OSError, RuntimeError, ConnectionResetError) as e:
-                print(f"[ConnectionManager] Connection error sending personal message: {type(e).__name__}")
-                self.disconnect(websocket)
-            except Exception as e:
-                print(f"[ConnectionManager] Unexpected error sending personal message: {e}")
-                self.disconnect(websocket)
-
-        async def broadcast(self, message: str):
-            disconnected = []
-            for connection in self.active_connections:
-                try:
-                    await connection.send_text(message)
-                except (OSError, RuntimeError, ConnectionResetError) as e:
-                    print(f"[ConnectionManager] Connection error during broadcast: {type(e).__name__}")
-                    disconnected.append(connection)
-                except Exception as e:
-                    print(f"[ConnectionManager] Error broadcasting to connection: {type(e).__name__}: {e}")
-                    disconnected.append(connection)
-            
-            # Clean up disconnected connections
-            for conn in disconnected:
-                self.disconnect(conn)
-            
-            if disconnected:
-                print(f"[ConnectionManager] Cleaned up {len(disconnected)} dead connections")
-
     manager = ConnectionManager()
 
+    @app.get("/api/admin/realtime")
+    async def get_realtime_stats(current_admin: dict = Depends(get_current_admin)):
+        """WebSocket connection and topic subscription counts"""
+        return manager.stats()
+
     # ============================================
     # PUSH NOTIFICATION ENDPOINTS
     # ============================================
@@ -5273,42 +5327,101 @@ try:
             return False
 
     @app.websocket("/ws")
-    async def websocket_endpoint(websocket: WebSocket):
-        await manager.connect(websocket)
+    async def websocket_endpoint(
+        websocket: WebSocket,
+        token: Optional[str] = None,
+        encoding: Optional[str] = None,  # "msgpack" for compact binary frames
+        compress: Optional[str] = None   # "deflate" to also deflate large binary frames
+    ):
+        user = None
+        if token:
+            user = await db.run_blocking(
+                get_current_user, HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+            )
+            if not user:
+                print("[WebSocket] Rejected connection with an invalid token")
+                await websocket.close(code=1008)
+                return
+        await manager.connect(websocket, user, ws_codec.negotiate(encoding, compress))
+        
+        async def authorize(topic: str) -> bool:
+            """Whether this connection may publish to or subscribe to a topic"""
+            return topic in manager.subscriptions.get(websocket, ()) or await realtime.can_subscribe(user, topic)
+        
+        async def join(topic: str) -> bool:
+            if not await authorize(topic):
+                await manager.send_json(websocket, {"type": "subscription_error", "topic": topic, "detail": "Not allowed"})
+                return False
+            manager.subscribe(websocket, topic)
+            return True
+        
+        async def receive_frame() -> Union[str, bytes]:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(message.get("code", 1000))
+            return message["bytes"] if message.get("bytes") is not None else message.get("text", "")
+        
+        def requested_topic(payload: dict) -> Optional[str]:
+            """Topic from {"topic": ...} or the legacy {"order_id"}/{"chat_room_id"} forms"""
+            if payload.get("topic"):
+                return str(payload["topic"])
+            if payload.get("order_id"):
+                return realtime.order_topic(payload["order_id"])
+            if payload.get("chat_room_id"):
+                return realtime.chat_topic(payload["chat_room_id"])
+            return None
+        
         last_ping = datetime.now()
         ping_interval = 30  # Send ping every 30 seconds
         
         try:
             while True:
+                # The writer task drops the connection when sends fail or it falls too far behind
+                if websocket not in manager.users:
+                    break
+                
                 try:
                     # Check if we need to send a ping
                     now = datetime.now()
                     if (now - last_ping).total_seconds() > ping_interval:
                         try:
-                            await websocket.send_json({"type": "ping", "timestamp": now.isoformat()})
+                            await manager.send_json(websocket, {"type": "ping", "timestamp": now.isoformat()})
                             last_ping = now
                         except Exception as ping_error:
                             print(f"[WebSocket] Ping failed: {ping_error}")
                             break
                     
-                    # Receive JSON data with shorter timeout for better responsiveness
+                    # Receive a JSON text or binary frame with shorter timeout for better responsiveness
                     # Reduced timeout helps catch connection issues faster
-                    data_text = await asyncio.wait_for(
-                        websocket.receive_text(), 
+                    frame = await asyncio.wait_for(
+                        receive_frame(), 
                         timeout=60  # 60 seconds timeout (reduced from 300)
                     )
                     
                     try:
-                        data = json.loads(data_text)
+                        data = ws_codec.decode(frame)
                         event_type = data.get("type", "message")
                         event_data = data.get("data", {})
                         
                         print(f"[WebSocket] Received event: {event_type}")
                         
+                        if event_type in ("subscribe", "unsubscribe"):
+                            topic = requested_topic(event_data or data)
+                            if not topic:
+                                await manager.send_json(websocket, {"type": "subscription_error", "detail": "No topic given"})
+                            elif event_type == "unsubscribe":
+                                manager.unsubscribe(websocket, topic)
+                                await manager.send_json(websocket, {"type": "unsubscribed", "topic": topic})
+                            elif await join(topic):
+                                await manager.send_json(websocket, {"type": "subscribed", "topic": topic})
+                        
                         # Handle chat-specific events
-                        if event_type == "chat_send_message":
-                            # Save message to database and broadcast
+                        elif event_type == "chat_send_message":
+                            # Save message to database and publish to the room
                             chat_room_id = event_data.get("chat_room_id")
+                            if not await authorize(realtime.chat_topic(chat_room_id)):
+                                await manager.send_json(websocket, {"type": "error", "detail": "Not a participant of this chat room"})
+                                continue
                             message_text = event_data.get("message")
                             sender_id = event_data.get("sender_id")
                             sender_type = event_data.get("sender_type")
@@ -5336,12 +5449,12 @@ try:
                                 db_message_data["location"] = location_data
                             
                             # Save to database - this returns the created message with generated ID
-                            saved_message = db.create_chat_message(db_message_data)
+                            saved_message = await db.aio.create_chat_message(db_message_data)
                             
                             print(f"[WebSocket] Message saved with ID: {saved_message['id']}")
-                            print(f"[WebSocket] Broadcasting message to room {chat_room_id}")
+                            print(f"[WebSocket] Publishing message to room {chat_room_id}")
                             
-                            # Broadcast the saved message to all clients
+                            # Publish the saved message to the room
                             message_data = {
                                 "id": saved_message["id"],
                                 "chat_room_id": saved_message["chat_room_id"],
@@ -5361,27 +5474,28 @@ try:
                             if saved_message.get("location"):
                                 message_data["location_data"] = saved_message["location"]
                             
-                            # Broadcast to all clients
-                            await manager.broadcast(json.dumps({
+                            await manager.publish(realtime.chat_topic(chat_room_id), {
                                 "type": "chat_message",
                                 "data": message_data
-                            }))
+                            })
                             
                         elif event_type == "chat_join_room":
                             # User joined chat room
                             chat_room_id = event_data.get("chat_room_id")
                             user_id = event_data.get("user_id")
+                            if not await join(realtime.chat_topic(chat_room_id)):
+                                continue
                             print(f"[WebSocket] User {user_id} joined room {chat_room_id}")
                             
                             # Notify other users in the room
-                            await manager.broadcast(json.dumps({
+                            await manager.publish(realtime.chat_topic(chat_room_id), {
                                 "type": "chat_user_status",
                                 "data": {
                                     "chat_room_id": chat_room_id,
                                     "user_id": user_id,
                                     "is_online": True
                                 }
-                            }))
+                            })
                             
                         elif event_type == "chat_leave_room":
                             # User left chat room
@@ -5390,106 +5504,107 @@ try:
                             print(f"[WebSocket] User {user_id} left room {chat_room_id}")
                             
                             # Notify other users in the room
-                            await manager.broadcast(json.dumps({
-                                "type": "chat_user_status",
-                                "data": {
-                                    "chat_room_id": chat_room_id,
-                                    "user_id": user_id,
-                                    "is_online": False
-                                }
-                            }))
+                            topic = realtime.chat_topic(chat_room_id)
+                            manager.unsubscribe(websocket, topic)
+                            if await authorize(topic):
+                                await manager.publish(topic, {
+                                    "type": "chat_user_status",
+                                    "data": {
+                                        "chat_room_id": chat_room_id,
+                                        "user_id": user_id,
+                                        "is_online": False
+                                    }
+                                })
                             
-                        elif event_type == "chat_typing_start":
-                            # User started typing
+                        elif event_type in ("chat_typing_start", "chat_typing_stop"):
+                            # User started/stopped typing
                             chat_room_id = event_data.get("chat_room_id")
                             user_id = event_data.get("user_id")
+                            topic = realtime.chat_topic(chat_room_id)
                             
-                            await manager.broadcast(json.dumps({
-                                "type": "chat_typing",
-                                "data": {
-                                    "chat_room_id": chat_room_id,
-                                    "user_id": user_id,
-                                    "is_typing": True
-                                }
-                            }))
-                            
-                        elif event_type == "chat_typing_stop":
-                            # User stopped typing
-                            chat_room_id = event_data.get("chat_room_id")
-                            user_id = event_data.get("user_id")
-                            
-                            await manager.broadcast(json.dumps({
-                                "type": "chat_typing",
-                                "data": {
-                                    "chat_room_id": chat_room_id,
-                                    "user_id": user_id,
-                                    "is_typing": False
-                                }
-                            }))
+                            if await authorize(topic):
+                                await manager.publish(topic, {
+                                    "type": "chat_typing",
+                                    "data": {
+                                        "chat_room_id": chat_room_id,
+                                        "user_id": user_id,
+                                        "is_typing": event_type == "chat_typing_start"
+                                    }
+                                }, coalesce_key=f"chat_typing:{chat_room_id}:{user_id}")
                             
                         elif event_type == "chat_message_delivered":
                             # Message delivered receipt
                             message_id = event_data.get("message_id")
+                            topic = realtime.chat_topic(event_data.get("chat_room_id"))
                             
-                            await manager.broadcast(json.dumps({
-                                "type": "chat_messages_delivered",
-                                "data": {
-                                    "message_ids": [message_id]
-                                }
-                            }))
+                            if await authorize(topic):
+                                await manager.publish(topic, {
+                                    "type": "chat_messages_delivered",
+                                    "data": {
+                                        "message_ids": [message_id]
+                                    }
+                                })
                             
                         elif event_type == "chat_mark_read":
                             # Mark messages as read
                             chat_room_id = event_data.get("chat_room_id")
                             message_ids = event_data.get("message_ids", [])
+                            topic = realtime.chat_topic(chat_room_id)
+                            if not await authorize(topic):
+                                continue
                             
                             # Save to database
                             if chat_room_id and message_ids:
                                 print(f"[WebSocket] Marking {len(message_ids)} messages as read in room {chat_room_id}")
-                                db.mark_messages_as_read(chat_room_id, message_ids)
+                                await db.aio.mark_messages_as_read(chat_room_id, message_ids)
                             
-                            # Broadcast read receipt
-                            await manager.broadcast(json.dumps({
+                            # Publish read receipt to the room
+                            await manager.publish(topic, {
                                 "type": "chat_messages_read",
                                 "data": {
                                     "message_ids": message_ids
                                 }
-                            }))
+                            })
                             
                         # Legacy event types for backward compatibility
-                        elif event_type == "message":
-                            # Broadcast new message to all connected clients
-                            await manager.broadcast(json.dumps({
-                                "type": "message",
-                                "chat_room_id": data.get("chat_room_id"),
-                                "message": data.get("message"),
-                                "sender_id": data.get("sender_id"),
-                                "sender_type": data.get("sender_type"),
-                                "sender_name": data.get("sender_name"),
-                                "message_type": data.get("message_type", "text"),
-                                "timestamp": data.get("timestamp")
-                            }))
-                        elif event_type == "typing":
-                            # Broadcast typing indicator
-                            await manager.broadcast(json.dumps({
-                                "type": "typing",
-                                "chat_room_id": data.get("chat_room_id"),
-                                "user_id": data.get("user_id"),
-                                "user_name": data.get("user_name"),
-                                "is_typing": data.get("is_typing", True)
-                            }))
-                        elif event_type == "read":
-                            # Broadcast read receipt
-                            await manager.broadcast(json.dumps({
-                                "type": "read",
-                                "chat_room_id": data.get("chat_room_id"),
-                                "message_ids": data.get("message_ids", []),
-                                "user_id": data.get("user_id")
-                            }))
+                        elif event_type in ("message", "typing", "read"):
+                            topic = realtime.chat_topic(data.get("chat_room_id"))
+                            if not await authorize(topic):
+                                continue
+                            if event_type == "message":
+                                legacy_event = {
+                                    "type": "message",
+                                    "chat_room_id": data.get("chat_room_id"),
+                                    "message": data.get("message"),
+                                    "sender_id": data.get("sender_id"),
+                                    "sender_type": data.get("sender_type"),
+                                    "sender_name": data.get("sender_name"),
+                                    "message_type": data.get("message_type", "text"),
+                                    "timestamp": data.get("timestamp")
+                                }
+                            elif event_type == "typing":
+                                legacy_event = {
+                                    "type": "typing",
+                                    "chat_room_id": data.get("chat_room_id"),
+                                    "user_id": data.get("user_id"),
+                                    "user_name": data.get("user_name"),
+                                    "is_typing": data.get("is_typing", True)
+                                }
+                            else:
+                                legacy_event = {
+                                    "type": "read",
+                                    "chat_room_id": data.get("chat_room_id"),
+                                    "message_ids": data.get("message_ids", []),
+                                    "user_id": data.get("user_id")
+                                }
+                            await manager.publish(topic, legacy_event)
                         
                         elif event_type == "rider_location_update":
-                            # Rider sends location update
-                            rider_id = event_data.get("rider_id")
+                            # Rider sends location update; only riders report their own position
+                            if realtime.user_role(user) != "rider":
+                                await manager.send_json(websocket, {"type": "error", "detail": "Only riders can send location updates"})
+                                continue
+                            rider_id = user["id"]
                             order_id = event_data.get("order_id")
                             latitude = event_data.get("latitude")
                             longitude = event_data.get("longitude")
@@ -5497,63 +5612,34 @@ try:
                             speed = event_data.get("speed")
                             heading = event_data.get("heading")
                             
-                            print(f"[WebSocket] Rider {rider_id} location update for order {order_id}: ({latitude}, {longitude})")
-                            
-                            # Update rider's location in database
-                            try:
-                                location_data = {
-                                    "latitude": latitude,
-                                    "longitude": longitude,
-                                    "accuracy": accuracy,
-                                    "speed": speed,
-                                    "heading": heading,
-                                    "timestamp": data.get("timestamp") or datetime.now().isoformat()
-                                }
-                                
-                                import sqlite3
-                                conn = sqlite3.connect(db.DB_PATH)
-                                cur = conn.cursor()
-                                cur.execute("""
-                                    UPDATE riders 
-                                    SET location = ?, updated_at = ?
-                                    WHERE id = ?
-                                """, (json.dumps(location_data), datetime.now().isoformat(), rider_id))
-                                conn.commit()
-                                conn.close()
-                                print(f"[WebSocket] ✅ Updated rider {rider_id} location in database")
-                            except Exception as e:
-                                print(f"[WebSocket] ❌ Error updating rider location in DB: {e}")
-                            
-                            # Broadcast to all clients (customers can filter by order_id)
-                            await manager.broadcast(json.dumps({
-                                "type": "rider_location",
-                                "data": {
-                                    "rider_id": rider_id,
-                                    "order_id": order_id,
-                                    "latitude": latitude,
-                                    "longitude": longitude,
-                                    "accuracy": accuracy,
-                                    "speed": speed,
-                                    "heading": heading,
-                                    "timestamp": data.get("timestamp") or datetime.now().isoformat()
-                                }
-                            }))
+                            location_data = {
+                                "latitude": latitude,
+                                "longitude": longitude,
+                                "accuracy": accuracy,
+                                "speed": speed,
+                                "heading": heading,
+                                "timestamp": data.get("timestamp") or datetime.now().isoformat()
+                            }
+                            point = location_coordinates(location_data)
+                            if point is None:
+                                await manager.send_json(websocket, {"type": "error", "detail": "latitude and longitude must be numbers within range"})
+                                continue
+                            location_data["latitude"], location_data["longitude"] = point
+                            # Dead-banded, then published to order:<id> and admin on the stream's tick
+                            await location_stream.ingest(rider_id, location_data, order_id)
                         
                         elif event_type == "ping":
                             # Respond to ping with pong
-                            await websocket.send_json({"type": "pong"})
+                            await manager.send_json(websocket, {"type": "pong"})
                             
-                    except json.JSONDecodeError:
-                        # Fallback to plain text for backward compatibility
-                        await manager.broadcast(json.dumps({
-                            "type": "message",
-                            "message": data_text
-                        }))
+                    except ws_codec.DecodeError:
+                        # Plain text has no topic to go to
+                        await manager.send_json(websocket, {"type": "error", "detail": "Expected a JSON or MessagePack event"})
                         
                 except asyncio.TimeoutError:
                     # Timeout - send ping to keep connection alive
                     try:
-                        await websocket.send_json({"type": "ping", "timestamp": datetime.now().isoformat()})
+                        await manager.send_json(websocket, {"type": "ping", "timestamp": datetime.now().isoformat()})
                         last_ping = datetime.now()
                     except Exception as ping_error:
                         print(f"[WebSocket] Ping failed after timeout: {ping_error}")
@@ -5684,7 +5770,7 @@ async def create_payment_order(order_data: PaymentOrderData):
     """Create a new order with payment information"""
     try:
         # Generate order ID
-        order_id = f"ORD-{len(orders_db) + 1:06d}-{utc_now().strftime('%Y%m')}"
+        order_id = ids.new_order_id()
         
         # Create order object
         order = {
@@ -5769,7 +5855,7 @@ async def create_or_get_chat_room(data: ChatRoomCreate, credentials: HTTPAuthori
     """Create or get existing chat room for an order"""
     try:
         # Verify authentication
-        current_user = get_current_user(credentials)
+        current_user = await db.run_blocking(get_current_user, credentials)
         if not current_user:
             raise HTTPException(status_code=401, detail="Unauthorized")
         
@@ -5787,18 +5873,18 @@ async def create_or_get_chat_room(data: ChatRoomCreate, credentials: HTTPAuthori
                 order_id = int(order_id)
         
         # Get order to find rider info if needed
-        order = db.get_order_by_id(f"ORD-{order_id}")
+        order = await db.aio.get_order_by_id(f"ORD-{order_id}")
         rider_id = order.get('rider_id') if order else None
         rider_name = None
         
         if rider_id:
             # Get rider name from database
-            rider = db.get_rider_by_id(rider_id)
+            rider = await db.aio.get_rider_by_id(rider_id)
             if rider:
                 rider_name = rider.get('username', 'Rider')
         
         # Create or get chat room
-        chat_room = db.create_or_get_chat_room(
+        chat_room = await db.aio.create_or_get_chat_room(
             order_id=order_id,
             customer_id=data.user_id,
             customer_name=user_name,
@@ -5819,19 +5905,40 @@ async def create_or_get_chat_room(data: ChatRoomCreate, credentials: HTTPAuthori
 @app.get("/api/chat/rooms/{chat_room_id}/messages")
 async def get_chat_messages_endpoint(
     chat_room_id: str,
+    response: Response,
     limit: int = 50,
     offset: int = 0,
+    latest: bool = False,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
     credentials: HTTPAuthorizationCredentials = Depends(security)
 ):
-    """Get message history for a chat room"""
+    """Get message history for a chat room, oldest first within the page
+    
+    - latest=true: the newest `limit` messages
+    - before=<cursor>: the `limit` messages just older than the cursor (scroll-back)
+    - after=<cursor>: messages newer than the cursor (catch-up)
+    - otherwise: legacy limit/offset from the start of the conversation
+    
+    X-Before-Cursor / X-After-Cursor headers hold the cursors of the page's
+    oldest and newest messages.
+    """
     try:
         # Verify authentication
-        current_user = get_current_user(credentials)
+        current_user = await db.run_blocking(get_current_user, credentials)
         if not current_user:
             raise HTTPException(status_code=401, detail="Unauthorized")
         
         print(f"📨 Fetching messages for chat room: {chat_room_id} (limit: {limit}, offset: {offset})")
-        messages = db.get_chat_messages(chat_room_id, limit, offset)
+        messages = await db.aio.get_chat_messages(
+            chat_room_id, limit, offset,
+            latest=latest,
+            before=decode_cursor(before) if before else None,
+            after=decode_cursor(after) if after else None
+        )
+        if messages:
+            response.headers["X-Before-Cursor"] = encode_cursor(db.message_cursor(messages[0]))
+            response.headers["X-After-Cursor"] = encode_cursor(db.message_cursor(messages[-1]))
         print(f"✅ Retrieved {len(messages)} messages")
         return messages
     
@@ -5848,16 +5955,16 @@ async def send_chat_message(message: ChatMessageCreate, credentials: HTTPAuthori
     """Send a new chat message"""
     try:
         # Verify token
-        current_user = get_current_user(credentials)
+        current_user = await db.run_blocking(get_current_user, credentials)
         if not current_user:
             raise HTTPException(status_code=401, detail="Unauthorized")
         
         # Create message in database
-        new_message = db.create_chat_message(message.dict())
+        new_message = await db.aio.create_chat_message(message.dict())
         
-        # Broadcast via WebSocket to all connected clients
+        # Publish via WebSocket to the room's subscribers
         try:
-            await manager.broadcast(json.dumps({
+            await manager.publish(realtime.chat_topic(new_message["chat_room_id"]), {
                 "type": "message",
                 "chat_room_id": new_message["chat_room_id"],
                 "message_id": new_message["id"],
@@ -5869,7 +5976,7 @@ async def send_chat_message(message: ChatMessageCreate, credentials: HTTPAuthori
                 "image_url": new_message.get("image_url"),
                 "location_data": new_message.get("location_data"),
                 "created_at": new_message["created_at"]
-            }))
+            })
         except Exception as ws_error:
             print(f"WebSocket broadcast error: {ws_error}")
         
@@ -5887,20 +5994,20 @@ async def mark_messages_as_read(
     """Mark messages as read"""
     try:
         # Verify token
-        current_user = get_current_user(credentials)
+        current_user = await db.run_blocking(get_current_user, credentials)
         if not current_user:
             raise HTTPException(status_code=401, detail="Unauthorized")
         
-        db.mark_messages_as_read(chat_room_id, data.message_ids)
+        await db.aio.mark_messages_as_read(chat_room_id, data.message_ids)
         
-        # Broadcast read receipt via WebSocket
+        # Publish read receipt to the room's subscribers
         try:
-            await manager.broadcast(json.dumps({
+            await manager.publish(realtime.chat_topic(chat_room_id), {
                 "type": "read",
                 "chat_room_id": chat_room_id,
                 "message_ids": data.message_ids,
                 "user_id": current_user["id"]
-            }))
+            })
         except Exception as ws_error:
             print(f"WebSocket broadcast error: {ws_error}")
         
@@ -5914,7 +6021,7 @@ async def get_user_chat_rooms_endpoint(credentials: HTTPAuthorizationCredentials
     """Get all chat rooms for the authenticated user"""
     try:
         # Verify authentication
-        current_user = get_current_user(credentials)
+        current_user = await db.run_blocking(get_current_user, credentials)
         if not current_user:
             raise HTTPException(status_code=401, detail="Unauthorized")
         
@@ -5924,17 +6031,17 @@ async def get_user_chat_rooms_endpoint(credentials: HTTPAuthorizationCredentials
         # Determine user type and ID based on role
         if user_role == "rider":
             user_type = "rider"
-            rider = db.get_rider_by_email(user_email)
+            rider = await db.aio.get_rider_by_email(user_email)
             user_id = rider.get("id") if rider else None
         else:
             user_type = "customer"
-            user = db.get_user_by_email(user_email)
+            user = await db.aio.get_user_by_email(user_email)
             user_id = user.get("id") if user else None
         
         if not user_id:
             raise HTTPException(status_code=404, detail="User not found")
         
-        chat_rooms = db.get_user_chat_rooms(user_id, user_type)
+        chat_rooms = await db.aio.get_user_chat_rooms(user_id, user_type)
         return chat_rooms
     
     except HTTPException:
@@ -5950,11 +6057,11 @@ async def close_chat_room(chat_room_id: str, credentials: HTTPAuthorizationCrede
     """Close a chat room"""
     try:
         # Verify token
-        current_user = get_current_user(credentials)
+        current_user = await db.run_blocking(get_current_user, credentials)
         if not current_user:
             raise HTTPException(status_code=401, detail="Unauthorized")
         
-        db.close_chat_room(chat_room_id)
+        await db.aio.close_chat_room(chat_room_id)
         return {"success": True, "message": "Chat room closed"}
     
     except Exception as e:
@@ -5968,7 +6075,7 @@ async def upload_chat_image(
     """Upload an image for chat"""
     try:
         # Verify token
-        current_user = get_current_user(credentials)
+        current_user = await db.run_blocking(get_current_user, credentials)
         if not current_user:
             raise HTTPException(status_code=401, detail="Unauthorized")
         
@@ -6019,23 +6126,35 @@ async def upload_chat_image(
 # SERVER INITIALIZATION
 # ========================
 
-# Background task for clearing expired assignments
-async def clear_expired_assignments_task():
-    """Background task that runs every 10 seconds to clear expired order assignments"""
+RIDER_INDEX_REFRESH_SECONDS = 60
+
+async def refresh_rider_index_task():
+    """Re-sync the rider spatial index with the riders table (picks up other server processes)"""
     while True:
+        await asyncio.sleep(RIDER_INDEX_REFRESH_SECONDS)
         try:
-            expired_orders = db.clear_expired_assignments()
-            if expired_orders:
-                print(f"⏰ Cleared {len(expired_orders)} expired assignments: {expired_orders}")
-                
-                # TODO: Trigger re-assignment for these orders
-                # for order_id in expired_orders:
-                #     await auto_assign_order(order_id)
-                
+            rider_index.rebuild(location_stream.locations(await db.aio.get_rider_locations()))
         except Exception as e:
-            print(f"Error in clear_expired_assignments_task: {e}")
-        
-        await asyncio.sleep(10)  # Run every 10 seconds
+            print(f"Error in refresh_rider_index_task: {e}")
+
+async def publish_rider_location(rider_id: int, order_id: Optional[str], fix: dict):
+    """Location stream tick: the newest fix of a rider on an order, to the order's trackers and admins"""
+    topics = [realtime.ADMIN_TOPIC]
+    if order_id:
+        topics.append(realtime.order_topic(order_id))
+    await manager.publish(topics, {
+        "type": "rider_location",
+        "data": {
+            "rider_id": rider_id,
+            "order_id": order_id,
+            "latitude": fix.get("latitude"),
+            "longitude": fix.get("longitude"),
+            "accuracy": fix.get("accuracy"),
+            "speed": fix.get("speed"),
+            "heading": fix.get("heading"),
+            "timestamp": fix.get("timestamp")
+        }
+    }, coalesce_key=f"rider_location:{rider_id}:{order_id}")
 
 @app.on_event("startup")
 async def startup_event():
@@ -6043,21 +6162,40 @@ async def startup_event():
     print("🚀 Starting GasFill Backend Server...")
     
     # Initialize database
-    db.init_db()
+    await db.aio.init_db()
     print("✅ Database initialized")
     
-    # Start background task for clearing expired assignments
-    asyncio.create_task(clear_expired_assignments_task())
-    print("✅ Background assignment cleanup task started")
+    # Index rider positions for nearest-rider dispatch
+    indexed = rider_index.rebuild(await db.aio.get_rider_locations())
+    print(f"✅ Rider spatial index built ({indexed} riders)")
+    asyncio.create_task(refresh_rider_index_task())
+    
+    # Expire rider offers at their deadlines (rebuilt from pending assignments)
+    # and cascade each expired offer to the next rider
+    assignment_scheduler.on_expired = redispatch_expired_orders
+    await assignment_scheduler.start()
+    
+    # Periodically match every pending order against every available rider
+    asyncio.create_task(batch_dispatch_task())
+    
+    # Dead-band and coalesce rider GPS fixes, and group-commit them to the database
+    location_stream.on_publish = publish_rider_location
+    location_stream.start()
 
 @app.on_event("shutdown")
 async def shutdown_event():
     """Run shutdown tasks"""
     print("👋 Shutting down GasFill Backend Server...")
+    
+    await assignment_scheduler.stop()
+    await location_stream.stop()  # writes the fixes still behind
+    
+    # Stop the database executor and close pooled connections
+    db.shutdown_executor()
 
 if __name__ == "__main__":
     # Migrate existing in-memory orders to SQLite
-    globals()['order_counter'] = db.migrate_orders(orders_db)
+    db.migrate_orders(orders_db)
     
     # Clear in-memory orders after migration
     orders_db.clear()
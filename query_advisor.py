@@ -0,0 +1,175 @@
+"""
+Query Advisor
+Records the query shapes db.py issues, runs EXPLAIN QUERY PLAN on each one
+and flags statements that fall back to full table scans, or that walk a whole
+index (SQLite's "SCAN t USING [COVERING] INDEX i": every row, in index order).
+
+Inside the server: POST /api/admin/query-advisor/start, exercise the app,
+then GET /api/admin/query-advisor for the report.
+
+From the command line (runs a representative read/sweep workload against a
+throwaway copy of the database, so the real file is never modified):
+    python query_advisor.py [path/to/gasfill.db]
+"""
+import re
+import sqlite3
+import sys
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+
+import db
+
+# Statements worth planning; PRAGMAs, DDL, BEGIN/COMMIT and plain INSERTs are ignored
+PLANNED_STATEMENTS = ('SELECT', 'UPDATE', 'DELETE', 'WITH')
+MAX_SHAPES = 500
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_IN_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_WHITESPACE = re.compile(r"\s+")
+_SCAN = re.compile(r"^SCAN (\w+)(?: USING (?:COVERING )?INDEX (\w+))?$")
+
+def normalize_query(sql: str) -> str:
+    """Reduce a statement to its shape: literals become ?, IN lists and whitespace collapse"""
+    shape = _STRING_LITERAL.sub('?', sql)
+    shape = _NUMBER_LITERAL.sub('?', shape)
+    shape = _IN_LIST.sub('(?, ...)', shape)
+    return _WHITESPACE.sub(' ', shape).strip()
+
+class QueryAdvisor:
+    """Collects distinct query shapes from the pooled connections and explains them"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._shapes: Dict[str, Dict[str, Any]] = {}
+        self.recording = False
+
+    def record(self, sql: str) -> None:
+        """Trace callback: count the statement under its normalized shape"""
+        if not sql.lstrip()[:6].upper().startswith(PLANNED_STATEMENTS):
+            return
+        shape = normalize_query(sql)
+        with self._lock:
+            entry = self._shapes.get(shape)
+            if entry is not None:
+                entry['count'] += 1
+            elif len(self._shapes) < MAX_SHAPES:
+                # Keep one concrete statement per shape; EXPLAIN needs real values
+                self._shapes[shape] = {'count': 1, 'sample': sql}
+
+    def start(self) -> None:
+        db.set_query_trace(self.record)
+        self.recording = True
+
+    def stop(self) -> None:
+        db.set_query_trace(None)
+        self.recording = False
+
+    def reset(self) -> None:
+        with self._lock:
+            self._shapes.clear()
+
+    def report(self) -> List[Dict[str, Any]]:
+        """Explain every recorded shape; full scans first, then full index scans, then by frequency"""
+        with self._lock:
+            shapes = [(shape, dict(entry)) for shape, entry in self._shapes.items()]
+
+        # Separate read-only connection: untraced, and EXPLAIN never touches data
+        conn = sqlite3.connect(f'file:{db.DB_PATH}?mode=ro', uri=True)
+        try:
+            results = []
+            for shape, entry in shapes:
+                try:
+                    rows = conn.execute('EXPLAIN QUERY PLAN ' + entry['sample']).fetchall()
+                    plan = [row[3] for row in rows]
+                    error = None
+                except sqlite3.Error as e:
+                    plan, error = [], str(e)
+
+                scans = [m for m in (_SCAN.match(step) for step in plan) if m]
+                results.append({
+                    'query': shape,
+                    'count': entry['count'],
+                    'plan': plan,
+                    'full_scans': [m.group(1) for m in scans if not m.group(2)],
+                    'index_scans': [f"{m.group(1)} ({m.group(2)})" for m in scans if m.group(2)],
+                    'temp_sort': any('TEMP B-TREE' in step for step in plan),
+                    'error': error
+                })
+        finally:
+            conn.close()
+
+        results.sort(key=lambda r: (not r['full_scans'], not r['index_scans'], -r['count']))
+        return results
+
+advisor = QueryAdvisor()
+
+def run_sample_workload() -> None:
+    """Issue the order queries the server relies on, using values from the current database"""
+    orders = db.get_all_orders()
+    sample = orders[0] if orders else {}
+    rider_ids = [o['rider_id'] for o in orders if o.get('rider_id')]
+    email = sample.get('customer_email') or 'nobody@example.com'
+    rider_id = rider_ids[0] if rider_ids else 0
+
+    db.get_order_by_id(sample.get('id') or 'missing')
+    db.get_orders_for_customer(email)
+    db.query_orders(rider_id=rider_id)
+    db.query_orders(rider_id=rider_id, status='assigned')
+    db.query_orders(rider_id=rider_id, status='delivered', limit=20)
+    db.query_orders(status='pending', unassigned=True, limit=20)
+    db.query_orders(created_after=(datetime.now() - timedelta(days=7)).isoformat())
+    db.query_orders(limit=5)
+    db.count_orders()
+    db.summarize_orders()
+    db.summarize_orders(group_by='rider_id', status='delivered')
+    db.summarize_orders(group_by='customer_email')
+    db.clear_expired_assignments()
+
+def print_report(results: List[Dict[str, Any]]) -> None:
+    scans = [r for r in results if r['full_scans']]
+    index_scans = [r for r in results if r['index_scans'] and not r['full_scans']]
+    print(f"\n📊 {len(results)} query shapes recorded, {len(scans)} with full table scans, "
+          f"{len(index_scans)} with full index scans\n")
+    for r in results:
+        marker = '❌ FULL SCAN' if r['full_scans'] else '⚠️  INDEX SCAN' if r['index_scans'] else '✅'
+        print(f"{marker} ({r['count']}x) {r['query']}")
+        for step in r['plan']:
+            print(f"      {step}")
+        if r['error']:
+            print(f"      ⚠️  {r['error']}")
+    if scans:
+        print(f"\n⚠️  Tables scanned: {', '.join(sorted({t for r in scans for t in r['full_scans']}))}")
+    if index_scans:
+        print(f"⚠️  Indexes scanned end to end: {', '.join(sorted({i for r in index_scans for i in r['index_scans']}))}")
+
+def main(source: Optional[str] = None) -> None:
+    source_path = Path(source) if source else db.DB_PATH
+    if not source_path.exists():
+        print(f"❌ Database not found: {source_path}")
+        sys.exit(1)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Work on a copy: init_db adds any missing indexes and the sweep writes
+        copy_path = Path(tmp) / 'advisor.db'
+        src = sqlite3.connect(source_path)
+        dst = sqlite3.connect(copy_path)
+        src.backup(dst)
+        src.close()
+        dst.close()
+
+        db.DB_PATH = copy_path
+        db.init_db()
+        advisor.start()
+        try:
+            run_sample_workload()
+        finally:
+            advisor.stop()
+        print_report(advisor.report())
+        db.close_all_connections()
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,333 @@
+"""
+Realtime
+Topic-based WebSocket pub/sub for chat, order tracking and dispatch events.
+
+Each socket subscribes to topics and publish() delivers an event only to the
+sockets subscribed to at least one of its topics, so traffic grows with
+interested subscribers instead of connections x events:
+
+    chat:<room_id>    chat messages, typing, read/delivered receipts
+    order:<order_id>  status changes and live rider location for one order
+    rider:<rider_id>  a rider's own feed: offers, verification results
+    user:<user_id>    a customer's own feed
+    admin             dispatch escalations and every order/rider event
+
+Connections authenticate with the JWT from ?token=. Personal feeds (rider:,
+user:, admin) are subscribed on connect; order and chat topics are
+subscribed on request and checked against the order / chat participants.
+Anonymous sockets stay connected for ping/pong but receive no topic traffic.
+"""
+import asyncio
+import json
+import os
+from collections import Counter, deque
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Set, Union
+
+from fastapi import WebSocket
+
+import db
+from ws_codec import JSON, Event, encoding_event
+
+ADMIN_TOPIC = "admin"
+
+EventLike = Union[Event, Dict[str, Any], str]
+
+SEND_QUEUE_SIZE = int(os.environ.get("GASFILL_WS_QUEUE_SIZE", "256"))
+
+# What happens when a socket's queue is full: drop its oldest queued event,
+# or disconnect it. Events published with a coalesce_key (rider positions,
+# typing indicators) always replace their queued predecessor first.
+DROP_OLDEST = "drop_oldest"
+DISCONNECT = "disconnect"
+SLOW_CONSUMER_POLICY = os.environ.get("GASFILL_WS_SLOW_POLICY", DROP_OLDEST)
+
+def chat_topic(chat_room_id) -> str:
+    return f"chat:{chat_room_id}"
+
+def order_topic(order_id) -> str:
+    return f"order:{order_id}"
+
+def rider_topic(rider_id) -> str:
+    return f"rider:{rider_id}"
+
+def user_topic(user_id) -> str:
+    return f"user:{user_id}"
+
+def user_role(user: Optional[Dict[str, Any]]) -> Optional[str]:
+    """'admin', 'rider', 'customer', or None for anonymous sockets"""
+    if not user:
+        return None
+    role = user.get("role")
+    return role if role in ("admin", "rider") else "customer"
+
+def default_topics(user: Optional[Dict[str, Any]]) -> List[str]:
+    """Personal feeds a connection is subscribed to as soon as it authenticates"""
+    role = user_role(user)
+    if role is None:
+        return []
+    if role == "rider":
+        return [rider_topic(user["id"])]
+    topics = [user_topic(user["id"])]
+    if role == "admin":
+        topics.append(ADMIN_TOPIC)
+    return topics
+
+async def can_subscribe(user: Optional[Dict[str, Any]], topic: str) -> bool:
+    """Whether a connection's user may receive a topic's events"""
+    role = user_role(user)
+    if role is None:
+        return False
+    if role == "admin":
+        return True
+
+    kind, _, key = topic.partition(":")
+    if kind == "order" and key:
+        order = await db.aio.get_order_by_id(key)
+        if not order:
+            return False
+        if role == "rider":
+            offered = str(order.get("assigned_riders") or "").split(",")
+            return order.get("rider_id") == user["id"] or str(user["id"]) in offered
+        return order.get("customer_email") == user.get("email")
+    if kind == "chat" and key:
+        return await db.aio.is_chat_participant(key, user["id"], role)
+    return topic in default_topics(user)
+
+class Outbox:
+    """Bounded send queue of one socket, drained by its own writer task"""
+
+    def __init__(self, websocket: WebSocket, encoding: str = JSON, maxsize: int = SEND_QUEUE_SIZE):
+        self.websocket = websocket
+        self.encoding = encoding
+        self.maxsize = maxsize
+        # Entries are [event, coalesce_key]; a coalesced update replaces the
+        # event in place so it keeps its original place in line
+        self.queue: Deque[List[Any]] = deque()
+        self.pending: Dict[str, List[Any]] = {}
+        self.ready = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+
+    def put(self, message: Event, coalesce_key: Optional[str] = None) -> bool:
+        """Queue a message; False if the queue is full and the policy is to disconnect"""
+        if coalesce_key is not None:
+            entry = self.pending.get(coalesce_key)
+            if entry is not None:
+                entry[0] = message
+                self.coalesced += 1
+                return True
+        if len(self.queue) >= self.maxsize:
+            if SLOW_CONSUMER_POLICY == DISCONNECT:
+                return False
+            _, oldest_key = self.queue.popleft()
+            if oldest_key is not None:
+                del self.pending[oldest_key]
+            self.dropped += 1
+        entry = [message, coalesce_key]
+        self.queue.append(entry)
+        if coalesce_key is not None:
+            self.pending[coalesce_key] = entry
+        self.max_depth = max(self.max_depth, len(self.queue))
+        self.ready.set()
+        return True
+
+    def _next(self) -> Event:
+        message, coalesce_key = self.queue.popleft()
+        if coalesce_key is not None:
+            del self.pending[coalesce_key]
+        return message
+
+    async def run(self, on_error: Callable[[WebSocket], None]) -> None:
+        while True:
+            await self.ready.wait()
+            while self.queue:
+                try:
+                    frame = self._next().frame(self.encoding)
+                    if isinstance(frame, bytes):
+                        await self.websocket.send_bytes(frame)
+                    else:
+                        await self.websocket.send_text(frame)
+                    self.sent += 1
+                    self.bytes_sent += len(frame)
+                except (OSError, RuntimeError, ConnectionResetError) as e:
+                    print(f"[ConnectionManager] Connection error during send: {type(e).__name__}")
+                    on_error(self.websocket)
+                    return
+                except Exception as e:
+                    print(f"[ConnectionManager] Error sending to connection: {type(e).__name__}: {e}")
+                    on_error(self.websocket)
+                    return
+            self.ready.clear()
+
+class ConnectionManager:
+    """Sockets, their users, their outboxes and a topic -> sockets index
+
+    publish() only appends to the subscribers' outboxes, so one slow client
+    delays nobody but itself.
+    """
+
+    def __init__(self):
+        self.users: Dict[WebSocket, Optional[Dict[str, Any]]] = {}
+        self.subscriptions: Dict[WebSocket, Set[str]] = {}
+        self.topics: Dict[str, Set[WebSocket]] = {}
+        self.outboxes: Dict[WebSocket, Outbox] = {}
+        self.sent = 0
+        self.bytes_sent = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.slow_disconnects = 0
+
+    @property
+    def active_connections(self) -> List[WebSocket]:
+        return list(self.users)
+
+    async def connect(self, websocket: WebSocket, user: Optional[Dict[str, Any]] = None, encoding: str = JSON):
+        try:
+            await websocket.accept()
+        except Exception as e:
+            print(f"[ConnectionManager] Error accepting connection: {e}")
+            raise
+        if encoding != JSON:
+            # JSON text, ahead of the writer, so the client can read it before knowing the format
+            await websocket.send_text(json.dumps(encoding_event(encoding)))
+        self.users[websocket] = user
+        self.subscriptions[websocket] = set()
+        outbox = self.outboxes[websocket] = Outbox(websocket, encoding)
+        outbox.task = asyncio.create_task(outbox.run(self.disconnect))
+        for topic in default_topics(user):
+            self.subscribe(websocket, topic)
+        who = f"{user_role(user)} {user['id']}" if user else "anonymous"
+        print(f"[ConnectionManager] New connection ({who}, {encoding}). Total active: {len(self.users)}")
+
+    def disconnect(self, websocket: WebSocket, close_code: Optional[int] = None):
+        try:
+            if websocket not in self.users:
+                return
+            for topic in self.subscriptions.pop(websocket, ()):
+                self._remove_subscriber(topic, websocket)
+            del self.users[websocket]
+            outbox = self.outboxes.pop(websocket)
+            self.sent += outbox.sent
+            self.bytes_sent += outbox.bytes_sent
+            self.dropped += outbox.dropped
+            self.coalesced += outbox.coalesced
+            if outbox.task is not None and outbox.task is not asyncio.current_task():
+                outbox.task.cancel()
+            if close_code is not None:
+                asyncio.create_task(self._close(websocket, close_code))
+            print(f"[ConnectionManager] Connection removed. Total active: {len(self.users)}")
+        except Exception as e:
+            print(f"[ConnectionManager] Error disconnecting: {e}")
+
+    async def _close(self, websocket: WebSocket, code: int) -> None:
+        try:
+            await websocket.close(code=code)
+        except Exception:
+            pass  # already gone
+
+    def user(self, websocket: WebSocket) -> Optional[Dict[str, Any]]:
+        return self.users.get(websocket)
+
+    def subscribe(self, websocket: WebSocket, topic: str) -> None:
+        if websocket not in self.users:
+            return
+        self.subscriptions[websocket].add(topic)
+        self.topics.setdefault(topic, set()).add(websocket)
+
+    def unsubscribe(self, websocket: WebSocket, topic: str) -> None:
+        subscribed = self.subscriptions.get(websocket)
+        if subscribed is not None and topic in subscribed:
+            subscribed.discard(topic)
+            self._remove_subscriber(topic, websocket)
+
+    def _remove_subscriber(self, topic: str, websocket: WebSocket) -> None:
+        subscribers = self.topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(websocket)
+            if not subscribers:
+                del self.topics[topic]
+
+    def subscribers(self, topics: Union[str, Iterable[str]]) -> Set[WebSocket]:
+        """Sockets subscribed to any of the topics, each once"""
+        if isinstance(topics, str):
+            topics = (topics,)
+        sockets: Set[WebSocket] = set()
+        for topic in topics:
+            sockets.update(self.topics.get(topic, ()))
+        return sockets
+
+    def _enqueue(self, sockets: Iterable[WebSocket], message: EventLike, coalesce_key: Optional[str] = None) -> int:
+        # Encoded at most once per wire format, however many sockets get it
+        message = Event.of(message)
+        outboxes = [(websocket, self.outboxes[websocket]) for websocket in sockets if websocket in self.outboxes]
+        # Encode up front so a bad payload fails in the publisher, not in a writer task
+        for encoding in {outbox.encoding for _, outbox in outboxes}:
+            message.frame(encoding)
+
+        queued = 0
+        slow = []
+        for websocket, outbox in outboxes:
+            if outbox.put(message, coalesce_key):
+                queued += 1
+            else:
+                slow.append(websocket)
+
+        for websocket in slow:
+            print(f"[ConnectionManager] Disconnecting slow consumer ({SEND_QUEUE_SIZE} events queued)")
+            self.slow_disconnects += 1
+            self.disconnect(websocket, close_code=1013)  # try again later
+        return queued
+
+    async def send_personal_message(self, message: EventLike, websocket: WebSocket):
+        self._enqueue((websocket,), message)
+
+    async def send_json(self, websocket: WebSocket, data: Dict[str, Any]):
+        """Queue an event for one socket, behind anything already queued for it"""
+        self._enqueue((websocket,), data)
+
+    async def publish(
+        self,
+        topics: Union[str, Iterable[str]],
+        message: EventLike,
+        coalesce_key: Optional[str] = None
+    ) -> int:
+        """Queue for every socket subscribed to any of the topics; returns how many queued it
+
+        message is the event dict (or an Event, or pre-encoded JSON text).
+
+        Events sharing a coalesce_key replace each other while still queued, so
+        a slow client gets the latest rider position rather than a backlog.
+        """
+        return self._enqueue(self.subscribers(topics), message, coalesce_key)
+
+    async def broadcast(self, message: EventLike) -> int:
+        """Queue for every connected socket (system-wide announcements only)"""
+        return self._enqueue(list(self.users), message)
+
+    def stats(self) -> Dict[str, Any]:
+        outboxes = list(self.outboxes.values())
+        depths = [len(outbox.queue) for outbox in outboxes]
+        return {
+            "connections": len(self.users),
+            "authenticated": sum(1 for user in self.users.values() if user),
+            "topics": len(self.topics),
+            "subscriptions": sum(len(topics) for topics in self.subscriptions.values()),
+            "encodings": dict(Counter(outbox.encoding for outbox in outboxes)),
+            "send_queue": {
+                "size": SEND_QUEUE_SIZE,
+                "slow_consumer_policy": SLOW_CONSUMER_POLICY,
+                "queued": sum(depths),
+                "max_depth": max(depths, default=0),
+                "peak_depth": max((outbox.max_depth for outbox in outboxes), default=0),
+                "backlogged_connections": sum(1 for depth in depths if depth >= SEND_QUEUE_SIZE // 2),
+                "sent": self.sent + sum(outbox.sent for outbox in outboxes),
+                "bytes_sent": self.bytes_sent + sum(outbox.bytes_sent for outbox in outboxes),
+                "dropped": self.dropped + sum(outbox.dropped for outbox in outboxes),
+                "coalesced": self.coalesced + sum(outbox.coalesced for outbox in outboxes),
+                "slow_disconnects": self.slow_disconnects,
+            },
+        }
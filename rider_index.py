@@ -0,0 +1,167 @@
+"""
+Rider Spatial Index
+Live grid of rider positions for nearest-rider and within-radius queries.
+
+Positions are bucketed into fixed CELL_DEGREES x CELL_DEGREES cells. A
+k-nearest query searches rings of cells around the query point and stops as
+soon as no unvisited cell can hold anything closer than the k-th hit, so the
+work depends on how many riders are nearby, not on how many are online.
+
+The index only knows where riders are. Availability changes on many paths
+(assignment, delivery, going offline), so callers filter candidates against
+the riders table. Build it with rebuild() at startup and keep it current with
+update() wherever a rider reports a GPS fix.
+"""
+import heapq
+import json
+import math
+import threading
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from geo import EARTH_RADIUS_KM, distance_km
+
+CELL_DEGREES = 0.01  # ~1.1 km at the equator
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+Cell = Tuple[int, int]
+
+def parse_location(location) -> Optional[Dict[str, float]]:
+    """Normalize a stored location ({lat, lng} or {latitude, longitude}, dict or JSON) to {lat, lng}"""
+    if not location:
+        return None
+    try:
+        if isinstance(location, str):
+            location = json.loads(location)
+        lat = location.get('lat', location.get('latitude'))
+        lng = location.get('lng', location.get('longitude'))
+        if lat is None or lng is None:
+            return None
+        return {'lat': float(lat), 'lng': float(lng)}
+    except (ValueError, TypeError, AttributeError):
+        return None
+
+def _cell(lat: float, lng: float) -> Cell:
+    return (math.floor(lat / CELL_DEGREES), math.floor(lng / CELL_DEGREES))
+
+class RiderSpatialIndex:
+    """Uniform lat/lng grid: rider_id -> position, cell -> rider ids"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._positions: Dict[int, Tuple[float, float, Cell]] = {}
+        self._cells: Dict[Cell, Set[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def update(self, rider_id: int, lat: float, lng: float) -> None:
+        cell = _cell(lat, lng)
+        with self._lock:
+            previous = self._positions.get(rider_id)
+            if previous and previous[2] != cell:
+                self._discard(rider_id, previous[2])
+            self._positions[rider_id] = (lat, lng, cell)
+            self._cells.setdefault(cell, set()).add(rider_id)
+
+    def update_location(self, rider_id: int, location) -> bool:
+        """update() from a stored location in either format; False if it has no coordinates"""
+        point = parse_location(location)
+        if not point or rider_id is None:
+            return False
+        self.update(int(rider_id), point['lat'], point['lng'])
+        return True
+
+    def remove(self, rider_id: int) -> None:
+        with self._lock:
+            previous = self._positions.pop(rider_id, None)
+            if previous:
+                self._discard(rider_id, previous[2])
+
+    def _discard(self, rider_id: int, cell: Cell) -> None:
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(rider_id)
+            if not members:
+                del self._cells[cell]
+
+    def rebuild(self, riders: Iterable[Tuple[int, object]]) -> int:
+        """Replace the index with (rider_id, location) pairs, e.g. from db.get_rider_locations()"""
+        with self._lock:
+            self._positions.clear()
+            self._cells.clear()
+        count = 0
+        for rider_id, location in riders:
+            count += self.update_location(rider_id, location)
+        return count
+
+    def position(self, rider_id: int) -> Optional[Tuple[float, float]]:
+        entry = self._positions.get(rider_id)
+        return (entry[0], entry[1]) if entry else None
+
+    def _ring(self, center: Cell, r: int) -> Iterable[Cell]:
+        """Cells at Chebyshev distance r from center"""
+        ci, cj = center
+        if r == 0:
+            yield center
+            return
+        for dj in range(-r, r + 1):
+            yield (ci - r, cj + dj)
+            yield (ci + r, cj + dj)
+        for di in range(-r + 1, r):
+            yield (ci + di, cj - r)
+            yield (ci + di, cj + r)
+
+    def nearest(
+        self,
+        lat: float,
+        lng: float,
+        k: int = 10,
+        exclude: Iterable[int] = (),
+        max_km: Optional[float] = None
+    ) -> List[Tuple[float, int]]:
+        """Up to k (distance_km, rider_id) pairs, closest first"""
+        exclude = set(exclude)
+        center = _cell(lat, lng)
+        # Smallest cell edge in km; longitude cells shrink away from the equator
+        cell_km = CELL_DEGREES * KM_PER_DEGREE * max(math.cos(math.radians(min(abs(lat) + 1, 89))), 0.01)
+        best: List[Tuple[float, int]] = []  # max-heap of the k closest, as (-distance, id)
+
+        with self._lock:
+            remaining = len(self._positions)
+            r = 0
+            while remaining > 0:
+                # Once the ring is wider than the occupied grid, finish with a plain scan
+                if r > 0 and 8 * r >= len(self._cells):
+                    cells = [c for c in self._cells if max(abs(c[0] - center[0]), abs(c[1] - center[1])) >= r]
+                else:
+                    cells = self._ring(center, r)
+                for cell in cells:
+                    for rider_id in self._cells.get(cell, ()):
+                        remaining -= 1
+                        if rider_id in exclude:
+                            continue
+                        rlat, rlng, _ = self._positions[rider_id]
+                        distance = distance_km(lat, lng, rlat, rlng)
+                        if max_km is not None and distance > max_km:
+                            continue
+                        if len(best) < k:
+                            heapq.heappush(best, (-distance, rider_id))
+                        elif distance < -best[0][0]:
+                            heapq.heapreplace(best, (-distance, rider_id))
+                if r > 0 and 8 * r >= len(self._cells):
+                    break
+                # Everything outside the searched square is at least r cells away
+                reach = r * cell_km
+                if len(best) == k and -best[0][0] <= reach:
+                    break
+                if max_km is not None and reach > max_km:
+                    break
+                r += 1
+
+        return sorted((-d, rider_id) for d, rider_id in best)
+
+    def within_radius(self, lat: float, lng: float, radius_km: float) -> List[Tuple[float, int]]:
+        """All (distance_km, rider_id) pairs within radius_km, closest first"""
+        return self.nearest(lat, lng, k=len(self._positions) or 1, max_km=radius_km)
+
+index = RiderSpatialIndex()
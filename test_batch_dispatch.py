@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Test Batch Dispatch Solver
+Checks the NumPy assignment solver against brute force on small matrices:
+- square and rectangular (more orders than riders, and the other way round)
+- many ties (costs drawn from 0-3)
+- forbidden pairs (+inf), including matrices with no feasible assignment
+
+Runs without the server: python test_batch_dispatch.py (or pytest).
+"""
+
+import itertools
+
+import numpy as np
+
+import batch_dispatch
+
+TRIALS = 2000
+
+def brute_force_cost(cost):
+    """Cheapest total over every assignment of min(n, m) pairs; inf if none avoids +inf"""
+    n, m = cost.shape
+    best = np.inf
+    if n <= m:
+        for cols in itertools.permutations(range(m), n):
+            best = min(best, cost[np.arange(n), list(cols)].sum())
+    else:
+        for rows in itertools.permutations(range(n), m):
+            best = min(best, cost[list(rows), np.arange(m)].sum())
+    return best
+
+def check_against_brute_force(shapes, forbidden_share, seed):
+    """Solve random matrices with the NumPy solver (scipy disabled); returns how many disagree"""
+    rng = np.random.default_rng(seed)
+    scipy_lsa, batch_dispatch._scipy_lsa = batch_dispatch._scipy_lsa, None
+    mismatches = 0
+    try:
+        for _ in range(TRIALS):
+            n, m = shapes[rng.integers(len(shapes))]
+            cost = rng.integers(0, 4, (n, m)).astype(float)
+            if forbidden_share:
+                cost[rng.random((n, m)) < forbidden_share] = np.inf
+            expected = brute_force_cost(cost)
+            try:
+                rows, cols = batch_dispatch.solve_assignment(cost)
+            except ValueError:
+                mismatches += expected != np.inf
+                continue
+            if (len(rows) != min(n, m) or len(set(rows.tolist())) != len(rows)
+                    or len(set(cols.tolist())) != len(cols) or cost[rows, cols].sum() != expected):
+                mismatches += 1
+    finally:
+        batch_dispatch._scipy_lsa = scipy_lsa
+    return mismatches
+
+def test_square_matrices():
+    """Square matrices with ties"""
+    print("[*] Testing square matrices...")
+    assert check_against_brute_force([(n, n) for n in range(1, 7)], 0.0, seed=1) == 0
+
+def test_rectangular_matrices():
+    """Wide and tall matrices with ties"""
+    print("[*] Testing rectangular matrices...")
+    shapes = [(n, m) for n in range(1, 6) for m in range(1, 6) if n != m]
+    assert check_against_brute_force(shapes, 0.0, seed=2) == 0
+
+def test_forbidden_pairs():
+    """+inf entries are never matched; infeasible matrices raise ValueError"""
+    print("[*] Testing forbidden (+inf) pairs...")
+    shapes = [(n, m) for n in range(1, 6) for m in range(1, 6)]
+    assert check_against_brute_force(shapes, 0.35, seed=3) == 0
+
+def test_infeasible_matrix_raises():
+    """A row with every pair forbidden cannot be matched"""
+    print("[*] Testing an infeasible matrix...")
+    cost = np.array([[1.0, 2.0], [np.inf, np.inf]])
+    scipy_lsa, batch_dispatch._scipy_lsa = batch_dispatch._scipy_lsa, None
+    try:
+        batch_dispatch.solve_assignment(cost)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("expected ValueError for an infeasible cost matrix")
+    finally:
+        batch_dispatch._scipy_lsa = scipy_lsa
+
+if __name__ == "__main__":
+    print("=" * 70)
+    print("  BATCH DISPATCH SOLVER TESTS")
+    print("=" * 70)
+    test_square_matrices()
+    test_rectangular_matrices()
+    test_forbidden_pairs()
+    test_infeasible_matrix_raises()
+    print("✅ Solver matches brute force")
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Test Delivery Fee Re-pricing
+db.recompute_delivery_fees() re-prices located orders with the rules in geo.py:
+- only orders whose fee changed are rewritten, and the count says how many
+- unlocated orders and non-numeric coordinates are skipped, not fatal
+- a million seeded orders are re-priced within TIME_LIMIT seconds
+
+Runs against a temporary database, without the server:
+python test_delivery_fees.py (or pytest).
+"""
+
+import json
+import os
+import tempfile
+import time
+
+import db
+import geo
+
+LARGE_ORDERS = 1_000_000
+TIME_LIMIT = 10.0
+
+def setup_database():
+    db.close_all_connections()
+    db.DB_PATH = os.path.join(tempfile.mkdtemp(), 'fees_test.db')
+    db.init_db()
+
+def create_located_order(location, total, delivery_fee):
+    return db.create_order({
+        "items": [],
+        "total": total,
+        "status": "pending",
+        "customer_location": json.dumps(location) if location is not None else None,
+        "delivery_fee": delivery_fee
+    })['id']
+
+def fees_by_id():
+    rows = db.get_connection().execute('SELECT id, delivery_fee FROM orders').fetchall()
+    return {row['id']: row['delivery_fee'] for row in rows}
+
+def test_only_stale_fees_change():
+    """Stale fees are fixed and counted; correct, unlocated and malformed orders are left as they were"""
+    print("[*] Testing re-pricing of stale fees...")
+    setup_database()
+    lat, lng = 5.65, -0.20
+    fee = geo.delivery_fee(geo.distance_m(geo.STATION_LAT, geo.STATION_LNG, lat, lng), 500.0)
+    capped = geo.delivery_fee(geo.distance_m(geo.STATION_LAT, geo.STATION_LNG, lat, lng), 20.0)
+
+    stale = [
+        create_located_order({"lat": lat, "lng": lng}, 500.0, 10.0),
+        create_located_order({"latitude": lat, "longitude": lng}, 500.0, 99.0),
+        create_located_order({"lat": lat, "lng": lng}, 20.0, fee),  # now capped at 50% of the total
+    ]
+    current = create_located_order({"lat": lat, "lng": lng}, 500.0, fee)
+    skipped = [
+        create_located_order(None, 500.0, 7.0),
+        create_located_order({"lat": "unknown", "lng": lng}, 500.0, 7.0),
+        create_located_order({"address": "Osu"}, 500.0, 7.0),
+    ]
+    before = fees_by_id()
+
+    assert db.recompute_delivery_fees() == len(stale)
+    after = fees_by_id()
+    assert after[stale[0]] == after[stale[1]] == fee
+    assert after[stale[2]] == capped
+    for order_id in [current] + skipped:
+        assert after[order_id] == before[order_id]
+
+    # A second pass has nothing left to change
+    assert db.recompute_delivery_fees() == 0
+
+def test_changed_rows_only_written():
+    """Orders with a current fee are not rewritten at all"""
+    print("[*] Testing that unchanged rows are not written...")
+    setup_database()
+    lat, lng = 5.60, -0.17
+    fee = geo.delivery_fee(geo.distance_m(geo.STATION_LAT, geo.STATION_LNG, lat, lng), 0)
+    for _ in range(5):
+        create_located_order({"lat": lat, "lng": lng}, 0, fee)
+    stale = create_located_order({"lat": lat, "lng": lng}, 0, 0.0)
+
+    conn = db.get_connection()
+    changes = conn.total_changes
+    assert db.recompute_delivery_fees() == 1
+    assert conn.total_changes - changes == 1
+    assert fees_by_id()[stale] == fee
+
+def test_large_table_timing():
+    """A million located orders, a tenth of them stale, re-priced within TIME_LIMIT"""
+    print(f"[*] Testing re-pricing {LARGE_ORDERS:,} orders...")
+    setup_database()
+    conn = db.get_connection()
+    with db.transaction():
+        conn.execute('''
+            WITH RECURSIVE n(i) AS (SELECT 0 UNION ALL SELECT i + 1 FROM n WHERE i + 1 < ?)
+            INSERT INTO orders (id, total, status, customer_location, delivery_fee)
+            SELECT 'FEE-' || i, 50 + i % 400, 'delivered',
+                   json_object('lat', 5.50 + (i % 1000) * 0.0003, 'lng', -0.30 + (i / 1000) * 0.0003),
+                   0
+            FROM n
+        ''', (LARGE_ORDERS,))
+    # Price every order once, then make every tenth fee stale
+    db.recompute_delivery_fees()
+    with db.transaction():
+        conn.execute("UPDATE orders SET delivery_fee = delivery_fee + 1 WHERE id LIKE 'FEE-%' AND CAST(substr(id, 5) AS INTEGER) % 10 = 0")
+
+    started = time.perf_counter()
+    updated = db.recompute_delivery_fees()
+    elapsed = time.perf_counter() - started
+    print(f"    {updated:,} of {LARGE_ORDERS:,} fees rewritten in {elapsed:.2f}s")
+    assert updated == LARGE_ORDERS // 10
+    assert elapsed < TIME_LIMIT, f"re-pricing took {elapsed:.2f}s"
+
+if __name__ == "__main__":
+    print("=" * 70)
+    print("  DELIVERY FEE RE-PRICING TESTS")
+    print("=" * 70)
+    test_only_stale_fees_change()
+    test_changed_rows_only_written()
+    test_large_table_timing()
+    print("✅ Delivery fees re-priced")
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""
+Test Broadcast Order Offers
+Several riders accept the same broadcast offer at the same moment; exactly
+one of them must get the order and every other offer must be closed as taken.
+
+Runs against a temporary database, without the server:
+python test_order_offers.py (or pytest).
+"""
+
+import os
+import tempfile
+import threading
+
+import db
+
+RIDERS = 8
+ROUNDS = 20
+
+def setup_database():
+    db.close_all_connections()
+    db.DB_PATH = os.path.join(tempfile.mkdtemp(), 'offers_test.db')
+    db.init_db()
+    return [
+        db.create_rider({
+            "username": f"rider{i}",
+            "email": f"rider{i}@example.com",
+            "password": "test123",
+            "phone": f"02400000{i:02d}"
+        })['id']
+        for i in range(RIDERS)
+    ]
+
+def claim_concurrently(order_id, rider_ids):
+    """Every rider claims at once (one thread and connection each); returns {rider_id: (order, outbid)}"""
+    barrier = threading.Barrier(len(rider_ids))
+    results = {}
+
+    def claim(rider_id):
+        barrier.wait()
+        results[rider_id] = db.claim_order_offer(order_id, rider_id, {"rider_id": rider_id})
+
+    threads = [threading.Thread(target=claim, args=(rider_id,)) for rider_id in rider_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def test_first_accept_wins():
+    """Exactly one concurrent claim wins; the winner owns the order and the others are outbid"""
+    print("[*] Testing concurrent claims on one offer...")
+    rider_ids = setup_database()
+    for _ in range(ROUNDS):
+        order_id = db.create_order({"items": [], "total": 100.0, "status": "pending"})['id']
+        assert db.create_order_offers(order_id, rider_ids)
+
+        results = claim_concurrently(order_id, rider_ids)
+        winners = [rider_id for rider_id, (order, _) in results.items() if order]
+        assert len(winners) == 1, f"expected one winner, got {winners}"
+        winner = winners[0]
+
+        order = db.get_order_by_id(order_id)
+        assert order['rider_id'] == winner and order['status'] == 'assigned'
+        assert sorted(results[winner][1]) == sorted(r for r in rider_ids if r != winner)
+
+        offers = db.get_connection().execute(
+            'SELECT rider_id, status FROM order_offers WHERE order_id=?', (order_id,)
+        ).fetchall()
+        assert {row['rider_id']: row['status'] for row in offers} == {
+            rider_id: 'accepted' if rider_id == winner else 'taken' for rider_id in rider_ids
+        }
+
+def test_claim_after_win_fails():
+    """A late accept on an order that is already assigned gets nothing"""
+    print("[*] Testing a late claim...")
+    rider_ids = setup_database()
+    order_id = db.create_order({"items": [], "total": 100.0, "status": "pending"})['id']
+    db.create_order_offers(order_id, rider_ids[:2])
+    assert db.claim_order_offer(order_id, rider_ids[0], {})[0]
+    assert db.claim_order_offer(order_id, rider_ids[1], {}) == (None, [])
+    assert db.get_order_by_id(order_id)['rider_id'] == rider_ids[0]
+
+if __name__ == "__main__":
+    print("=" * 70)
+    print("  BROADCAST OFFER TESTS")
+    print("=" * 70)
+    test_first_accept_wins()
+    test_claim_after_win_fails()
+    print("✅ Exactly one rider wins each offer")
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Test Order Records
+Orders fetched from the database are dicts whose JSON columns are decoded
+on first access. They must serialize like plain dicts:
+- json.dumps(order) round-trips with every JSON column decoded
+- an order published through the WebSocket manager arrives intact
+
+Runs against a temporary database, without the server:
+python test_order_records.py (or pytest).
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+
+import db
+from realtime import ConnectionManager, order_topic
+
+ITEMS = [{"name": "Gas 12.5kg", "quantity": 2, "price": 120.0}]
+LOCATION = {"lat": 5.6148, "lng": -0.2059}
+TRACKING_INFO = {"eta_minutes": 25}
+
+def setup_order():
+    db.close_all_connections()
+    db.DB_PATH = os.path.join(tempfile.mkdtemp(), 'records_test.db')
+    db.init_db()
+    order = db.create_order({
+        "items": ITEMS,
+        "total": 240.0,
+        "status": "pending",
+        "customer_location": json.dumps(LOCATION),
+        "tracking_info": TRACKING_INFO
+    })
+    return order['id']
+
+def check_decoded(order):
+    assert order['items'] == ITEMS
+    assert order['customer_location'] == LOCATION
+    assert order['tracking_info'] == TRACKING_INFO
+    assert order['delivery_fee'] == 10.0
+
+class RecordingSocket:
+    """Stands in for a WebSocket: keeps every text frame it is sent"""
+
+    def __init__(self):
+        self.frames = []
+
+    async def accept(self):
+        pass
+
+    async def send_text(self, text):
+        self.frames.append(text)
+
+    async def send_bytes(self, data):
+        self.frames.append(data)
+
+def test_fetched_order_is_a_dict():
+    """Fetched orders are dicts and copy out fully decoded"""
+    print("[*] Testing fetched orders are dicts...")
+    order_id = setup_order()
+    order = db.get_order_by_id(order_id)
+    assert isinstance(order, dict)
+    check_decoded(dict(db.get_order_by_id(order_id)))
+    check_decoded({**db.get_order_by_id(order_id)})
+    check_decoded(db.get_order_by_id(order_id).copy())
+    assert db.get_order_by_id(order_id) == dict(order)
+
+def test_json_round_trip():
+    """json.dumps of a fetched order (alone and in a list) decodes every JSON column"""
+    print("[*] Testing json.dumps round trip...")
+    order_id = setup_order()
+    order = db.get_order_by_id(order_id)
+    decoded = json.loads(json.dumps(order))
+    check_decoded(decoded)
+    assert decoded == json.loads(json.dumps(dict(db.get_order_by_id(order_id))))
+    check_decoded(json.loads(json.dumps(db.get_all_orders()))[0])
+
+def test_published_order_payload():
+    """An order inside a published event reaches the subscriber decoded"""
+    print("[*] Testing an order in a published event...")
+    order_id = setup_order()
+
+    async def publish():
+        manager = ConnectionManager()
+        socket = RecordingSocket()
+        await manager.connect(socket)
+        manager.subscribe(socket, order_topic(order_id))
+        order = db.get_order_by_id(order_id)
+        assert await manager.publish(order_topic(order_id), {"type": "order_update", "data": order}) == 1
+        await asyncio.sleep(0.05)  # let the socket's writer task send it
+        manager.disconnect(socket)
+        return socket.frames
+
+    frames = asyncio.run(publish())
+    assert len(frames) == 1
+    event = json.loads(frames[0])
+    assert event["type"] == "order_update"
+    assert event["data"]["id"] == order_id
+    check_decoded(event["data"])
+
+if __name__ == "__main__":
+    print("=" * 70)
+    print("  ORDER RECORD TESTS")
+    print("=" * 70)
+    test_fetched_order_is_a_dict()
+    test_json_round_trip()
+    test_published_order_payload()
+    print("✅ Order records serialize like dicts")
@@ -0,0 +1,148 @@
+"""
+WebSocket Event Codec
+Encodes each published event once per wire format and shares the frame.
+
+Formats, chosen per connection with /ws?encoding=...&compress=...:
+    json      text frames, compact separators (the default)
+    msgpack   binary frames: one header byte, then the MessagePack body with
+              the keys in KEY_ALIASES shortened (latitude -> la, ...)
+
+Header byte of binary frames: FRAME_PLAIN, or FRAME_DEFLATE when the body is
+raw-deflated (zlib wbits=-15). Only connections that asked for
+compress=deflate get deflated frames, and only bodies of at least
+COMPRESS_MIN_BYTES; small frames such as rider positions gain nothing. The
+standard permessage-deflate extension is negotiated separately by uvicorn for
+clients that offer it.
+
+Clients may send events in the same binary format (decode()); rider
+location updates are the bulk of upstream traffic. msgpack is optional:
+without it every connection falls back to JSON. Binary connections are
+told their format and key table in a JSON "encoding" event on connect.
+"""
+import json
+import zlib
+from typing import Any, Dict, Optional, Union
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional
+    msgpack = None
+
+JSON = "json"
+MSGPACK = "msgpack"
+MSGPACK_DEFLATE = "msgpack+deflate"
+
+FRAME_PLAIN = 0x00
+FRAME_DEFLATE = 0x01
+COMPRESS_MIN_BYTES = 256
+
+# Long keys that appear in nearly every event; values and other keys pass through
+KEY_ALIASES = {
+    "type": "t",
+    "data": "d",
+    "timestamp": "ts",
+    "order_id": "o",
+    "rider_id": "r",
+    "user_id": "u",
+    "chat_room_id": "c",
+    "latitude": "la",
+    "longitude": "lo",
+    "accuracy": "ac",
+    "speed": "sp",
+    "heading": "hd",
+    "status": "s",
+    "message_ids": "mi",
+}
+
+EXPANDED_KEYS = {short: key for key, short in KEY_ALIASES.items()}
+
+class DecodeError(ValueError):
+    """A client frame that is not a JSON or MessagePack event object"""
+
+def negotiate(encoding: Optional[str], compress: Optional[str] = None) -> str:
+    """Wire format for a connection's ?encoding=/&compress= request"""
+    if encoding != MSGPACK or msgpack is None:
+        return JSON
+    return MSGPACK_DEFLATE if compress == "deflate" else MSGPACK
+
+def _rename(value: Any, names: Dict[str, str]) -> Any:
+    if isinstance(value, dict):
+        return {names.get(key, key): _rename(item, names) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_rename(item, names) for item in value]
+    return value
+
+def decode(frame: Union[str, bytes]) -> Dict[str, Any]:
+    """Event from a client frame: JSON text, or a binary frame in the format above"""
+    try:
+        if isinstance(frame, str):
+            event = json.loads(frame)
+        elif msgpack is None:
+            raise DecodeError("binary frames need msgpack")
+        else:
+            body = frame[1:]
+            if frame[:1] == bytes((FRAME_DEFLATE,)):
+                body = zlib.decompress(body, -15)
+            event = _rename(msgpack.unpackb(body), EXPANDED_KEYS)
+    except DecodeError:
+        raise
+    except Exception as e:
+        raise DecodeError(str(e)) from e
+    if not isinstance(event, dict):
+        raise DecodeError("event must be an object")
+    return event
+
+class Event:
+    """A published event and its encoded frames, one per wire format"""
+
+    __slots__ = ("_payload", "_frames")
+
+    def __init__(self, payload: Optional[Dict[str, Any]] = None, json_text: Optional[str] = None):
+        self._payload = payload
+        self._frames: Dict[str, Union[str, bytes]] = {}
+        if json_text is not None:
+            self._frames[JSON] = json_text
+
+    @classmethod
+    def of(cls, event: Union["Event", Dict[str, Any], str]) -> "Event":
+        """Wrap a payload dict or an already JSON-encoded string"""
+        if isinstance(event, Event):
+            return event
+        if isinstance(event, str):
+            return cls(json_text=event)
+        return cls(event)
+
+    @property
+    def payload(self) -> Dict[str, Any]:
+        if self._payload is None:
+            self._payload = json.loads(self._frames[JSON])
+        return self._payload
+
+    def frame(self, encoding: str = JSON) -> Union[str, bytes]:
+        """The frame for a wire format: str for text frames, bytes for binary"""
+        frame = self._frames.get(encoding)
+        if frame is None:
+            if encoding == JSON:
+                frame = json.dumps(self.payload, separators=(",", ":"))
+            elif encoding == MSGPACK_DEFLATE:
+                frame = plain = self.frame(MSGPACK)
+                if len(plain) > COMPRESS_MIN_BYTES:
+                    deflated = bytes((FRAME_DEFLATE,)) + _deflate(plain[1:])
+                    if len(deflated) < len(plain):
+                        frame = deflated
+            else:
+                frame = bytes((FRAME_PLAIN,)) + msgpack.packb(_rename(self.payload, KEY_ALIASES))
+            self._frames[encoding] = frame
+        return frame
+
+def _deflate(body: bytes) -> bytes:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+    return compressor.compress(body) + compressor.flush()
+
+def encoding_event(encoding: str) -> Dict[str, Any]:
+    """First event on a binary connection: its format and key table"""
+    return {
+        "type": "encoding",
+        "encoding": encoding,
+        "keys": EXPANDED_KEYS,
+    }